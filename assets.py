@@ -0,0 +1,92 @@
+import hashlib
+import logging
+import os
+from time import monotonic
+from typing import Awaitable, Callable
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, InputFile, Message
+
+import database as db
+
+# Так Telegram отвечает на file_id, который больше не принимает (файл удалён, сменился бот и т.п.)
+_STALE_FILE_ID_MARKERS = ("file identifier", "file reference", "file_id")
+# Как часто сверять картинку с диском: меняют их только при выкладке, а экран показывается на каждое нажатие
+ASSET_STAT_INTERVAL = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+def is_stale_file_id(error: Exception) -> bool:
+    if not isinstance(error, TelegramBadRequest):
+        return False
+    message = error.message.lower()
+    return any(marker in message for marker in _STALE_FILE_ID_MARKERS)
+
+
+def _sent_file_id(message: Message | bool | None) -> str | None:
+    # Правка inline-сообщения возвращает True, а не Message — file_id тогда узнать неоткуда
+    photo = getattr(message, "photo", None)
+    if photo:
+        return photo[-1].file_id
+    document = getattr(message, "document", None)
+    return document.file_id if document else None
+
+
+class AssetRegistry:
+    """Локальные картинки загружаются в Telegram один раз, дальше отправляются по file_id.
+
+    file_id хранится в SQLite по хешу содержимого: изменённый файл получит новый id, а старый
+    после перезапуска не потеряется.
+    """
+
+    def __init__(self, stat_interval: float = ASSET_STAT_INTERVAL) -> None:
+        self.stat_interval = stat_interval
+        # path -> (mtime, size, sha256): файл перечитываем, только если он изменился на диске
+        self._hashes: dict[str, tuple[float, int, str]] = {}
+        # path -> когда в следующий раз делать os.stat
+        self._check_at: dict[str, float] = {}
+        self._file_ids: dict[str, str] = {}
+
+    def content_hash(self, path: str) -> str:
+        now = monotonic()
+        cached = self._hashes.get(path)
+        if cached and now < self._check_at[path]:
+            return cached[2]
+        stat = os.stat(path)
+        self._check_at[path] = now + self.stat_interval
+        if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+            return cached[2]
+        with open(path, "rb") as file:
+            digest = hashlib.sha256(file.read()).hexdigest()
+        self._hashes[path] = (stat.st_mtime, stat.st_size, digest)
+        return digest
+
+    async def file_id(self, content_hash: str) -> str | None:
+        file_id = self._file_ids.get(content_hash)
+        if file_id is None:
+            file_id = await db.get_asset_file_id(content_hash)
+            if file_id:
+                self._file_ids[content_hash] = file_id
+        return file_id
+
+    async def send(self, path: str, send: Callable[[str | InputFile], Awaitable[Message]]) -> Message:
+        """Вызывает send с file_id картинки, а если его нет или Telegram его отверг — с самим файлом."""
+        content_hash = self.content_hash(path)
+        file_id = await self.file_id(content_hash)
+        if file_id:
+            try:
+                return await send(file_id)
+            except TelegramBadRequest as exc:
+                if not is_stale_file_id(exc):
+                    raise
+                logger.warning("file_id для %s больше не действует, загружаю файл заново", path)
+                self._file_ids.pop(content_hash, None)
+                await db.delete_asset_file_id(content_hash)
+
+        message = await send(FSInputFile(path))
+        file_id = _sent_file_id(message)
+        if file_id:
+            self._file_ids[content_hash] = file_id
+            await db.save_asset_file_id(content_hash, file_id)
+        return message
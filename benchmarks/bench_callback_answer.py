@@ -0,0 +1,76 @@
+"""Время до остановки "часиков" на кнопке: ответ в конце обработчика против CallbackAnswerMiddleware.
+
+Обработчик моделируется как в handlers.py: чтение из базы, правка сообщения (запрос к Telegram),
+затем callback.answer(). Задержки сети и базы случайные, с фиксированным seed.
+
+Запуск из корня проекта: python benchmarks/bench_callback_answer.py
+"""
+import asyncio
+import os
+import random
+import statistics
+import sys
+from time import perf_counter
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot
+from aiogram.types import CallbackQuery, User
+
+from middlewares import CallbackAnswerMiddleware
+
+RUNS = 300
+SEED = 1
+
+
+def _latencies(rng: random.Random) -> tuple[float, float, float]:
+    # (база, правка сообщения, answerCallbackQuery) в секундах; у сети длинный хвост
+    return rng.uniform(0.001, 0.02), rng.lognormvariate(-2.3, 0.5), rng.lognormvariate(-2.5, 0.4)
+
+
+async def _run(use_middleware: bool) -> list[float]:
+    rng = random.Random(SEED)
+    bot = Bot("1:bench")
+    middleware = CallbackAnswerMiddleware()
+    results = []
+
+    for run in range(RUNS):
+        db_delay, edit_delay, answer_delay = _latencies(rng)
+        started = perf_counter()
+        stopped = []
+
+        async def fake_answer(self, *args, **kwargs):
+            await asyncio.sleep(answer_delay)
+            stopped.append(perf_counter() - started)
+            return True
+
+        async def handler(callback, data):
+            await asyncio.sleep(db_delay)
+            await asyncio.sleep(edit_delay)
+            await callback.answer()
+
+        event = CallbackQuery(
+            id=str(run), from_user=User(id=1, is_bot=False, first_name="u"), chat_instance="1", data="prod_crm"
+        ).as_(bot)
+        with patch.object(CallbackQuery, "answer", fake_answer):
+            if use_middleware:
+                await middleware(handler, event, {})
+            else:
+                await handler(event, {})
+        results.append(stopped[0])
+    return results
+
+
+def _report(name: str, samples: list[float]) -> None:
+    quantiles = statistics.quantiles(samples, n=20)
+    print(f"{name:<22}p50 {statistics.median(samples) * 1000:6.1f} ms   p95 {quantiles[18] * 1000:6.1f} ms")
+
+
+async def main() -> None:
+    _report("answer after handler", await _run(False))
+    _report("answer middleware", await _run(True))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
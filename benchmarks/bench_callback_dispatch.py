@@ -0,0 +1,105 @@
+"""Сравнивает разбор callback_data перебором фильтров aiogram и таблицей callbacks.CallbackTable.
+
+"До" — роутер с теми же фильтрами F.data/StateFilter, что были в handlers.py, в том же порядке;
+"после" — роутер handlers.py с единственным обработчиком-таблицей. Обработчики подменены пустыми,
+так что меряется только поиск обработчика и разбор данных.
+
+Запуск из корня проекта: python benchmarks/bench_callback_dispatch.py
+"""
+import asyncio
+import os
+import sys
+from time import perf_counter
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import F, Router
+from aiogram.filters import StateFilter
+from aiogram.types import CallbackQuery, User
+
+import handlers
+from handlers import AdminStates as S
+
+NUMBER = 20_000
+
+LEGACY_FILTERS = (
+    (F.data == "admin_back",),
+    (F.data == "admin_upload",),
+    (F.data == "admin_delete_upload",),
+    (F.data == "admin_view_products",),
+    (F.data == "admin_send_notification",),
+    (S.waiting_for_notification_target, F.data.startswith("notify_")),
+    (F.data == "confirm_yes", S.waiting_for_notification_target),
+    (F.data.startswith("broadcast_"),),
+    (F.data == "confirm_no",),
+    (F.data == "admin_stats",),
+    (S.waiting_for_product_selection, F.data.startswith("prod_")),
+    (S.waiting_for_file_type, F.data.startswith("file_type_")),
+    (S.waiting_for_delete_product, F.data.startswith("admin_del_prod_")),
+    (S.waiting_for_delete_target, F.data == "admin_delete_back_products"),
+    (StateFilter(S.waiting_for_delete_product, S.waiting_for_delete_target), F.data == "admin_delete_cancel"),
+    (S.waiting_for_delete_target, F.data.startswith("admin_del_target_")),
+    (S.waiting_for_platform, F.data.startswith("platform_")),
+    (S.waiting_for_broadcast_action, F.data.startswith("upload_broadcast_")),
+    (S.waiting_for_broadcast_action, F.data == "upload_save_only"),
+    (S.waiting_for_broadcast_action, F.data == "upload_cancel"),
+    (F.data == "back_to_shop",),
+    (F.data == "back_to_scout_scope",),
+    (F.data.startswith("prod_"),),
+    (F.data.startswith("demo_select_"),),
+    (F.data == "scout_scope_instruction",),
+    (F.data == "demo_scout_scope",),
+    (F.data.startswith("demo_download_"),),
+    (F.data == "buy_scout_scope",),
+    (F.data.startswith("plan_scout_scope_"),),
+    (F.data.startswith("buy_"),),
+)
+
+SAMPLES = ("admin_back", "prod_scout_scope", "demo_download_scout_scope_win", "buy_crm")
+
+
+async def _noop(*args, **kwargs):
+    return None
+
+
+def _legacy_router() -> Router:
+    router = Router()
+    for filters in LEGACY_FILTERS:
+        router.callback_query.register(_noop, *filters)
+    return router
+
+
+def _table_router() -> Router:
+    router = Router()
+    router.callback_query.register(handlers.callbacks.dispatch)
+    return router
+
+
+async def _measure(router: Router, data: str) -> float:
+    user = User(id=1, is_bot=False, first_name="u")
+    event = CallbackQuery(id="1", from_user=user, chat_instance="1", data=data)
+    started = perf_counter()
+    for _ in range(NUMBER):
+        await router.propagate_event("callback_query", event, raw_state=None)
+    return (perf_counter() - started) / NUMBER * 1e6
+
+
+async def main() -> None:
+    legacy = _legacy_router()
+    table = _table_router()
+    print(f"{'callback_data':<34}{'filters, us':>13}{'table, us':>12}")
+    for data in SAMPLES:
+        before = await _measure(legacy, data)
+        # Подменяем обработчики маршрутов пустыми, оставляя сам разбор
+        routes = [route for routes in handlers.callbacks._routes.values() for route in routes]
+        with patch.multiple(handlers.callbacks, _routes={
+            key: [type(route)(_noop, route.states, route.fields, route.params, True) for route in routes]
+            for key, routes in handlers.callbacks._routes.items()
+        }):
+            after = await _measure(table, data)
+        print(f"{data:<34}{before:>13.1f}{after:>12.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
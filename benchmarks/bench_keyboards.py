@@ -0,0 +1,34 @@
+"""Сравнивает сборку клавиатур заново с выдачей готовых объектов из кэша.
+
+Запуск из корня проекта: python benchmarks/bench_keyboards.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import keyboards as kb
+
+NUMBER = 20_000
+
+CASES = (
+    ("main_menu", kb.main_menu, ()),
+    ("products_menu", kb.products_menu, ()),
+    ("admin_menu", kb.admin_menu, ()),
+    ("notification_products_menu", kb.notification_products_menu, ()),
+    ("scout_scope_menu(True)", kb.scout_scope_menu, (True,)),
+    ("demo_platform_menu('crm')", kb.demo_platform_menu, ("crm",)),
+)
+
+
+def main() -> None:
+    print(f"{'menu':<30}{'build, us':>12}{'cached, us':>12}{'speedup':>10}")
+    for name, menu, args in CASES:
+        build = timeit.timeit(lambda: menu.__wrapped__(*args), number=NUMBER) / NUMBER * 1e6
+        cached = timeit.timeit(lambda: menu(*args), number=NUMBER) / NUMBER * 1e6
+        print(f"{name:<30}{build:>12.2f}{cached:>12.3f}{build / cached:>9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
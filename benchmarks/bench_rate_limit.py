@@ -0,0 +1,72 @@
+"""Память и время вызова RateLimitMiddleware на 1M пользователей: скользящее окно против GCRA.
+
+Каждый пользователь присылает по REQUESTS_PER_USER апдейтов (как при листании меню),
+после чего меряется память, занятая состоянием лимитера, и среднее время вызова.
+
+Запуск из корня проекта: python benchmarks/bench_rate_limit.py [число пользователей]
+"""
+import asyncio
+import gc
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+from types import SimpleNamespace
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import middlewares
+import ratelimit
+
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+REQUESTS_PER_USER = 3
+
+
+async def _handler(event, data):
+    return None
+
+
+async def _feed(limiter, events, clock) -> int:
+    calls = 0
+    for _ in range(REQUESTS_PER_USER):
+        for event in events:
+            await limiter(_handler, event, {})
+            calls += 1
+        # Следующий круг через секунду: запросы проходят лимит, очередь окна растёт
+        clock[0] += 1.0
+    return calls
+
+
+async def _run(algorithm: str) -> tuple[float, float]:
+    events = [SimpleNamespace(from_user=SimpleNamespace(id=user_id)) for user_id in range(USERS)]
+    clock = [0.0]
+    with patch.object(ratelimit, "monotonic", new=lambda: clock[0]):
+        # Время и память меряем в разных прогонах: tracemalloc сильно замедляет вызовы
+        limiter = middlewares.RateLimitMiddleware(algorithm=algorithm)
+        started = perf_counter()
+        calls = await _feed(limiter, events, clock)
+        per_call = (perf_counter() - started) / calls * 1e6
+        del limiter
+
+        clock[0] = 0.0
+        gc.collect()
+        tracemalloc.start()
+        limiter = middlewares.RateLimitMiddleware(algorithm=algorithm)
+        await _feed(limiter, events, clock)
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    assert len(limiter.backend) == USERS
+    return memory / USERS, per_call
+
+
+async def main() -> None:
+    print(f"{USERS} пользователей, по {REQUESTS_PER_USER} запроса")
+    print(f"{'algorithm':<10}{'bytes/user':>12}{'us/call':>10}")
+    for algorithm in (middlewares.RATE_LIMIT_WINDOW, middlewares.RATE_LIMIT_GCRA):
+        per_user, per_call = await _run(algorithm)
+        print(f"{algorithm:<10}{per_user:>12.0f}{per_call:>10.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,394 @@
+import asyncio
+import itertools
+import logging
+import random
+from collections import deque
+from time import monotonic
+from typing import AsyncIterable, Awaitable, Callable
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+# Telegram допускает ~30 сообщений в секунду на бота и ~1 в секунду в один чат
+BROADCAST_RATE = 25.0
+BROADCAST_WORKERS = 8
+PER_CHAT_INTERVAL = 1.0
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+# Telegram ограничивает частоту правок сообщения, чаще раза в несколько секунд прогресс не обновляем
+PROGRESS_INTERVAL = 3.0
+
+_UNREACHABLE_MARKERS = ("chat not found", "user is deactivated", "bot was blocked")
+
+logger = logging.getLogger(__name__)
+
+
+def is_unreachable(error: Exception) -> bool:
+    """Получатель недоступен насовсем: заблокировал бота, удалил аккаунт или чат не существует."""
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    if isinstance(error, TelegramBadRequest):
+        message = error.message.lower()
+        return any(marker in message for marker in _UNREACHABLE_MARKERS)
+    return False
+
+
+class TokenBucket:
+    """Глобальный лимит отправок: rate токенов в секунду, всплеск до capacity."""
+
+    def __init__(self, rate: float = BROADCAST_RATE, capacity: float | None = None) -> None:
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Останавливает выдачу токенов (flood wait от Telegram); после паузы без всплеска."""
+        resume_at = monotonic() + seconds
+        if resume_at > self._paused_until:
+            self._paused_until = resume_at
+            self._tokens = 0.0
+            self._updated = resume_at
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        # Замок даёт очередь FIFO: воркеры не обгоняют друг друга за токенами
+        async with self._lock:
+            while True:
+                now = monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+class ChatPacer:
+    """Минимальный интервал между сообщениями в один чат."""
+
+    def __init__(self, interval: float = PER_CHAT_INTERVAL) -> None:
+        self.interval = interval
+        self._ready_at: dict[int, float] = {}
+        self._expiry: deque[tuple[float, int]] = deque()
+
+    def __len__(self) -> int:
+        return len(self._ready_at)
+
+    def _expire(self, now: float) -> None:
+        expiry = self._expiry
+        while expiry and expiry[0][0] <= now:
+            ready_at, chat_id = expiry.popleft()
+            if self._ready_at.get(chat_id) == ready_at:
+                del self._ready_at[chat_id]
+
+    async def wait(self, chat_id: int) -> None:
+        now = monotonic()
+        self._expire(now)
+        ready_at = self._ready_at.get(chat_id)
+        if ready_at is not None and ready_at > now:
+            self._ready_at[chat_id] = ready_at + self.interval
+            self._expiry.append((ready_at + self.interval, chat_id))
+            await asyncio.sleep(ready_at - now)
+            return
+
+        self._ready_at[chat_id] = now + self.interval
+        self._expiry.append((now + self.interval, chat_id))
+
+
+class RetryPolicy:
+    """Решает, повторять ли отправку после ошибки и через сколько секунд."""
+
+    def __init__(
+        self,
+        max_attempts: int = RETRY_MAX_ATTEMPTS,
+        base_delay: float = RETRY_BASE_DELAY,
+        max_delay: float = RETRY_MAX_DELAY,
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay_for(self, error: Exception, attempt: int) -> float | None:
+        # attempt — номер уже неудавшейся попытки, начиная с 1; None — ошибка окончательная
+        if attempt >= self.max_attempts:
+            return None
+        if isinstance(error, TelegramRetryAfter):
+            return float(error.retry_after)
+        if isinstance(error, (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError)):
+            # Full jitter: воркеры после сбоя сети не возвращаются все в один момент
+            return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        # Forbidden, "chat not found" и прочие BadRequest повтор не исправит
+        return None
+
+
+class DelayQueue:
+    """Отложенные повторы: элемент попадает в очередь готовых по истечении задержки."""
+
+    def __init__(self, ready: asyncio.Queue) -> None:
+        self._ready = ready
+        self._handles: dict[int, asyncio.TimerHandle] = {}
+        self._keys = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._handles)
+
+    def put(self, item, delay: float) -> None:
+        key = next(self._keys)
+        self._handles[key] = asyncio.get_running_loop().call_later(delay, self._release, key, item)
+
+    def _release(self, key: int, item) -> None:
+        del self._handles[key]
+        self._ready.put_nowait(item)
+
+    def clear(self) -> None:
+        for handle in self._handles.values():
+            handle.cancel()
+        self._handles.clear()
+
+
+class SkipDelivery(Exception):
+    """send() решил, что получателю нечего отправлять: не ошибка и не доставка."""
+
+
+class BroadcastStats:
+    __slots__ = ("sent", "failed", "skipped", "retried")
+
+    def __init__(self) -> None:
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self.retried = 0
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed + self.skipped
+
+
+class BroadcastEngine:
+    """Рассылка пулом воркеров в пределах глобального и почат-лимитов Telegram."""
+
+    def __init__(
+        self,
+        rate: float = BROADCAST_RATE,
+        workers: int = BROADCAST_WORKERS,
+        per_chat_interval: float = PER_CHAT_INTERVAL,
+        retry_policy: RetryPolicy | None = None,
+        throttle_sends: bool = True,
+    ) -> None:
+        self.workers = max(1, workers)
+        # False — send сам вызывает throttle() перед запросом: пропуск получателя не тратит лимит
+        self.throttle_sends = throttle_sends
+        self.bucket = TokenBucket(rate)
+        self.pacer = ChatPacer(per_chat_interval)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.stats = BroadcastStats()
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+        self._cancelled = asyncio.Event()
+
+    @property
+    def paused(self) -> bool:
+        return not self._resumed.is_set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def pause(self) -> None:
+        # Уже начатые отправки доводятся до конца, новые ждут resume()
+        if not self.cancelled:
+            self._resumed.clear()
+
+    def resume(self) -> None:
+        self._resumed.set()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+        self._resumed.set()
+
+    async def throttle(self, chat_id: int) -> None:
+        """Ждёт права на один запрос к чату; вызывать перед каждым дополнительным запросом в send."""
+        await self.pacer.wait(chat_id)
+        await self.bucket.acquire()
+
+    async def run(
+        self,
+        batches: AsyncIterable[list[int]],
+        send: Callable[[int], Awaitable[object]],
+        on_result: Callable[[int, Exception | None], None] | None = None,
+    ) -> BroadcastStats:
+        stats = self.stats
+        # Повторы и свежие получатели идут через одну неограниченную очередь, а окно
+        # ограничивает число незавершённых свежих: чтение аудитории не убегает вперёд отправки,
+        # а отложенный повтор никогда не ждёт места в очереди
+        ready: asyncio.Queue = asyncio.Queue()
+        window = asyncio.Semaphore(self.workers * 4)
+        delayed = DelayQueue(ready)
+        done = asyncio.Event()
+        outstanding = 0
+        producing = True
+
+        def settle(chat_id: int, error: Exception | None) -> None:
+            nonlocal outstanding
+            if error is None:
+                stats.sent += 1
+            elif isinstance(error, SkipDelivery):
+                stats.skipped += 1
+            else:
+                stats.failed += 1
+            if on_result is not None:
+                try:
+                    on_result(chat_id, error)
+                except Exception:
+                    logger.exception("Ошибка обработки результата рассылки для %s", chat_id)
+            outstanding -= 1
+            window.release()
+            if not producing and not outstanding:
+                done.set()
+
+        async def produce() -> None:
+            nonlocal outstanding, producing
+            async for batch in batches:
+                for chat_id in batch:
+                    await window.acquire()
+                    outstanding += 1
+                    ready.put_nowait((chat_id, 0))
+            producing = False
+            if not outstanding:
+                done.set()
+
+        async def work() -> None:
+            while True:
+                item = await ready.get()
+                if item is None or self.cancelled:
+                    return
+                await self._resumed.wait()
+                if self.cancelled:
+                    return
+
+                chat_id, attempt = item
+                try:
+                    if self.throttle_sends:
+                        await self.throttle(chat_id)
+                    await send(chat_id)
+                except SkipDelivery as exc:
+                    settle(chat_id, exc)
+                    continue
+                except Exception as exc:
+                    attempt += 1
+                    if isinstance(exc, TelegramRetryAfter):
+                        self.bucket.pause(exc.retry_after)
+                    delay = self.retry_policy.delay_for(exc, attempt)
+                    if delay is None:
+                        settle(chat_id, exc)
+                    else:
+                        logger.info("Повтор отправки в %s через %.1f с: %s", chat_id, delay, exc)
+                        stats.retried += 1
+                        delayed.put((chat_id, attempt), delay)
+                    continue
+                settle(chat_id, None)
+
+        producer = asyncio.create_task(produce())
+        workers = [asyncio.create_task(work()) for _ in range(self.workers)]
+        finished = asyncio.create_task(done.wait())
+        stopped = asyncio.create_task(self._cancelled.wait())
+        try:
+            # Воркеры бесконечны: ждём итога по всем получателям или отмены,
+            # а ошибку продюсера (чтение аудитории) пробрасываем сразу
+            pending = {producer, finished, stopped}
+            while finished in pending and stopped in pending:
+                completed, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                if producer in completed and producer.exception() is not None:
+                    producer.result()
+
+            if self.cancelled:
+                # Даём воркерам довести начатые отправки, чтобы их итог попал в журнал
+                producer.cancel()
+                delayed.clear()
+                for _ in workers:
+                    ready.put_nowait(None)
+                await asyncio.gather(*workers, return_exceptions=True)
+        finally:
+            delayed.clear()
+            for task in (producer, finished, stopped, *workers):
+                task.cancel()
+        return stats
+
+
+class BroadcastJob:
+    """Фоновая рассылка: держит движок для паузы/отмены и считает прогресс."""
+
+    def __init__(self, broadcast_id: int, engine: BroadcastEngine, total: int | None = None) -> None:
+        self.broadcast_id = broadcast_id
+        self.engine = engine
+        self.total = total
+        self.task: asyncio.Task | None = None
+        # Приостановлена до перезапуска: в отличие от отмены, рассылка продолжится после старта
+        self.suspended = False
+        # Последний опубликованный текст прогресса: одинаковый повторно не отправляем
+        self.last_progress: str | None = None
+        self._started_at = monotonic()
+        self._paused_at: float | None = None
+        self._paused_total = 0.0
+
+    @property
+    def stats(self) -> BroadcastStats:
+        return self.engine.stats
+
+    def pause(self) -> None:
+        if self._paused_at is None and not self.engine.cancelled:
+            self._paused_at = monotonic()
+        self.engine.pause()
+
+    def resume(self) -> None:
+        if self._paused_at is not None:
+            self._paused_total += monotonic() - self._paused_at
+            self._paused_at = None
+        self.engine.resume()
+
+    def cancel(self) -> None:
+        self.resume()
+        self.engine.cancel()
+
+    def suspend(self) -> None:
+        self.suspended = True
+        self.cancel()
+
+    def active_seconds(self) -> float:
+        paused = self._paused_total
+        if self._paused_at is not None:
+            paused += monotonic() - self._paused_at
+        return max(0.0, monotonic() - self._started_at - paused)
+
+    def rate(self) -> float:
+        elapsed = self.active_seconds()
+        return self.stats.processed / elapsed if elapsed > 0 else 0.0
+
+    def eta(self) -> float | None:
+        rate = self.rate()
+        if self.total is None or rate <= 0:
+            return None
+        return max(0, self.total - self.stats.processed) / rate
+
+    async def report_progress(self, publish: Callable[[], Awaitable[object]], interval: float) -> None:
+        """Вызывает publish не чаще раза в interval секунд, пока задача рассылки не закончится."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await publish()
+            except Exception:
+                logger.debug("Не удалось обновить прогресс рассылки %s", self.broadcast_id, exc_info=True)
@@ -0,0 +1,112 @@
+import inspect
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.fsm.state import State
+from aiogram.types import CallbackQuery
+
+# Разделитель полей в callback_data; ключ продукта сам может содержать "_" (scout_scope)
+SEPARATOR = "_"
+
+
+def pack(prefix: str, *fields: object) -> str:
+    """Собирает callback_data из префикса маршрута и его полей: pack("demo_download_", "crm", "win")."""
+    return prefix + SEPARATOR.join(str(field) for field in fields)
+
+
+@dataclass(frozen=True, slots=True)
+class CallbackRoute:
+    handler: Callable[..., Awaitable[Any]]
+    # None — обработчик срабатывает в любом состоянии FSM
+    states: frozenset[str | None] | None
+    fields: tuple[str, ...]
+    params: frozenset[str]
+    accepts_any: bool
+
+    def unpack(self, payload: str) -> dict[str, str] | None:
+        if not self.fields:
+            return {}
+        # Лишние "_" достаются первому полю: "scout_scope_win" -> ("scout_scope", "win")
+        values = payload.rsplit(SEPARATOR, len(self.fields) - 1)
+        if len(values) != len(self.fields):
+            return None
+        return dict(zip(self.fields, values))
+
+    async def __call__(self, callback: CallbackQuery, data: dict[str, Any]):
+        if not self.accepts_any:
+            data = {name: value for name, value in data.items() if name in self.params}
+        return await self.handler(callback, **data)
+
+
+class CallbackTable:
+    """Диспетчер callback_data по словарю вместо перебора фильтров aiogram.
+
+    Маршрут — точное значение ("admin_back") или префикс, оканчивающийся на "_" ("prod_").
+    Префиксы ищутся от самого длинного кандидата к короткому, так что разбор стоит
+    O(длины callback_data, ≤ 64 байт) и не зависит от числа маршрутов.
+    """
+
+    def __init__(self) -> None:
+        self._routes: dict[str, list[CallbackRoute]] = {}
+
+    def route(self, key: str, *states: State | str | None, fields: tuple[str, ...] = ()):
+        """Регистрирует обработчик; поля префикса передаются ему именованными аргументами."""
+        state_names = frozenset(state.state if isinstance(state, State) else state for state in states)
+
+        def register(handler):
+            signature = inspect.signature(handler)
+            params = frozenset(signature.parameters)
+            accepts_any = any(
+                param.kind is inspect.Parameter.VAR_KEYWORD for param in signature.parameters.values()
+            )
+            route = CallbackRoute(handler, state_names or None, fields, params, accepts_any)
+            routes = self._routes.setdefault(key, [])
+            # Обработчики с фильтром по состоянию проверяются раньше общих
+            if route.states:
+                routes.insert(0, route)
+            else:
+                routes.append(route)
+            return handler
+
+        return register
+
+    def _match(self, key: str, payload: str, raw_state: str | None):
+        for route in self._routes.get(key, ()):
+            if route.states is not None and raw_state not in route.states:
+                continue
+            fields = route.unpack(payload)
+            if fields is not None:
+                return route, fields
+        return None
+
+    def resolve(self, data: str, raw_state: str | None = None) -> tuple[CallbackRoute, dict[str, str]] | None:
+        match = self._match(data, "", raw_state)
+        end = data.rfind(SEPARATOR)
+        while match is None and end > 0:
+            match = self._match(data[:end + 1], data[end + 1:], raw_state)
+            end = data.rfind(SEPARATOR, 0, end)
+        return match
+
+    def match_for(self, callback: CallbackQuery, data: dict[str, Any]) -> tuple[CallbackRoute, dict[str, str]] | None:
+        """Маршрут нажатия; найденный один раз кладётся в data для следующих middleware и dispatch."""
+        match = data.get("callback_match")
+        if match is None:
+            match = self.resolve(callback.data or "", data.get("raw_state"))
+            if match is not None:
+                data["callback_match"] = match
+        return match
+
+    async def dispatch(
+        self,
+        callback: CallbackQuery,
+        raw_state: str | None = None,
+        callback_match: tuple[CallbackRoute, dict[str, str]] | None = None,
+        **data: Any,
+    ):
+        # Маршрут могли уже найти middleware (match_for) — тогда не ищем повторно
+        match = callback_match or self.resolve(callback.data or "", raw_state)
+        if match is None:
+            return UNHANDLED
+        route, fields = match
+        return await route(callback, {**data, "raw_state": raw_state, **fields})
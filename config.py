@@ -5,3 +5,7 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_IDS = [int(id) for id in os.getenv("ADMIN_IDS", "").split(",") if id]
+# Файл SQLite с общим состоянием лимитера, если бот запущен в нескольких процессах
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB")
+# Порт /metrics в формате Prometheus на 127.0.0.1; 0 — не поднимать
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
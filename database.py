@@ -1,116 +1,757 @@
+import asyncio
+import logging
+import json
+from contextlib import asynccontextmanager
+from time import monotonic, time
+
 import aiosqlite
 
 DB_NAME = 'bot_database.db'
+READER_POOL_SIZE = 2
+CATALOG_CHECK_INTERVAL = 5.0
+USER_FLUSH_BATCH = 500
+USER_FLUSH_INTERVAL = 1.0
+USER_CHUNK_SIZE = 1000
+LEDGER_FLUSH_BATCH = 200
+LEDGER_FLUSH_INTERVAL = 2.0
 
-async def create_tables():
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                full_name TEXT
-            )
-        ''')
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS products (
-                key TEXT PRIMARY KEY,
-                name TEXT,
-                file_id TEXT,
-                file_id_mac TEXT,
-                description TEXT,
-                version TEXT,
-                version_mac TEXT,
-                db_file_id TEXT,
-                db_version TEXT
-            )
-        ''')
-        # Migrate: add missing columns for macOS builds if DB existed before
-        async with db.execute('PRAGMA table_info(products)') as cursor:
-            columns = {row[1] for row in await cursor.fetchall()}
-        if 'file_id_mac' not in columns:
-            await db.execute('ALTER TABLE products ADD COLUMN file_id_mac TEXT')
-        if 'version_mac' not in columns:
-            await db.execute('ALTER TABLE products ADD COLUMN version_mac TEXT')
-        # Insert default products if not exist
-        scout_scope_desc = (
-            '*Представь:* все данные об игроках - в одном клике.\n'
-            '• Возраст и роль\n'
-            '• Steam-профиль и пул карт\n'
-            '• Автосбор и порядок в карточках\n'
-            'Быстро. Четко. По делу.'
+SEGMENT_VIEW = 'view'
+SEGMENT_DEMO = 'demo'
+SEGMENT_BUY = 'buy'
+
+DELIVERY_PENDING = 'pending'
+DELIVERY_SENT = 'sent'
+DELIVERY_FAILED = 'failed'
+DELIVERY_BLOCKED = 'blocked'
+# Получателю нечего было отправлять: все файлы этой версии у него уже есть
+DELIVERY_SKIPPED = 'skipped'
+
+BROADCAST_RUNNING = 'running'
+BROADCAST_DONE = 'done'
+BROADCAST_CANCELLED = 'cancelled'
+
+logger = logging.getLogger(__name__)
+
+_CONNECTION_PRAGMAS = (
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -8000',
+    'PRAGMA mmap_size = 67108864',
+    'PRAGMA foreign_keys = ON',
+)
+
+
+async def _run_pragma(conn: aiosqlite.Connection, pragma: str) -> None:
+    # Курсор закрываем сразу: незавершенный PRAGMA держит блокировку файла
+    async with conn.execute(pragma):
+        pass
+
+
+class ConnectionPool:
+    """Долгоживущие соединения: один писатель под замком и пул читателей (WAL)."""
+
+    def __init__(self, path: str, readers: int = READER_POOL_SIZE) -> None:
+        self.path = path
+        self.readers = max(1, readers)
+        self._writer: aiosqlite.Connection | None = None
+        self._reader_conns: list[aiosqlite.Connection] = []
+        self._idle_readers: asyncio.Queue | None = None
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path)
+        conn.row_factory = aiosqlite.Row
+        try:
+            for pragma in _CONNECTION_PRAGMAS:
+                await _run_pragma(conn, pragma)
+        except BaseException:
+            await conn.close()
+            raise
+        return conn
+
+    async def open(self) -> None:
+        async with self._open_lock:
+            if self.is_open:
+                return
+
+            writer = await self._connect()
+            idle_readers: asyncio.Queue = asyncio.Queue()
+            try:
+                # journal_mode хранится в файле БД, достаточно выставить один раз с писателя
+                await _run_pragma(writer, 'PRAGMA journal_mode = WAL')
+                for _ in range(self.readers):
+                    reader = await self._connect()
+                    self._reader_conns.append(reader)
+                    await _run_pragma(reader, 'PRAGMA query_only = ON')
+                    idle_readers.put_nowait(reader)
+            except BaseException:
+                await writer.close()
+                for reader in self._reader_conns:
+                    await reader.close()
+                self._reader_conns.clear()
+                raise
+
+            self._idle_readers = idle_readers
+            self._writer = writer
+
+    async def close(self) -> None:
+        async with self._open_lock:
+            if not self.is_open:
+                return
+
+            async with self._write_lock:
+                writer, self._writer = self._writer, None
+                await writer.close()
+
+            for reader in self._reader_conns:
+                await reader.close()
+            self._reader_conns.clear()
+            self._idle_readers = None
+
+    @asynccontextmanager
+    async def reader(self):
+        if not self.is_open:
+            await self.open()
+
+        idle_readers = self._idle_readers
+        conn = await idle_readers.get()
+        try:
+            yield conn
+        finally:
+            idle_readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def transaction(self):
+        if not self.is_open:
+            await self.open()
+
+        async with self._write_lock:
+            conn = self._writer
+            try:
+                yield conn
+            except BaseException:
+                await conn.rollback()
+                raise
+            await conn.commit()
+
+
+class ProductCatalog:
+    """Снимок таблицы products в памяти, сверяется с файлом через PRAGMA data_version."""
+
+    def __init__(self, check_interval: float = CATALOG_CHECK_INTERVAL) -> None:
+        self.check_interval = check_interval
+        self._rows: dict[str, aiosqlite.Row] | None = None
+        self._data_version: int | None = None
+        self._checked_at = 0.0
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._rows is not None
+
+    def reset(self) -> None:
+        self._rows = None
+        self._data_version = None
+        self._checked_at = 0.0
+
+    async def reload(self, conn: aiosqlite.Connection) -> None:
+        # Читаем через писателя: его data_version меняется только от чужих коммитов
+        async with conn.execute('PRAGMA data_version') as cursor:
+            data_version = (await cursor.fetchone())[0]
+        async with conn.execute('SELECT * FROM products ORDER BY rowid') as cursor:
+            rows = await cursor.fetchall()
+
+        self._rows = {row['key']: row for row in rows}
+        self._data_version = data_version
+        self._checked_at = monotonic()
+
+    async def _is_stale(self, conn: aiosqlite.Connection) -> bool:
+        async with conn.execute('PRAGMA data_version') as cursor:
+            data_version = (await cursor.fetchone())[0]
+        self._checked_at = monotonic()
+        return data_version != self._data_version
+
+    async def rows(self) -> dict[str, aiosqlite.Row]:
+        if self._rows is not None and monotonic() - self._checked_at < self.check_interval:
+            return self._rows
+
+        async with _pool.transaction() as conn:
+            if self._rows is None or await self._is_stale(conn):
+                await self.reload(conn)
+        return self._rows
+
+
+class WriteBehindBuffer:
+    """Отложенная запись: копим upsert'ы по ключу и пишем одной транзакцией."""
+
+    def __init__(
+        self,
+        statement: str,
+        batch_size: int = USER_FLUSH_BATCH,
+        interval: float = USER_FLUSH_INTERVAL,
+    ) -> None:
+        self.statement = statement
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pending: dict[object, tuple] = {}
+        self._timer: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, key, params: tuple) -> None:
+        # Повтор по тому же ключу заменяет запись: в БД уйдёт только последняя версия
+        self._pending[key] = params
+        if len(self._pending) >= self.batch_size:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.interval)
+
+    def _schedule(self, delay: float) -> None:
+        if self._timer is not None:
+            if delay:
+                return
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().create_task(self._flush_later(delay))
+
+    async def _flush_later(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._pending:
+                return
+
+            batch, self._pending = self._pending, {}
+            try:
+                async with _pool.transaction() as conn:
+                    await conn.executemany(self.statement, list(batch.values()))
+            except BaseException as exc:
+                # Возвращаем пачку в буфер, не затирая более свежие данные
+                batch.update(self._pending)
+                self._pending = batch
+                if not isinstance(exc, Exception):
+                    raise
+                logger.exception("Не удалось записать пачку из %d строк, повторим позже", len(batch))
+                self._schedule(self.interval)
+
+    async def close(self) -> None:
+        timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        await self.flush()
+
+
+class DeliveryLedger:
+    """Буфер результатов рассылки: цикл отправки не ждёт записи каждого статуса в БД."""
+
+    def __init__(self, broadcast_id: int, batch_size: int = LEDGER_FLUSH_BATCH) -> None:
+        self.broadcast_id = broadcast_id
+        self.batch_size = batch_size
+        self._pending: list[tuple[int, str, str | None]] = []
+        self._flush_task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+        self._flushed_at = monotonic()
+
+    def record(self, user_id: int, status: str, error_code: str | None = None) -> None:
+        self._pending.append((user_id, status, error_code))
+        # Сбрасываем и по размеру, и по времени: после падения повторно уйдут максимум несекундные хвосты
+        due = len(self._pending) >= self.batch_size or monotonic() - self._flushed_at >= LEDGER_FLUSH_INTERVAL
+        if due and (self._flush_task is None or self._flush_task.done()):
+            self._flushed_at = monotonic()
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_in_background())
+
+    async def _flush_in_background(self) -> None:
+        # Ошибку фоновой записи никто не ждёт: логируем здесь, строки остаются в буфере до следующей попытки
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Не удалось записать статусы рассылки %s, повторим позже", self.broadcast_id)
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._pending:
+                return
+
+            batch, self._pending = self._pending, []
+            try:
+                await record_deliveries(self.broadcast_id, batch)
+            except BaseException:
+                self._pending[:0] = batch
+                raise
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        await self.flush()
+
+
+_pool = ConnectionPool(DB_NAME)
+_catalog = ProductCatalog()
+_users = WriteBehindBuffer(
+    'INSERT INTO users (user_id, username, full_name) VALUES (?, ?, ?) '
+    'ON CONFLICT(user_id) DO UPDATE SET '
+    'username = excluded.username, full_name = excluded.full_name, blocked_at = NULL '
+    'WHERE username IS NOT excluded.username OR full_name IS NOT excluded.full_name OR blocked_at IS NOT NULL'
+)
+_segments = WriteBehindBuffer(
+    'INSERT INTO user_segments (product_key, user_id, action, platform, updated_at) VALUES (?, ?, ?, ?, ?) '
+    'ON CONFLICT(product_key, user_id, action, platform) DO UPDATE SET updated_at = excluded.updated_at'
+)
+_artifacts = WriteBehindBuffer(
+    'INSERT INTO user_artifacts (user_id, product_key, artifact, version, updated_at) VALUES (?, ?, ?, ?, ?) '
+    'ON CONFLICT(user_id, product_key, artifact) DO UPDATE SET '
+    'version = excluded.version, updated_at = excluded.updated_at'
+)
+
+
+async def connect(path: str | None = None) -> None:
+    global _pool
+    if path is not None and path != _pool.path:
+        await _pool.close()
+        _pool = ConnectionPool(path)
+        _catalog.reset()
+    await _pool.open()
+
+
+async def close() -> None:
+    await _users.close()
+    await _segments.close()
+    await _artifacts.close()
+    await _pool.close()
+    _catalog.reset()
+
+
+async def load_catalog() -> None:
+    async with _pool.transaction() as conn:
+        await _catalog.reload(conn)
+
+
+async def _execute(sql: str, params=()) -> None:
+    async with _pool.transaction() as conn:
+        async with conn.execute(sql, params):
+            pass
+
+
+async def _update_product(sql: str, params=()) -> None:
+    async with _pool.transaction() as conn:
+        async with conn.execute(sql, params):
+            pass
+        await conn.commit()
+        # Обновляем снимок под тем же замком писателя, чтобы не было гонки с другими записями
+        await _catalog.reload(conn)
+
+
+async def _fetchone(sql: str, params=()):
+    async with _pool.reader() as conn:
+        async with conn.execute(sql, params) as cursor:
+            return await cursor.fetchone()
+
+
+async def _fetchall(sql: str, params=()):
+    async with _pool.reader() as conn:
+        async with conn.execute(sql, params) as cursor:
+            return await cursor.fetchall()
+
+
+async def _migrate_initial_schema(db: aiosqlite.Connection) -> None:
+    # Базы, созданные до реестра миграций, уже могут содержать эти таблицы
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            full_name TEXT
         )
-        crm_desc = (
-            '*Представь:* ты держишь под контролем все, что ведет к победе.\n'
-            '• Эмоции и настрой\n'
-            '• Психологическая устойчивость\n'
-            '• Игровые аспекты и дисциплина\n'
-            'Все собрано в одной системе.'
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS products (
+            key TEXT PRIMARY KEY,
+            name TEXT,
+            file_id TEXT,
+            file_id_mac TEXT,
+            description TEXT,
+            version TEXT,
+            version_mac TEXT,
+            db_file_id TEXT,
+            db_version TEXT
+        )
+    ''')
+    # Migrate: add missing columns for macOS builds if DB existed before
+    async with db.execute('PRAGMA table_info(products)') as cursor:
+        columns = {row[1] for row in await cursor.fetchall()}
+    if 'file_id_mac' not in columns:
+        await db.execute('ALTER TABLE products ADD COLUMN file_id_mac TEXT')
+    if 'version_mac' not in columns:
+        await db.execute('ALTER TABLE products ADD COLUMN version_mac TEXT')
+    # Insert default products if not exist
+    scout_scope_desc = (
+        '*Представь:* все данные об игроках - в одном клике.\n'
+        '• Возраст и роль\n'
+        '• Steam-профиль и пул карт\n'
+        '• Автосбор и порядок в карточках\n'
+        'Быстро. Четко. По делу.'
+    )
+    crm_desc = (
+        '*Представь:* ты держишь под контролем все, что ведет к победе.\n'
+        '• Эмоции и настрой\n'
+        '• Психологическая устойчивость\n'
+        '• Игровые аспекты и дисциплина\n'
+        'Все собрано в одной системе.'
+    )
+    await db.execute('INSERT OR IGNORE INTO products (key, name, description) VALUES (?, ?, ?)',
+                     ('scout_scope', 'ScoutScope', scout_scope_desc))
+    await db.execute('INSERT OR IGNORE INTO products (key, name, description) VALUES (?, ?, ?)',
+                     ('crm', 'PerformanceCoach CRM', crm_desc))
+    await db.execute('INSERT OR IGNORE INTO products (key, name, description) VALUES (?, ?, ?)',
+                     ('cis_bot', 'CIS FINDER BOT', 'Бот для поиска.'))
+    await db.execute('UPDATE products SET description = ? WHERE key = ?', (scout_scope_desc, 'scout_scope'))
+    await db.execute('UPDATE products SET description = ? WHERE key = ?', (crm_desc, 'crm'))
+
+
+async def _migrate_broadcast_ledger(db: aiosqlite.Connection) -> None:
+    await db.execute('''
+        CREATE TABLE broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_by INTEGER,
+            created_at INTEGER NOT NULL,
+            finished_at INTEGER
         )
-        await db.execute('INSERT OR IGNORE INTO products (key, name, description) VALUES (?, ?, ?)',
-                         ('scout_scope', 'ScoutScope', scout_scope_desc))
-        await db.execute('INSERT OR IGNORE INTO products (key, name, description) VALUES (?, ?, ?)',
-                         ('crm', 'PerformanceCoach CRM', crm_desc))
-        await db.execute('INSERT OR IGNORE INTO products (key, name, description) VALUES (?, ?, ?)',
-                         ('cis_bot', 'CIS FINDER BOT', 'Бот для поиска.'))
-        await db.execute('UPDATE products SET description = ? WHERE key = ?', (scout_scope_desc, 'scout_scope'))
-        await db.execute('UPDATE products SET description = ? WHERE key = ?', (crm_desc, 'crm'))
-        await db.commit()
+    ''')
+    await db.execute('''
+        CREATE TABLE broadcast_deliveries (
+            broadcast_id INTEGER NOT NULL REFERENCES broadcasts (id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            error_code TEXT,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+    # Покрывает и выборку следующей пачки pending, и подсчёт статусов по рассылке
+    await db.execute('''
+        CREATE INDEX idx_broadcast_deliveries_status
+        ON broadcast_deliveries (broadcast_id, status, user_id)
+    ''')
+
+
+async def _migrate_user_segments(db: aiosqlite.Connection) -> None:
+    # platform = '' для действий без привязки к ОС (просмотр, заявка на покупку)
+    await db.execute('''
+        CREATE TABLE user_segments (
+            product_key TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            platform TEXT NOT NULL DEFAULT '',
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (product_key, user_id, action, platform)
+        ) WITHOUT ROWID
+    ''')
+    await db.execute('''
+        CREATE INDEX idx_user_segments_action
+        ON user_segments (product_key, action, platform, user_id)
+    ''')
+
+
+async def _migrate_broadcast_cursor(db: aiosqlite.Connection) -> None:
+    # Последний user_id аудитории, уже поставленный в журнал: после рестарта аудиторию читаем дальше него
+    await db.execute('ALTER TABLE broadcasts ADD COLUMN audience_cursor INTEGER NOT NULL DEFAULT 0')
+
+
+async def _migrate_user_reachability(db: aiosqlite.Connection) -> None:
+    # blocked_at — когда Telegram ответил, что пользователь недоступен; NULL — доступен
+    await db.execute('ALTER TABLE users ADD COLUMN blocked_at INTEGER')
+    await db.execute('''
+        CREATE INDEX idx_users_blocked
+        ON users (user_id) WHERE blocked_at IS NOT NULL
+    ''')
+
+
+async def _migrate_user_artifacts(db: aiosqlite.Connection) -> None:
+    # Последняя доставленная пользователю версия каждого файла: artifact = app_win / app_mac / db
+    await db.execute('''
+        CREATE TABLE user_artifacts (
+            user_id INTEGER NOT NULL,
+            product_key TEXT NOT NULL,
+            artifact TEXT NOT NULL,
+            version TEXT,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (user_id, product_key, artifact)
+        ) WITHOUT ROWID
+    ''')
+
+
+async def _migrate_assets(db: aiosqlite.Connection) -> None:
+    # file_id загруженных в Telegram картинок по sha256 их содержимого
+    await db.execute('''
+        CREATE TABLE assets (
+            content_hash TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+
+# Порядок важен: номер миграции = позиция в кортеже, применённые не меняем, только дописываем новые
+MIGRATIONS = (
+    _migrate_initial_schema,
+    _migrate_broadcast_ledger,
+    _migrate_user_segments,
+    _migrate_broadcast_cursor,
+    _migrate_user_reachability,
+    _migrate_user_artifacts,
+    _migrate_assets,
+)
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+async def _read_user_version(conn: aiosqlite.Connection) -> int:
+    async with conn.execute('PRAGMA user_version') as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def create_tables():
+    # Быстрый путь: на актуальной базе старт стоит одного чтения PRAGMA
+    row = await _fetchone('PRAGMA user_version')
+    if row[0] >= SCHEMA_VERSION:
+        return
+
+    for number, migration in enumerate(MIGRATIONS, start=1):
+        async with _pool.transaction() as db:
+            # BEGIN IMMEDIATE берёт блокировку записи до проверки версии: параллельный процесс не применит миграцию дважды
+            await db.execute('BEGIN IMMEDIATE')
+            if await _read_user_version(db) >= number:
+                continue
+            logger.info("Применяю миграцию БД %d: %s", number, migration.__name__)
+            await migration(db)
+            await db.execute(f'PRAGMA user_version = {number}')
 
 async def add_user(user_id, username, full_name):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('INSERT OR IGNORE INTO users (user_id, username, full_name) VALUES (?, ?, ?)', 
-                         (user_id, username, full_name))
-        await db.commit()
+    _users.add(user_id, (user_id, username, full_name))
+
+async def mark_user_unreachable(user_id):
+    # Пользователь мог ещё лежать в буфере: сначала сбрасываем его, иначе UPDATE не найдёт строку
+    await _users.flush()
+    await _execute('UPDATE users SET blocked_at = ? WHERE user_id = ? AND blocked_at IS NULL', (int(time()), user_id))
+
+async def mark_user_reachable(user_id):
+    await _users.flush()
+    await _execute('UPDATE users SET blocked_at = NULL WHERE user_id = ? AND blocked_at IS NOT NULL', (user_id,))
+
+async def add_user_segment(user_id, product_key, action, platform=''):
+    _segments.add((product_key, user_id, action, platform), (product_key, user_id, action, platform, int(time())))
+
+async def flush_users():
+    await _users.flush()
+
+async def record_artifact_delivery(user_id, product_key, artifact, version):
+    _artifacts.add((user_id, product_key, artifact), (user_id, product_key, artifact, version, int(time())))
 
-async def get_all_users():
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute('SELECT user_id FROM users') as cursor:
-            return [row[0] for row in await cursor.fetchall()]
+async def get_delivered_versions(product_key, user_ids):
+    """Версии файлов продукта, уже доставленные пользователям: {user_id: {artifact: version}}."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    await _artifacts.flush()
+    # Список id одним JSON-параметром: SQLite до 3.32 не принимает больше 999 переменных
+    rows = await _fetchall(
+        "SELECT user_id, artifact, version FROM user_artifacts "
+        "WHERE user_id IN (SELECT value FROM json_each(?)) AND product_key = ?",
+        (json.dumps(user_ids), product_key),
+    )
+    delivered = {}
+    for user_id, artifact, version in rows:
+        delivered.setdefault(user_id, {})[artifact] = version
+    return delivered
+
+def _audience_query(exclude_user_ids=None, product_key=None, action=None, platform=None,
+                    include_unreachable=False):
+    filter_params = []
+    if product_key is None:
+        source = 'users'
+        clauses = [] if include_unreachable else ['blocked_at IS NULL']
+    else:
+        source = 'user_segments'
+        clauses = ['product_key = ?']
+        filter_params.append(product_key)
+        if action is not None:
+            clauses.append('action = ?')
+            filter_params.append(action)
+        if platform is not None:
+            clauses.append('platform = ?')
+            filter_params.append(platform)
+        if not include_unreachable:
+            # Заблокировавших бота немного, подзапрос читает только частичный индекс idx_users_blocked
+            clauses.append('user_id NOT IN (SELECT user_id FROM users WHERE blocked_at IS NOT NULL)')
+    if exclude_user_ids:
+        excluded = list(exclude_user_ids)
+        clauses.append(f"user_id NOT IN ({', '.join('?' * len(excluded))})")
+        filter_params.extend(excluded)
+    return source, clauses, filter_params
+
+async def iter_user_batches(chunk_size=USER_CHUNK_SIZE, after_user_id=0, exclude_user_ids=None, *,
+                            product_key=None, action=None, platform=None, include_unreachable=False):
+    # Keyset-пагинация по user_id: память постоянна, первая пачка готова сразу
+    await _users.flush()
+    await _segments.flush()
+    source, clauses, filter_params = _audience_query(
+        exclude_user_ids, product_key, action, platform, include_unreachable
+    )
+    where = ' AND '.join(['user_id > ?', *clauses])
+    sql = f"SELECT DISTINCT user_id FROM {source} WHERE {where} ORDER BY user_id LIMIT ?"
+
+    last_user_id = after_user_id
+    while True:
+        rows = await _fetchall(sql, (last_user_id, *filter_params, chunk_size))
+        if not rows:
+            return
+        batch = [row[0] for row in rows]
+        yield batch
+        if len(batch) < chunk_size:
+            return
+        last_user_id = batch[-1]
+
+async def iter_user_ids(chunk_size=USER_CHUNK_SIZE, after_user_id=0, exclude_user_ids=None, **filters):
+    async for batch in iter_user_batches(chunk_size, after_user_id, exclude_user_ids, **filters):
+        for user_id in batch:
+            yield user_id
+
+async def count_audience(*, product_key=None, action=None, platform=None, include_unreachable=False):
+    await _users.flush()
+    await _segments.flush()
+    source, clauses, filter_params = _audience_query(None, product_key, action, platform, include_unreachable)
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+    row = await _fetchone(f"SELECT COUNT(DISTINCT user_id) FROM {source}{where}", filter_params)
+    return row[0]
 
 async def update_product_file(key, file_id, version):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('UPDATE products SET file_id = ?, version = ? WHERE key = ?', (file_id, version, key))
-        await db.commit()
+    await _update_product('UPDATE products SET file_id = ?, version = ? WHERE key = ?', (file_id, version, key))
 
 async def update_product_file_mac(key, file_id, version):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('UPDATE products SET file_id_mac = ?, version_mac = ? WHERE key = ?', (file_id, version, key))
-        await db.commit()
+    await _update_product('UPDATE products SET file_id_mac = ?, version_mac = ? WHERE key = ?', (file_id, version, key))
 
 async def update_product_db(key, db_file_id, db_version):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('UPDATE products SET db_file_id = ?, db_version = ? WHERE key = ?', (db_file_id, db_version, key))
-        await db.commit()
+    await _update_product('UPDATE products SET db_file_id = ?, db_version = ? WHERE key = ?', (db_file_id, db_version, key))
 
 async def clear_product_file(key):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('UPDATE products SET file_id = NULL, version = NULL WHERE key = ?', (key,))
-        await db.commit()
+    await _update_product('UPDATE products SET file_id = NULL, version = NULL WHERE key = ?', (key,))
 
 async def clear_product_file_mac(key):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('UPDATE products SET file_id_mac = NULL, version_mac = NULL WHERE key = ?', (key,))
-        await db.commit()
+    await _update_product('UPDATE products SET file_id_mac = NULL, version_mac = NULL WHERE key = ?', (key,))
 
 async def clear_product_db(key):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('UPDATE products SET db_file_id = NULL, db_version = NULL WHERE key = ?', (key,))
-        await db.commit()
+    await _update_product('UPDATE products SET db_file_id = NULL, db_version = NULL WHERE key = ?', (key,))
 
 async def get_product(key):
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute('SELECT * FROM products WHERE key = ?', (key,)) as cursor:
-            return await cursor.fetchone()
+    catalog = await _catalog.rows()
+    return catalog.get(key)
 
 async def get_all_products():
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute('SELECT * FROM products') as cursor:
-            return await cursor.fetchall()
+    catalog = await _catalog.rows()
+    return list(catalog.values())
+
+async def get_asset_file_id(content_hash):
+    row = await _fetchone('SELECT file_id FROM assets WHERE content_hash = ?', (content_hash,))
+    return row[0] if row else None
+
+async def save_asset_file_id(content_hash, file_id):
+    await _execute(
+        'INSERT INTO assets (content_hash, file_id, updated_at) VALUES (?, ?, ?) '
+        'ON CONFLICT(content_hash) DO UPDATE SET file_id = excluded.file_id, updated_at = excluded.updated_at',
+        (content_hash, file_id, int(time())),
+    )
+
+async def delete_asset_file_id(content_hash):
+    await _execute('DELETE FROM assets WHERE content_hash = ?', (content_hash,))
 
 async def get_user_count():
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute('SELECT COUNT(*) FROM users') as cursor:
-            result = await cursor.fetchone()
-            return result[0]
+    await _users.flush()
+    result = await _fetchone('SELECT COUNT(*) FROM users')
+    return result[0]
+
+async def create_broadcast(kind, payload, created_by=None):
+    async with _pool.transaction() as conn:
+        async with conn.execute(
+            'INSERT INTO broadcasts (kind, payload, status, created_by, created_at) VALUES (?, ?, ?, ?, ?)',
+            (kind, json.dumps(payload, ensure_ascii=False), BROADCAST_RUNNING, created_by, int(time())),
+        ) as cursor:
+            return cursor.lastrowid
+
+async def finish_broadcast(broadcast_id, status=BROADCAST_DONE):
+    await _execute('UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ?',
+                   (status, int(time()), broadcast_id))
+
+async def get_broadcast(broadcast_id):
+    return await _fetchone('SELECT * FROM broadcasts WHERE id = ?', (broadcast_id,))
+
+async def add_pending_deliveries(broadcast_id, user_ids):
+    # Курсор двигаем в той же транзакции: пачка либо целиком в журнале и за курсором, либо нет
+    if not user_ids:
+        return
+    now = int(time())
+    async with _pool.transaction() as conn:
+        await conn.executemany(
+            'INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id, status, updated_at) '
+            'VALUES (?, ?, ?, ?)',
+            [(broadcast_id, user_id, DELIVERY_PENDING, now) for user_id in user_ids],
+        )
+        async with conn.execute(
+            'UPDATE broadcasts SET audience_cursor = MAX(audience_cursor, ?) WHERE id = ?',
+            (max(user_ids), broadcast_id),
+        ):
+            pass
+
+async def record_deliveries(broadcast_id, results):
+    now = int(time())
+    blocked = [(now, user_id) for user_id, status, _ in results if status == DELIVERY_BLOCKED]
+    if blocked:
+        await _users.flush()
+    async with _pool.transaction() as conn:
+        await conn.executemany(
+            'INSERT INTO broadcast_deliveries (broadcast_id, user_id, status, error_code, updated_at) '
+            'VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT(broadcast_id, user_id) DO UPDATE SET '
+            'status = excluded.status, error_code = excluded.error_code, updated_at = excluded.updated_at',
+            [(broadcast_id, user_id, status, error_code, now) for user_id, status, error_code in results],
+        )
+        # Недоступных сразу исключаем из будущих рассылок
+        await conn.executemany('UPDATE users SET blocked_at = ? WHERE user_id = ? AND blocked_at IS NULL', blocked)
+
+async def get_pending_deliveries(broadcast_id, after_user_id=0, limit=USER_CHUNK_SIZE):
+    rows = await _fetchall(
+        'SELECT user_id FROM broadcast_deliveries '
+        'WHERE broadcast_id = ? AND status = ? AND user_id > ? ORDER BY user_id LIMIT ?',
+        (broadcast_id, DELIVERY_PENDING, after_user_id, limit),
+    )
+    return [row[0] for row in rows]
+
+async def iter_pending_deliveries(broadcast_id, chunk_size=USER_CHUNK_SIZE):
+    last_user_id = 0
+    while True:
+        batch = await get_pending_deliveries(broadcast_id, last_user_id, chunk_size)
+        if not batch:
+            return
+        yield batch
+        if len(batch) < chunk_size:
+            return
+        last_user_id = batch[-1]
+
+async def get_unfinished_broadcasts():
+    return await _fetchall('SELECT * FROM broadcasts WHERE status = ? ORDER BY id', (BROADCAST_RUNNING,))
+
+async def get_broadcast_stats(broadcast_id):
+    rows = await _fetchall(
+        'SELECT status, COUNT(*) FROM broadcast_deliveries WHERE broadcast_id = ? GROUP BY status',
+        (broadcast_id,),
+    )
+    return {row[0]: row[1] for row in rows}
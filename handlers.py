@@ -1,14 +1,49 @@
+import asyncio
+import json
+import logging
+
 from aiogram import Router, F, Bot
-from aiogram.filters import Command, CommandStart, StateFilter
-from aiogram.types import Message, CallbackQuery, ContentType, FSInputFile
+from aiogram.filters import KICKED, MEMBER, ChatMemberUpdatedFilter, Command, CommandStart
+from aiogram.types import Message, CallbackQuery, ChatMemberUpdated, ContentType, InputMediaDocument
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
 import keyboards as kb
 import database as db
+from assets import AssetRegistry
+from broadcaster import PROGRESS_INTERVAL, BroadcastEngine, BroadcastJob, SkipDelivery, is_unreachable
+from callbacks import CallbackTable
+from ratelimit import RateLimitPolicy, rate_limit
+from screens import Screen, ScreenRenderer
 from config import ADMIN_IDS
 
 router = Router()
+# Все нажатия кнопок разбираются одной таблицей, а не перебором фильтров роутера
+callbacks = CallbackTable()
+router.callback_query.register(callbacks.dispatch)
+logger = logging.getLogger(__name__)
+
+BROADCAST_SHUTDOWN_TIMEOUT = 10.0
+
+# Кому уходит обновление файла: выбирает администратор при загрузке, хранится в payload["audience"]
+FILE_AUDIENCE_ALL = "all"
+FILE_AUDIENCE_DEMO = "demo"
+
+# Демо — до двух документов по несколько мегабайт: своё окно, каждое скачивание стоит 2
+DOWNLOAD_RATE_LIMIT = RateLimitPolicy(min_interval=2.0, window=60.0, max_requests=6, cost=2, bucket="downloads")
+# Заявки и обращения пересылаются каждому администратору
+ADMIN_REQUEST_RATE_LIMIT = RateLimitPolicy(min_interval=2.0, window=300.0, max_requests=5, bucket="admin_requests")
+
+# Готовые карточки продуктов: product_key -> (строка каталога, (text, markup, photo_path))
+_product_views: dict[str, tuple[object, tuple]] = {}
+
+# Логотипы грузим в Telegram один раз, дальше шлём по file_id
+_assets = AssetRegistry()
+# Смена экранов правкой текущего сообщения вместо удаления и повторной отправки
+_screens = ScreenRenderer(_assets)
+
+# Активные фоновые рассылки по id из таблицы broadcasts
+_broadcast_jobs: dict[int, BroadcastJob] = {}
 
 SCOUT_SCOPE_DEMO_INFO = (
     "*Демоверсия* — это демонстрация продукта без полного функционала.\n\n"
@@ -103,27 +138,255 @@ async def _ensure_admin_message(message: Message, state: FSMContext | None = Non
     return False
 
 
-def get_demo_platform_text(product_key: str) -> str:
-    if product_key == "scout_scope":
-        return f"{SCOUT_SCOPE_DEMO_INFO}\n\nВыберите ОС для демоверсии:"
-    return "Выберите ОС для демоверсии:"
+async def _track_segment(callback: CallbackQuery, product_key: str, action: str, platform: str = "") -> None:
+    user = getattr(callback, "from_user", None)
+    if user:
+        await db.add_user_segment(user.id, product_key, action, platform)
 
 
-async def show_demo_platform_message(callback: CallbackQuery, text: str, markup):
-    if not callback.message:
+def _delivery_failure(exc: Exception) -> tuple[str, str | None]:
+    if isinstance(exc, SkipDelivery):
+        return db.DELIVERY_SKIPPED, None
+    status = db.DELIVERY_BLOCKED if is_unreachable(exc) else db.DELIVERY_FAILED
+    return status, type(exc).__name__
+
+
+async def _pending_batches(broadcast_id: int, batches):
+    async for batch in batches:
+        await db.add_pending_deliveries(broadcast_id, batch)
+        yield batch
+
+
+async def _resume_batches(broadcast_id: int, audience_cursor: int, audience: dict):
+    # Сначала те, кто уже в журнале, но без подтверждённой доставки, затем аудитория за курсором
+    async for batch in db.iter_pending_deliveries(broadcast_id):
+        yield batch
+    async for batch in db.iter_user_batches(after_user_id=audience_cursor, **audience):
+        yield batch
+
+
+async def _with_delivered_versions(batches, product_key: str, delivered: dict):
+    # Уже доставленные версии читаем одним запросом на пачку, а не на каждого получателя
+    async for batch in batches:
+        delivered.update(await db.get_delivered_versions(product_key, batch))
+        yield batch
+
+
+async def _run_broadcast(job: BroadcastJob, batches, send):
+    ledger = db.DeliveryLedger(job.broadcast_id)
+
+    def on_result(user_id: int, error: Exception | None):
+        if error is None:
+            ledger.record(user_id, db.DELIVERY_SENT)
+        else:
+            ledger.record(user_id, *_delivery_failure(error))
+
+    try:
+        stats = await job.engine.run(_pending_batches(job.broadcast_id, batches), send, on_result)
+    finally:
+        await ledger.close()
+    if not job.suspended:
+        status = db.BROADCAST_CANCELLED if job.engine.cancelled else db.BROADCAST_DONE
+        await db.finish_broadcast(job.broadcast_id, status)
+    return stats
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours} ч {minutes} мин"
+    if minutes:
+        return f"{minutes} мин {seconds} с"
+    return f"{seconds} с"
+
+
+def _format_broadcast_progress(job: BroadcastJob, title: str) -> str:
+    stats = job.stats
+    lines = [title, ""]
+    if job.total is not None:
+        lines.append(f"Обработано: {stats.processed} из {job.total}")
+    lines.append(f"Доставлено: {stats.sent}")
+    lines.append(f"Не доставлено: {stats.failed}")
+    if stats.skipped:
+        lines.append(f"Уже были у получателя: {stats.skipped}")
+    lines.append(f"Скорость: {job.rate():.1f} сообщ./с")
+    eta = job.eta()
+    if job.suspended:
+        lines.append("⏸ Бот перезапускается, рассылка продолжится после старта")
+    elif job.engine.paused:
+        lines.append("⏸ Рассылка на паузе")
+    elif eta is not None:
+        lines.append(f"Осталось: ~{_format_duration(eta)}")
+    return "\n".join(lines)
+
+
+async def _publish_broadcast_progress(job: BroadcastJob, bot: Bot, progress_message: Message | None, title: str,
+                                      final: bool = False):
+    if progress_message is None:
+        return
+
+    text = _format_broadcast_progress(job, title)
+    markup = None if final else kb.broadcast_progress_menu(job.broadcast_id, job.engine.paused)
+    # Одинаковый текст не отправляем: Telegram ответит "message is not modified"
+    if text == job.last_progress and not final:
         return
+    job.last_progress = text
+    await bot.edit_message_text(
+        text,
+        chat_id=progress_message.chat.id,
+        message_id=progress_message.message_id,
+        reply_markup=markup,
+    )
+
+
+async def _run_broadcast_job(job: BroadcastJob, bot: Bot, progress_message: Message | None, batches, send,
+                             title: str, finish):
+    async def publish():
+        await _publish_broadcast_progress(job, bot, progress_message, title)
 
+    reporter = asyncio.create_task(job.report_progress(publish, PROGRESS_INTERVAL))
     try:
-        # Для стабильного показа экрана демоверсии отправляем отдельное сообщение,
-        # а предыдущее (если возможно) убираем.
-        await callback.message.delete()
+        stats = await _run_broadcast(job, batches, send)
     except Exception:
-        pass
+        logger.exception("Рассылка %s прервана ошибкой", job.broadcast_id)
+        stats = job.stats
+    finally:
+        reporter.cancel()
+        _broadcast_jobs.pop(job.broadcast_id, None)
 
     try:
-        await callback.message.answer(text, reply_markup=markup, parse_mode="Markdown")
+        await _publish_broadcast_progress(job, bot, progress_message, title, final=True)
     except Exception:
         pass
+    if not job.suspended:
+        await finish(stats, job.engine.cancelled)
+
+
+def _broadcast_audience(kind: str, payload: dict) -> dict:
+    if kind == "file":
+        return _file_update_audience(payload)
+    target = payload.get("target", "all")
+    return {} if target == "all" else {"product_key": target}
+
+
+async def _launch_broadcast(bot: Bot, broadcast_id: int, kind: str, payload: dict, admin_chat: int,
+                            progress_message: Message | None, audience_cursor: int | None = None):
+    """Запускает рассылку фоновой задачей; audience_cursor задан при возобновлении после рестарта."""
+    audience = _broadcast_audience(kind, payload)
+    # Обновление файла решает, слать ли что-то получателю, до запроса к API и само ждёт лимит
+    engine = BroadcastEngine(throttle_sends=kind != "file")
+
+    if kind == "file":
+        product = await db.get_product(payload['product_key'])
+        file_desc = "приложения" if payload.get('file_type', 'app') == 'app' else "базы данных"
+        title = f"📤 Рассылка {file_desc}"
+
+        delivered = {}
+
+        async def send(user_id: int):
+            await _send_file_update(bot, user_id, payload, product, delivered.pop(user_id, None), engine.throttle)
+
+        async def finish(stats, cancelled: bool):
+            status = "Рассылка остановлена." if cancelled else "Рассылка завершена."
+            await bot.send_message(
+                admin_chat,
+                f"✅ *Готово!*\n\n"
+                f"{status}\n"
+                f"Доставлено: {stats.sent} пользователям.\n"
+                f"Уже были у получателя: {stats.skipped}.",
+                parse_mode="Markdown"
+            )
+    else:
+        notification_text = payload['text']
+        title = "📤 Отправка уведомлений"
+
+        async def send(user_id: int):
+            await bot.send_message(user_id, f"📢 {notification_text}")
+
+        async def finish(stats, cancelled: bool):
+            heading = "⛔ *Рассылка остановлена*" if cancelled else "✅ *Рассылка завершена!*"
+            await bot.send_message(
+                admin_chat,
+                f"{heading}\n\n"
+                f"Доставлено: {stats.sent}\n"
+                f"Не доставлено: {stats.failed}",
+                reply_markup=kb.admin_menu(),
+                parse_mode="Markdown"
+            )
+
+    total = await db.count_audience(**audience)
+    if audience_cursor is None:
+        batches = db.iter_user_batches(**audience)
+    else:
+        batches = _resume_batches(broadcast_id, audience_cursor, audience)
+        delivery_stats = await db.get_broadcast_stats(broadcast_id)
+        # Заблокировавшие бота уже выпали из count_audience, их не вычитаем второй раз
+        settled = sum(
+            delivery_stats.get(status, 0) for status in (db.DELIVERY_SENT, db.DELIVERY_FAILED, db.DELIVERY_SKIPPED)
+        )
+        total = max(0, total - settled)
+
+    if kind == "file":
+        batches = _with_delivered_versions(batches, payload['product_key'], delivered)
+
+    job = BroadcastJob(broadcast_id, engine, total)
+    _broadcast_jobs[broadcast_id] = job
+    job.task = asyncio.create_task(_run_broadcast_job(job, bot, progress_message, batches, send, title, finish))
+    return job
+
+
+async def resume_broadcasts(bot: Bot) -> int:
+    """Продолжает рассылки, прерванные перезапуском; уже доставленным повторно не отправляет."""
+    broadcasts = await db.get_unfinished_broadcasts()
+    for broadcast in broadcasts:
+        broadcast_id = broadcast['id']
+        admin_chat = broadcast['created_by']
+        progress_message = None
+        if admin_chat:
+            try:
+                progress_message = await bot.send_message(
+                    admin_chat,
+                    "🔄 Возобновляю рассылку после перезапуска...",
+                    reply_markup=kb.broadcast_progress_menu(broadcast_id),
+                )
+            except Exception:
+                logger.warning("Не удалось уведомить администратора %s о возобновлении рассылки", admin_chat)
+
+        payload = json.loads(broadcast['payload'])
+        logger.info("Возобновляю рассылку %s с курсора %s", broadcast_id, broadcast['audience_cursor'])
+        await _launch_broadcast(
+            bot, broadcast_id, broadcast['kind'], payload, admin_chat, progress_message,
+            audience_cursor=broadcast['audience_cursor'],
+        )
+    return len(broadcasts)
+
+
+async def shutdown_broadcasts(timeout: float = BROADCAST_SHUTDOWN_TIMEOUT) -> None:
+    """Останавливает фоновые рассылки при выключении, оставляя их незавершёнными для resume_broadcasts."""
+    jobs = list(_broadcast_jobs.values())
+    if not jobs:
+        return
+
+    for job in jobs:
+        job.suspend()
+    tasks = [job.task for job in jobs if job.task]
+    _, still_running = await asyncio.wait(tasks, timeout=timeout)
+    for task in still_running:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def get_demo_platform_text(product_key: str) -> str:
+    if product_key == "scout_scope":
+        return f"{SCOUT_SCOPE_DEMO_INFO}\n\nВыберите ОС для демоверсии:"
+    return "Выберите ОС для демоверсии:"
+
+
+async def show_demo_platform_message(callback: CallbackQuery, text: str, markup):
+    if not callback.message:
+        return
+    await _screens.show(callback.message, Screen(text, markup))
 
 
 def _escape_markdown(value: str) -> str:
@@ -195,39 +458,16 @@ def _build_admin_delete_product_text(product_key: str, product) -> tuple[str, bo
 async def _render_product_view(callback: CallbackQuery, text: str, markup, photo_path: str | None = None):
     if not callback.message:
         return
+    await _screens.show(callback.message, Screen(text, markup, photo_path))
 
-    if photo_path:
-        if callback.message.photo:
-            try:
-                await callback.message.edit_caption(
-                    caption=text,
-                    reply_markup=markup,
-                    parse_mode="Markdown",
-                )
-            except Exception:
-                await callback.message.edit_caption(caption=text, reply_markup=markup)
-            return
+@router.my_chat_member(F.chat.type == "private", ChatMemberUpdatedFilter(member_status_changed=KICKED))
+async def bot_blocked(event: ChatMemberUpdated):
+    await db.mark_user_unreachable(event.chat.id)
 
-        try:
-            await callback.message.delete()
-        except Exception:
-            pass
-
-        try:
-            await callback.message.answer_photo(
-                photo=FSInputFile(photo_path),
-                caption=text,
-                reply_markup=markup,
-                parse_mode="Markdown",
-            )
-        except Exception:
-            await callback.message.answer(text, reply_markup=markup)
-        return
-
-    try:
-        await callback.message.edit_text(text, reply_markup=markup, parse_mode="Markdown")
-    except Exception:
-        await callback.message.edit_text(text, reply_markup=markup)
+@router.my_chat_member(F.chat.type == "private", ChatMemberUpdatedFilter(member_status_changed=MEMBER))
+async def bot_unblocked(event: ChatMemberUpdated):
+    # Разблокировал бота — снова получает рассылки
+    await db.mark_user_reachable(event.chat.id)
 
 @router.message(CommandStart())
 async def cmd_start(message: Message):
@@ -235,8 +475,7 @@ async def cmd_start(message: Message):
     
     # Отправляем логотип
     try:
-        photo = FSInputFile('logo.png')
-        await message.answer_photo(
+        await _assets.send('logo.png', lambda photo: message.answer_photo(
             photo=photo,
             caption=(
                 "Приветствуем тебя в нашем боте! 🚀\n\n"
@@ -246,7 +485,7 @@ async def cmd_start(message: Message):
                 "Выбери нужный раздел в меню ниже 👇"
             ),
             reply_markup=kb.main_menu()
-        )
+        ))
     except FileNotFoundError:
         # Если файл не найден, отправляем текст без изображения
         await message.answer(
@@ -269,7 +508,7 @@ async def cmd_admin(message: Message):
 
 # --- Admin Panel ---
 
-@router.callback_query(F.data == "admin_back")
+@callbacks.route("admin_back")
 async def admin_back(callback: CallbackQuery, state: FSMContext):
     if not await _ensure_admin_callback(callback):
         return
@@ -283,7 +522,7 @@ async def admin_back(callback: CallbackQuery, state: FSMContext):
     )
     await callback.answer()
 
-@router.callback_query(F.data == "admin_upload")
+@callbacks.route("admin_upload")
 async def admin_upload_start(callback: CallbackQuery, state: FSMContext):
     if not await _ensure_admin_callback(callback):
         return
@@ -296,7 +535,7 @@ async def admin_upload_start(callback: CallbackQuery, state: FSMContext):
     )
     await callback.answer()
 
-@router.callback_query(F.data == "admin_delete_upload")
+@callbacks.route("admin_delete_upload")
 async def admin_delete_upload_start(callback: CallbackQuery, state: FSMContext):
     if not await _ensure_admin_callback(callback):
         return
@@ -311,7 +550,7 @@ async def admin_delete_upload_start(callback: CallbackQuery, state: FSMContext):
     await state.set_state(AdminStates.waiting_for_delete_product)
     await callback.answer()
 
-@router.callback_query(F.data == "admin_view_products")
+@callbacks.route("admin_view_products")
 async def admin_view_products(callback: CallbackQuery):
     if not await _ensure_admin_callback(callback):
         return
@@ -346,7 +585,7 @@ async def admin_view_products(callback: CallbackQuery):
     await callback.message.edit_text(text, reply_markup=kb.admin_menu(), parse_mode="Markdown")
     await callback.answer()
 
-@router.callback_query(F.data == "admin_send_notification")
+@callbacks.route("admin_send_notification")
 async def admin_send_notification_start(callback: CallbackQuery, state: FSMContext):
     if not await _ensure_admin_callback(callback):
         return
@@ -372,12 +611,11 @@ async def admin_notification_text_received(message: Message, state: FSMContext):
     )
     await state.set_state(AdminStates.waiting_for_notification_target)
 
-@router.callback_query(AdminStates.waiting_for_notification_target, F.data.startswith("notify_"))
-async def admin_notification_target_selected(callback: CallbackQuery, state: FSMContext):
+@callbacks.route("notify_", AdminStates.waiting_for_notification_target, fields=("target",))
+async def admin_notification_target_selected(callback: CallbackQuery, state: FSMContext, target: str):
     if not await _ensure_admin_callback(callback):
         return
 
-    target = callback.data.split("_", 1)[1]
     data = await state.get_data()
     notification_text = data['notification_text']
     
@@ -389,10 +627,12 @@ async def admin_notification_target_selected(callback: CallbackQuery, state: FSM
     )
     
     if target == "all":
-        user_count = await db.get_user_count()
+        # Тот же подсчёт, что и у рассылки: заблокировавшие бота не входят
+        user_count = await db.count_audience()
         preview_text += f"Все пользователи ({user_count} чел.)"
     else:
-        preview_text += f"Пользователи продукта {target}"
+        user_count = await db.count_audience(product_key=target)
+        preview_text += f"Пользователи продукта {target} ({user_count} чел.)"
     
     preview_text += "\n\nОтправить?"
     
@@ -400,7 +640,7 @@ async def admin_notification_target_selected(callback: CallbackQuery, state: FSM
     await callback.message.edit_text(preview_text, reply_markup=kb.confirm_broadcast_menu(), parse_mode="Markdown")
     await callback.answer()
 
-@router.callback_query(F.data == "confirm_yes", AdminStates.waiting_for_notification_target)
+@callbacks.route("confirm_yes", AdminStates.waiting_for_notification_target)
 async def admin_confirm_broadcast(callback: CallbackQuery, state: FSMContext):
     if not await _ensure_admin_callback(callback):
         return
@@ -408,30 +648,53 @@ async def admin_confirm_broadcast(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     notification_text = data['notification_text']
     
-    users = await db.get_all_users()
-    count = 0
-    failed = 0
-    
-    await callback.message.edit_text("📤 Отправка уведомлений...")
-    
-    for user_id in users:
-        try:
-            await callback.bot.send_message(user_id, f"📢 {notification_text}")
-            count += 1
-        except Exception:
-            failed += 1
-    
-    await callback.message.answer(
-        f"✅ *Рассылка завершена!*\n\n"
-        f"Доставлено: {count}\n"
-        f"Не доставлено: {failed}",
-        reply_markup=kb.admin_menu(),
-        parse_mode="Markdown"
-    )
+    target = data.get("target", "all")
+    admin_chat = callback.message.chat.id
+
+    # Рассылка идёт в фоне: FSM освобождаем сразу, прогресс правится в одном сообщении
     await state.clear()
     await callback.answer()
 
-@router.callback_query(F.data == "confirm_no")
+    payload = {"text": notification_text, "target": target}
+    broadcast_id = await db.create_broadcast("notification", payload, callback.from_user.id)
+    progress_message = await callback.message.edit_text(
+        "📤 Отправка уведомлений...",
+        reply_markup=kb.broadcast_progress_menu(broadcast_id),
+    )
+    await _launch_broadcast(callback.bot, broadcast_id, "notification", payload, admin_chat, progress_message)
+
+@callbacks.route("broadcast_", fields=("action", "broadcast_id"))
+async def admin_broadcast_control(callback: CallbackQuery, action: str, broadcast_id: str):
+    if not await _ensure_admin_callback(callback):
+        return
+
+    job = _broadcast_jobs.get(int(broadcast_id)) if broadcast_id.isdigit() else None
+    if not job:
+        await callback.answer("Рассылка уже завершена", show_alert=True)
+        return
+
+    if action == "pause":
+        job.pause()
+        await callback.answer("Рассылка на паузе")
+    elif action == "resume":
+        job.resume()
+        await callback.answer("Рассылка продолжается")
+    elif action == "cancel":
+        job.cancel()
+        await callback.answer("Останавливаю рассылку...")
+        return
+    else:
+        await callback.answer()
+        return
+
+    try:
+        await callback.message.edit_reply_markup(
+            reply_markup=kb.broadcast_progress_menu(job.broadcast_id, job.engine.paused)
+        )
+    except Exception:
+        pass
+
+@callbacks.route("confirm_no")
 async def admin_cancel_broadcast(callback: CallbackQuery, state: FSMContext):
     if not await _ensure_admin_callback(callback):
         return
@@ -443,7 +706,7 @@ async def admin_cancel_broadcast(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.answer()
 
-@router.callback_query(F.data == "admin_stats")
+@callbacks.route("admin_stats")
 async def admin_stats(callback: CallbackQuery):
     if not await _ensure_admin_callback(callback):
         return
@@ -482,12 +745,11 @@ async def admin_upload_file(message: Message, state: FSMContext):
     )
     await state.set_state(AdminStates.waiting_for_product_selection)
 
-@router.callback_query(AdminStates.waiting_for_product_selection, F.data.startswith("prod_"))
-async def admin_select_product(callback: CallbackQuery, state: FSMContext):
+@callbacks.route("prod_", AdminStates.waiting_for_product_selection, fields=("product_key",))
+async def admin_select_product(callback: CallbackQuery, state: FSMContext, product_key: str):
     if not await _ensure_admin_callback(callback):
         return
 
-    product_key = callback.data.split("_", 1)[1]
     await state.update_data(product_key=product_key)
     
     if product_key in ('scout_scope', 'crm'):
@@ -499,12 +761,11 @@ async def admin_select_product(callback: CallbackQuery, state: FSMContext):
         await state.set_state(AdminStates.waiting_for_version)
     await callback.answer()
 
-@router.callback_query(AdminStates.waiting_for_file_type, F.data.startswith("file_type_"))
-async def admin_select_file_type(callback: CallbackQuery, state: FSMContext):
+@callbacks.route("file_type_", AdminStates.waiting_for_file_type, fields=("file_type",))
+async def admin_select_file_type(callback: CallbackQuery, state: FSMContext, file_type: str):
     if not await _ensure_admin_callback(callback):
         return
 
-    file_type = callback.data.split("_", 2)[2]
     await state.update_data(file_type=file_type)
     
     if file_type == 'app':
@@ -515,12 +776,11 @@ async def admin_select_file_type(callback: CallbackQuery, state: FSMContext):
         await state.set_state(AdminStates.waiting_for_version)
     await callback.answer()
 
-@router.callback_query(AdminStates.waiting_for_delete_product, F.data.startswith("admin_del_prod_"))
-async def admin_delete_select_product(callback: CallbackQuery, state: FSMContext):
+@callbacks.route("admin_del_prod_", AdminStates.waiting_for_delete_product, fields=("product_key",))
+async def admin_delete_select_product(callback: CallbackQuery, state: FSMContext, product_key: str):
     if not await _ensure_admin_callback(callback):
         return
 
-    product_key = callback.data.split("admin_del_prod_", 1)[1]
     product = await db.get_product(product_key)
     if not product:
         await callback.answer("Продукт не найден", show_alert=True)
@@ -546,7 +806,7 @@ async def admin_delete_select_product(callback: CallbackQuery, state: FSMContext
     await state.set_state(AdminStates.waiting_for_delete_target)
     await callback.answer()
 
-@router.callback_query(AdminStates.waiting_for_delete_target, F.data == "admin_delete_back_products")
+@callbacks.route("admin_delete_back_products", AdminStates.waiting_for_delete_target)
 async def admin_delete_back_products(callback: CallbackQuery, state: FSMContext):
     if not await _ensure_admin_callback(callback):
         return
@@ -560,9 +820,10 @@ async def admin_delete_back_products(callback: CallbackQuery, state: FSMContext)
     await state.set_state(AdminStates.waiting_for_delete_product)
     await callback.answer()
 
-@router.callback_query(
-    StateFilter(AdminStates.waiting_for_delete_product, AdminStates.waiting_for_delete_target),
-    F.data == "admin_delete_cancel",
+@callbacks.route(
+    "admin_delete_cancel",
+    AdminStates.waiting_for_delete_product,
+    AdminStates.waiting_for_delete_target,
 )
 async def admin_delete_cancel(callback: CallbackQuery, state: FSMContext):
     if not await _ensure_admin_callback(callback):
@@ -575,12 +836,11 @@ async def admin_delete_cancel(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.answer()
 
-@router.callback_query(AdminStates.waiting_for_delete_target, F.data.startswith("admin_del_target_"))
-async def admin_delete_target(callback: CallbackQuery, state: FSMContext):
+@callbacks.route("admin_del_target_", AdminStates.waiting_for_delete_target, fields=("target",))
+async def admin_delete_target(callback: CallbackQuery, state: FSMContext, target: str):
     if not await _ensure_admin_callback(callback):
         return
 
-    target = callback.data.split("admin_del_target_", 1)[1]
     data = await state.get_data()
     product_key = data.get("delete_product_key")
     if not product_key:
@@ -632,12 +892,11 @@ async def admin_delete_target(callback: CallbackQuery, state: FSMContext):
 
     await callback.answer()
 
-@router.callback_query(AdminStates.waiting_for_platform, F.data.startswith("platform_"))
-async def admin_select_platform(callback: CallbackQuery, state: FSMContext):
+@callbacks.route("platform_", AdminStates.waiting_for_platform, fields=("platform",))
+async def admin_select_platform(callback: CallbackQuery, state: FSMContext, platform: str):
     if not await _ensure_admin_callback(callback):
         return
 
-    platform = callback.data.split("_", 1)[1]
     await state.update_data(platform=platform)
     platform_name = "Windows" if platform == "win" else "macOS"
     await callback.message.answer(f"Введите версию приложения для {platform_name} (например, 1.0.5):")
@@ -661,16 +920,100 @@ async def admin_set_version(message: Message, state: FSMContext):
         platform_name = "Windows" if platform == "win" else "macOS"
         platform_note = f" ({platform_name})"
     
+    # Сегменты копятся только с момента их появления: администратор видит, сколько людей в каждом варианте
+    everyone = await db.count_audience()
+    demo_users = await db.count_audience(**_file_update_audience({**data, "audience": FILE_AUDIENCE_DEMO}))
+
     await message.answer(
         f"📝 Версия {file_type_name}{platform_note}: `{version}`\n\n"
+        f"Получатели рассылки: все пользователи — {everyone}, скачавшие демо — {demo_users}.\n"
         f"Что делать дальше?",
         reply_markup=kb.upload_action_menu(),
         parse_mode="Markdown"
     )
     await state.set_state(AdminStates.waiting_for_broadcast_action)
 
-@router.callback_query(AdminStates.waiting_for_broadcast_action, F.data == "upload_broadcast")
-async def admin_broadcast_file(callback: CallbackQuery, state: FSMContext):
+def _file_update_audience(data: dict) -> dict:
+    if data.get('audience') == FILE_AUDIENCE_ALL:
+        return {}
+    # Сборку под ОС получают те, кто качал демо под эту ОС; базу данных — все, кто качал демо
+    audience = {"product_key": data['product_key'], "action": db.SEGMENT_DEMO}
+    if data.get('file_type', 'app') == 'app':
+        audience["platform"] = data.get('platform', 'win')
+    return audience
+
+def _artifact_key(file_type: str, platform: str = 'win') -> str:
+    return 'db' if file_type == 'db' else f"app_{platform}"
+
+def _already_delivered(delivered: dict, artifact: str, version) -> bool:
+    # Без номера версии не понять, тот же ли это файл, поэтому такие отправляем всегда
+    return version is not None and delivered.get(artifact) == version
+
+def _companion_document(data: dict, product) -> tuple[str, str, str, str] | None:
+    # К сборке ScoutScope и CRM прикладываем базу, к базе — сборку; возвращает (artifact, file_id, version, caption)
+    if data['product_key'] not in ('scout_scope', 'crm'):
+        return None
+    if data.get('file_type', 'app') == 'app':
+        if product['db_file_id']:
+            return 'db', product['db_file_id'], product['db_version'], f"🗄️ База данных версия: {product['db_version']}"
+    elif product['file_id']:
+        return 'app_win', product['file_id'], product['version'], f"📦 Приложение версия: {product['version']}"
+    elif product['file_id_mac']:
+        return 'app_mac', product['file_id_mac'], product['version_mac'], f"📦 Приложение версия: {product['version_mac']}"
+    return None
+
+async def _send_documents(bot: Bot, chat_id: int, documents: list[tuple[str, str]]):
+    """Отправляет файлы одним альбомом: один запрос вместо отдельного на каждый файл."""
+    if len(documents) == 1:
+        file_id, caption = documents[0]
+        await bot.send_document(chat_id, file_id, caption=caption)
+        return
+    await bot.send_media_group(
+        chat_id,
+        [InputMediaDocument(media=file_id, caption=caption) for file_id, caption in documents],
+    )
+
+async def _send_file_update(bot: Bot, user_id: int, data: dict, product, delivered: dict | None = None,
+                            throttle=None):
+    version = data['version']
+    file_type = data.get('file_type', 'app')
+    platform = data.get('platform', 'win')
+    delivered = delivered or {}
+
+    if file_type == 'app':
+        platform_name = "Windows" if platform == "win" else "macOS"
+        caption = (
+            f"🔥 Вышло обновление {product['name']}!\n\n"
+            f"📦 Приложение ({platform_name}) версия: {version}"
+        )
+    else:
+        caption = f"🔥 Обновление базы данных {product['name']}!\n\n🗄️ База данных версия: {version}"
+
+    # Файлы той же версии, что уже есть у пользователя, повторно не шлём
+    documents = []
+    artifacts = []
+    artifact = _artifact_key(file_type, platform)
+    if not _already_delivered(delivered, artifact, version):
+        documents.append((data['file_id'], caption))
+        artifacts.append((artifact, version))
+    companion = _companion_document(data, product)
+    if companion:
+        companion_artifact, companion_file_id, companion_version, companion_caption = companion
+        if not _already_delivered(delivered, companion_artifact, companion_version):
+            documents.append((companion_file_id, companion_caption))
+            artifacts.append((companion_artifact, companion_version))
+    if not documents:
+        # Отдельный итог, чтобы журнал и отчёт не считали такого получателя доставленным
+        raise SkipDelivery()
+
+    if throttle is not None:
+        await throttle(user_id)
+    await _send_documents(bot, user_id, documents)
+    for artifact, artifact_version in artifacts:
+        await db.record_artifact_delivery(user_id, data['product_key'], artifact, artifact_version)
+
+@callbacks.route("upload_broadcast_", AdminStates.waiting_for_broadcast_action, fields=("audience",))
+async def admin_broadcast_file(callback: CallbackQuery, state: FSMContext, audience: str):
     if not await _ensure_admin_callback(callback):
         return
 
@@ -690,61 +1033,29 @@ async def admin_broadcast_file(callback: CallbackQuery, state: FSMContext):
         await db.update_product_db(data['product_key'], data['file_id'], version)
         file_desc = "базы данных"
     
-    await callback.message.edit_text(f"✅ {file_desc.capitalize()} сохранено!\n📤 Начинаю рассылку...")
-    
-    # Рассылка
-    users = await db.get_all_users()
-    product = await db.get_product(data['product_key'])
-    count = 0
-    
-    for user_id in users:
-        try:
-            if file_type == 'app':
-                platform_name = "Windows" if platform == "win" else "macOS"
-                caption = (
-                    f"🔥 Вышло обновление {product['name']}!\n\n"
-                    f"📦 Приложение ({platform_name}) версия: {version}"
-                )
-                await callback.bot.send_document(user_id, data['file_id'], caption=caption)
-            else:
-                caption = f"🔥 Обновление базы данных {product['name']}!\n\n🗄️ База данных версия: {version}"
-                await callback.bot.send_document(user_id, data['file_id'], caption=caption)
-            
-            # Если это ScoutScope и есть оба файла, отправим второй
-            if data['product_key'] in ('scout_scope', 'crm'):
-                if file_type == 'app' and product['db_file_id']:
-                    try:
-                        db_caption = f"🗄️ База данных версия: {product['db_version']}"
-                        await callback.bot.send_document(user_id, product['db_file_id'], caption=db_caption)
-                    except:
-                        pass
-                elif file_type == 'db' and product['file_id']:
-                    try:
-                        app_caption = f"📦 Приложение версия: {product['version']}"
-                        await callback.bot.send_document(user_id, product['file_id'], caption=app_caption)
-                    except:
-                        pass
-                elif file_type == 'db' and product['file_id_mac']:
-                    try:
-                        app_caption = f"📦 Приложение версия: {product['version_mac']}"
-                        await callback.bot.send_document(user_id, product['file_id_mac'], caption=app_caption)
-                    except:
-                        pass
-            
-            count += 1
-        except Exception:
-            pass
-    
-    await callback.message.answer(
-        f"✅ *Готово!*\n\n"
-        f"Рассылка завершена.\n"
-        f"Доставлено: {count} пользователям.",
-        parse_mode="Markdown"
-    )
+    admin_chat = callback.message.chat.id
     await state.clear()
     await callback.answer()
 
-@router.callback_query(AdminStates.waiting_for_broadcast_action, F.data == "upload_save_only")
+    # Рассылка
+    payload = {
+        "product_key": data['product_key'],
+        "file_type": file_type,
+        "platform": platform,
+        "file_id": data['file_id'],
+        "version": version,
+        # В payload, чтобы возобновлённая после рестарта рассылка шла тем же адресатам
+        "audience": FILE_AUDIENCE_DEMO if audience == FILE_AUDIENCE_DEMO else FILE_AUDIENCE_ALL,
+    }
+    audience_note = "всем пользователям" if payload["audience"] == FILE_AUDIENCE_ALL else "скачавшим демо"
+    broadcast_id = await db.create_broadcast("file", payload, callback.from_user.id)
+    progress_message = await callback.message.edit_text(
+        f"✅ {file_desc.capitalize()} сохранено!\n📤 Начинаю рассылку {audience_note}...",
+        reply_markup=kb.broadcast_progress_menu(broadcast_id),
+    )
+    await _launch_broadcast(callback.bot, broadcast_id, "file", payload, admin_chat, progress_message)
+
+@callbacks.route("upload_save_only", AdminStates.waiting_for_broadcast_action)
 async def admin_save_only(callback: CallbackQuery, state: FSMContext):
     if not await _ensure_admin_callback(callback):
         return
@@ -774,7 +1085,7 @@ async def admin_save_only(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.answer()
 
-@router.callback_query(AdminStates.waiting_for_broadcast_action, F.data == "upload_cancel")
+@callbacks.route("upload_cancel", AdminStates.waiting_for_broadcast_action)
 async def admin_cancel_upload(callback: CallbackQuery, state: FSMContext):
     if not await _ensure_admin_callback(callback):
         return
@@ -789,24 +1100,13 @@ async def admin_cancel_upload(callback: CallbackQuery, state: FSMContext):
 async def show_shop(message: Message):
     await message.answer("Выберите продукт:", reply_markup=kb.products_menu())
 
-@router.callback_query(F.data == "back_to_shop")
+@callbacks.route("back_to_shop")
 async def back_to_shop(callback: CallbackQuery):
-    if callback.message.photo:
-        try:
-            await callback.message.delete()
-        except Exception:
-            pass
-        await callback.message.answer("Выберите продукт:", reply_markup=kb.products_menu())
-    else:
-        await callback.message.edit_text("Выберите продукт:", reply_markup=kb.products_menu())
+    await _screens.show(callback.message, Screen("Выберите продукт:", kb.products_menu(), parse_mode=None))
     await callback.answer()
 
 
-async def _show_product(callback: CallbackQuery, product_key: str) -> bool:
-    product = await db.get_product(product_key)
-    if not product:
-        return False
-
+def _build_product_view(product_key: str, product) -> tuple[str, object, str | None]:
     text = _build_product_text(product_key, product)
     markup = None
     photo_path = None
@@ -822,11 +1122,43 @@ async def _show_product(callback: CallbackQuery, product_key: str) -> bool:
     elif product_key == "cis_bot":
         markup = kb.cis_bot_menu()
 
+    return text, markup, photo_path
+
+
+def _product_view(product_key: str, product) -> tuple[str, object, str | None]:
+    cached = _product_views.get(product_key)
+    # Строка каталога не меняется до его перезагрузки, поэтому обычно хватает сравнения по ссылке;
+    # после перезагрузки пересобираем только продукты, чьи строки действительно изменились
+    if cached is not None:
+        cached_product, view = cached
+        if cached_product is product:
+            return view
+        if cached_product == product:
+            _product_views[product_key] = (product, view)
+            return view
+
+    view = _build_product_view(product_key, product)
+    _product_views[product_key] = (product, view)
+    return view
+
+
+async def warm_product_views() -> None:
+    """Собирает карточки всех продуктов заранее, чтобы первое открытие не тратило время на сборку."""
+    for product in await db.get_all_products():
+        _product_view(product['key'], product)
+
+
+async def _show_product(callback: CallbackQuery, product_key: str) -> bool:
+    product = await db.get_product(product_key)
+    if not product:
+        return False
+
+    text, markup, photo_path = _product_view(product_key, product)
     await _render_product_view(callback, text, markup, photo_path)
     return True
 
 
-@router.callback_query(F.data == "back_to_scout_scope")
+@callbacks.route("back_to_scout_scope")
 async def back_to_scout_scope(callback: CallbackQuery):
     is_shown = await _show_product(callback, "scout_scope")
     if is_shown:
@@ -835,41 +1167,29 @@ async def back_to_scout_scope(callback: CallbackQuery):
         await callback.answer("Продукт не найден", show_alert=True)
 
 
-@router.callback_query(F.data.startswith("prod_"))
-async def show_product(callback: CallbackQuery):
-    product_key = callback.data.split("_", 1)[1]
+@callbacks.route("prod_", fields=("product_key",))
+async def show_product(callback: CallbackQuery, product_key: str):
     is_shown = await _show_product(callback, product_key)
     if is_shown:
+        await _track_segment(callback, product_key, db.SEGMENT_VIEW)
         await callback.answer()
     else:
         await callback.answer("Продукт не найден", show_alert=True)
 
-@router.callback_query(F.data.startswith("demo_select_"))
-async def demo_select_platform(callback: CallbackQuery):
-    product_key = callback.data.split("_", 2)[2]
+@callbacks.route("demo_select_", fields=("product_key",))
+async def demo_select_platform(callback: CallbackQuery, product_key: str):
     text = get_demo_platform_text(product_key)
     markup = kb.demo_platform_menu(product_key)
     await show_demo_platform_message(callback, text, markup)
     await callback.answer()
 
-@router.callback_query(F.data == "scout_scope_instruction")
+@callbacks.route("scout_scope_instruction")
 async def show_scout_scope_instruction(callback: CallbackQuery):
-    markup = kb.scout_scope_instruction_menu()
-    if callback.message.photo:
-        await callback.message.edit_caption(
-            caption=SCOUT_SCOPE_INSTRUCTION_TEXT,
-            reply_markup=markup,
-            parse_mode="Markdown",
-        )
-    else:
-        await callback.message.edit_text(
-            SCOUT_SCOPE_INSTRUCTION_TEXT,
-            reply_markup=markup,
-            parse_mode="Markdown",
-        )
+    screen = Screen(SCOUT_SCOPE_INSTRUCTION_TEXT, kb.scout_scope_instruction_menu(), keep_photo=True)
+    await _screens.show(callback.message, screen)
     await callback.answer()
 
-@router.callback_query(F.data == "demo_scout_scope")
+@callbacks.route("demo_scout_scope")
 async def demo_select_platform_legacy(callback: CallbackQuery):
     product_key = "scout_scope"
     text = get_demo_platform_text(product_key)
@@ -877,10 +1197,9 @@ async def demo_select_platform_legacy(callback: CallbackQuery):
     await show_demo_platform_message(callback, text, markup)
     await callback.answer()
 
-@router.callback_query(F.data.startswith("demo_download_"))
-async def send_demo(callback: CallbackQuery):
-    payload = callback.data[len("demo_download_"):]
-    product_key, platform = payload.rsplit("_", 1)
+@callbacks.route("demo_download_", fields=("product_key", "platform"))
+@rate_limit(DOWNLOAD_RATE_LIMIT)
+async def send_demo(callback: CallbackQuery, product_key: str, platform: str):
     product = await db.get_product(product_key)
     if not product:
         await callback.answer("Продукт не найден", show_alert=True)
@@ -894,19 +1213,28 @@ async def send_demo(callback: CallbackQuery):
         caption = f"📦 Демоверсия {product['name']} ({platform_name})"
         if version:
             caption += f"\nВерсия приложения: {version}"
-        await callback.message.answer_document(file_id, caption=caption)
-        
-        if product['db_file_id']:
+        documents = [(file_id, caption)]
+        artifacts = [(_artifact_key('app', platform), version)]
+
+        # Сборку отдаём всегда — её явно попросили, а базу той же версии повторно не шлём
+        user_id = callback.from_user.id
+        delivered = (await db.get_delivered_versions(product_key, [user_id])).get(user_id, {})
+        if product['db_file_id'] and not _already_delivered(delivered, 'db', product['db_version']):
             db_caption = f"🗄️ База данных для {product['name']}"
             if product['db_version']:
                 db_caption += f"\nВерсия БД: {product['db_version']}"
-            await callback.message.answer_document(product['db_file_id'], caption=db_caption)
-        
+            documents.append((product['db_file_id'], db_caption))
+            artifacts.append(('db', product['db_version']))
+
+        await _send_documents(callback.bot, callback.message.chat.id, documents)
+        for artifact, artifact_version in artifacts:
+            await db.record_artifact_delivery(user_id, product_key, artifact, artifact_version)
+        await _track_segment(callback, product_key, db.SEGMENT_DEMO, platform)
         await callback.answer()
     else:
         await callback.answer(f"Файл для {platform_name} временно недоступен", show_alert=True)
 
-@router.callback_query(F.data == "buy_scout_scope")
+@callbacks.route("buy_scout_scope")
 async def show_scout_scope_plans(callback: CallbackQuery):
     text = (
         "💎 *ScoutScope Pro*\n\n"
@@ -916,21 +1244,23 @@ async def show_scout_scope_plans(callback: CallbackQuery):
         "• *Стандарт* — полный функционал, 5000 рублей, обновление базы раз в 12 часов.\n"
         "• *Премиум* — 7000 рублей, обновление базы раз в 12 часов."
     )
-    markup = kb.scout_scope_pro_plans_menu()
-    if callback.message.photo:
-        await callback.message.edit_caption(caption=text, reply_markup=markup, parse_mode="Markdown")
-    else:
-        await callback.message.edit_text(text, reply_markup=markup, parse_mode="Markdown")
+    await _screens.show(callback.message, Screen(text, kb.scout_scope_pro_plans_menu(), keep_photo=True))
     await callback.answer()
 
-@router.callback_query(F.data.startswith("plan_scout_scope_"))
-async def scout_scope_plan_request(callback: CallbackQuery, bot: Bot):
-    plan_key = callback.data.split("plan_scout_scope_", 1)[1]
+@callbacks.route("plan_scout_scope_", fields=("plan_key",))
+@rate_limit(ADMIN_REQUEST_RATE_LIMIT)
+async def scout_scope_plan_request(callback: CallbackQuery, bot: Bot, plan_key: str):
     plan = SCOUT_SCOPE_PLANS.get(plan_key)
     if not plan:
         await callback.answer("Тариф не найден", show_alert=True)
         return
 
+    # Подтверждение сразу: рассылка администраторам дольше, чем ждёт CallbackAnswerMiddleware
+    await callback.answer(
+        "Заявка отправлена администратору! 🚀\nАдминистратор скоро свяжется с вами.",
+        show_alert=True,
+    )
+    await _track_segment(callback, "scout_scope", db.SEGMENT_BUY)
     user = callback.from_user
     safe_name = _escape_markdown(user.full_name or "не указано")
     safe_username = _escape_markdown(f"@{user.username}" if user.username else "не указан")
@@ -949,16 +1279,17 @@ async def scout_scope_plan_request(callback: CallbackQuery, bot: Bot):
         except:
             pass
 
+@callbacks.route("buy_", fields=("product_key",))
+@rate_limit(ADMIN_REQUEST_RATE_LIMIT)
+async def buy_request(callback: CallbackQuery, bot: Bot, product_key: str):
+    if product_key == "scout_scope":
+        return
+    # Подтверждение сразу: рассылка администраторам дольше, чем ждёт CallbackAnswerMiddleware
     await callback.answer(
         "Заявка отправлена администратору! 🚀\nАдминистратор скоро свяжется с вами.",
         show_alert=True,
     )
-
-@router.callback_query(F.data.startswith("buy_"))
-async def buy_request(callback: CallbackQuery, bot: Bot):
-    product_key = callback.data.split("_", 1)[1]
-    if product_key == "scout_scope":
-        return
+    await _track_segment(callback, product_key, db.SEGMENT_BUY)
     user = callback.from_user
     safe_name = _escape_markdown(user.full_name or "не указано")
     safe_username = _escape_markdown(f"@{user.username}" if user.username else "не указан")
@@ -976,11 +1307,6 @@ async def buy_request(callback: CallbackQuery, bot: Bot):
             )
         except:
             pass
-            
-    await callback.answer(
-        "Заявка отправлена администратору! 🚀\nАдминистратор скоро свяжется с вами.",
-        show_alert=True,
-    )
 
 # --- Social Networks ---
 @router.message(F.text == "Соц.Сети 🌐")
@@ -1003,6 +1329,7 @@ async def support_start(message: Message, state: FSMContext):
     )
 
 @router.message(SupportStates.waiting_for_request, F.text)
+@rate_limit(ADMIN_REQUEST_RATE_LIMIT)
 async def support_submit(message: Message, state: FSMContext, bot: Bot):
     request_text = message.text.strip()
     if not request_text:
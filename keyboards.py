@@ -1,21 +1,65 @@
+from functools import cache, lru_cache
+
+from pydantic import ConfigDict
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+from callbacks import pack
+
+# Клавиатуры собираются один раз и отдаются всем одним и тем же объектом,
+# поэтому разметка заморожена целиком: ряды — кортежи, кнопки — замороженные модели.
+# Изменить общий экземпляр нельзя, только собрать новый.
+
+
+class FrozenInlineKeyboardButton(InlineKeyboardButton):
+    model_config = ConfigDict(frozen=True)
+
+
+class FrozenKeyboardButton(KeyboardButton):
+    model_config = ConfigDict(frozen=True)
+
+
+class FrozenInlineKeyboardMarkup(InlineKeyboardMarkup):
+    model_config = ConfigDict(frozen=True)
+
+    inline_keyboard: tuple[tuple[FrozenInlineKeyboardButton, ...], ...]
+
+
+class FrozenReplyKeyboardMarkup(ReplyKeyboardMarkup):
+    model_config = ConfigDict(frozen=True)
+
+    keyboard: tuple[tuple[FrozenKeyboardButton, ...], ...]
+
+
+def _freeze_rows(rows, button_type):
+    return tuple(
+        tuple(button_type.model_validate(button.model_dump(exclude_unset=True)) for button in row)
+        for row in rows
+    )
+
+
+def _frozen(builder: InlineKeyboardBuilder) -> FrozenInlineKeyboardMarkup:
+    return FrozenInlineKeyboardMarkup(inline_keyboard=_freeze_rows(builder.export(), FrozenInlineKeyboardButton))
+
+
+@cache
 def main_menu():
     kb = [
         [KeyboardButton(text="Магазин 🛍️"), KeyboardButton(text="Отзывы 💡")],
         [KeyboardButton(text="Соц.Сети 🌐"), KeyboardButton(text="Поддержка 👩‍💻")]
     ]
-    return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True)
+    return FrozenReplyKeyboardMarkup(keyboard=_freeze_rows(kb, FrozenKeyboardButton), resize_keyboard=True)
 
+@cache
 def products_menu():
     builder = InlineKeyboardBuilder()
     builder.button(text="ScoutScope", callback_data="prod_scout_scope")
     builder.button(text="PerformanceCoach CRM", callback_data="prod_crm")
     builder.button(text="CIS FINDER BOT", callback_data="prod_cis_bot")
     builder.adjust(1)
-    return builder.as_markup()
+    return _frozen(builder)
 
+@cache
 def scout_scope_menu(has_file=False):
     builder = InlineKeyboardBuilder()
     if has_file:
@@ -24,14 +68,16 @@ def scout_scope_menu(has_file=False):
     builder.button(text="Инструкция 📘", callback_data="scout_scope_instruction")
     builder.button(text="Назад 🔙", callback_data="back_to_shop")
     builder.adjust(1)
-    return builder.as_markup()
+    return _frozen(builder)
 
+@cache
 def scout_scope_instruction_menu():
     builder = InlineKeyboardBuilder()
     builder.button(text="Назад к ScoutScope 🔙", callback_data="back_to_scout_scope")
     builder.adjust(1)
-    return builder.as_markup()
+    return _frozen(builder)
 
+@cache
 def scout_scope_pro_plans_menu():
     builder = InlineKeyboardBuilder()
     builder.button(text="Минимум — 1500 рублей", callback_data="plan_scout_scope_minimum", style="success")
@@ -40,8 +86,9 @@ def scout_scope_pro_plans_menu():
     builder.button(text="Премиум — 7000 рублей", callback_data="plan_scout_scope_3m", style="danger")
     builder.button(text="Назад 🔙", callback_data="back_to_scout_scope")
     builder.adjust(1)
-    return builder.as_markup()
+    return _frozen(builder)
 
+@cache
 def crm_menu(has_file=False):
     builder = InlineKeyboardBuilder()
     if has_file:
@@ -49,38 +96,43 @@ def crm_menu(has_file=False):
     builder.button(text="Pro Версия 🌟", callback_data="buy_crm", style="primary")
     builder.button(text="Назад 🔙", callback_data="back_to_shop")
     builder.adjust(1)
-    return builder.as_markup()
+    return _frozen(builder)
 
+@cache
 def cis_bot_menu():
     builder = InlineKeyboardBuilder()
     builder.button(text="Перейти к боту 🤖", url="https://t.me/Cisfinderofficial_bot")
     builder.button(text="Назад 🔙", callback_data="back_to_shop")
     builder.adjust(1)
-    return builder.as_markup()
+    return _frozen(builder)
 
+@cache
 def file_type_menu():
     builder = InlineKeyboardBuilder()
     builder.button(text="📦 Приложение", callback_data="file_type_app")
     builder.button(text="🗄️ База данных", callback_data="file_type_db")
     builder.adjust(1)
-    return builder.as_markup()
+    return _frozen(builder)
 
+@cache
 def platform_menu():
     builder = InlineKeyboardBuilder()
     builder.button(text="Windows", callback_data="platform_win")
     builder.button(text="macOS", callback_data="platform_mac")
     builder.adjust(2)
-    return builder.as_markup()
+    return _frozen(builder)
 
+@cache
 def demo_platform_menu(product_key: str):
     builder = InlineKeyboardBuilder()
-    builder.button(text="Windows", callback_data=f"demo_download_{product_key}_win")
-    builder.button(text="macOS", callback_data=f"demo_download_{product_key}_mac")
-    back_callback = "back_to_scout_scope" if product_key == "scout_scope" else f"prod_{product_key}"
+    builder.button(text="Windows", callback_data=pack("demo_download_", product_key, "win"))
+    builder.button(text="macOS", callback_data=pack("demo_download_", product_key, "mac"))
+    back_callback = "back_to_scout_scope" if product_key == "scout_scope" else pack("prod_", product_key)
     builder.button(text="Назад 🔙", callback_data=back_callback)
     builder.adjust(2)
-    return builder.as_markup()
+    return _frozen(builder)
 
+@cache
 def admin_menu():
     builder = InlineKeyboardBuilder()
     builder.button(text="📦 Загрузить файлы", callback_data="admin_upload")
@@ -89,8 +141,9 @@ def admin_menu():
     builder.button(text="📢 Отправить уведомление", callback_data="admin_send_notification")
     builder.button(text="📈 Статистика", callback_data="admin_stats")
     builder.adjust(1)
-    return builder.as_markup()
+    return _frozen(builder)
 
+@cache
 def admin_delete_products_menu():
     builder = InlineKeyboardBuilder()
     builder.button(text="ScoutScope", callback_data="admin_del_prod_scout_scope")
@@ -98,35 +151,48 @@ def admin_delete_products_menu():
     builder.button(text="CIS FINDER BOT", callback_data="admin_del_prod_cis_bot")
     builder.button(text="🔙 Назад", callback_data="admin_back")
     builder.adjust(1)
-    return builder.as_markup()
+    return _frozen(builder)
 
 def admin_delete_targets_menu(product_key: str, product):
+    # Строку продукта сводим к набору флагов: по нему и кэшируем
+    return _admin_delete_targets_menu(
+        product_key,
+        bool(product["file_id"] or product["version"]),
+        bool(product["file_id_mac"] or product["version_mac"]),
+        bool(product["db_file_id"] or product["db_version"]),
+    )
+
+@cache
+def _admin_delete_targets_menu(product_key: str, has_app: bool, has_app_mac: bool, has_db: bool):
     builder = InlineKeyboardBuilder()
 
     if product_key in ("scout_scope", "crm"):
-        if product["file_id"] or product["version"]:
+        if has_app:
             builder.button(text="🗑️ Приложение Windows", callback_data="admin_del_target_app_win")
-        if product["file_id_mac"] or product["version_mac"]:
+        if has_app_mac:
             builder.button(text="🗑️ Приложение macOS", callback_data="admin_del_target_app_mac")
-        if product["db_file_id"] or product["db_version"]:
+        if has_db:
             builder.button(text="🗑️ База данных", callback_data="admin_del_target_db")
     else:
-        if product["file_id"] or product["version"]:
+        if has_app:
             builder.button(text="🗑️ Приложение", callback_data="admin_del_target_app_win")
 
     builder.button(text="🔙 К продуктам", callback_data="admin_delete_back_products")
     builder.button(text="❌ Отмена", callback_data="admin_delete_cancel")
     builder.adjust(1)
-    return builder.as_markup()
+    return _frozen(builder)
 
+@cache
 def upload_action_menu():
     builder = InlineKeyboardBuilder()
-    builder.button(text="✅ Сохранить и разослать", callback_data="upload_broadcast")
+    builder.button(text="📢 Сохранить и разослать всем", callback_data=pack("upload_broadcast_", "all"))
+    builder.button(text="🎯 Сохранить и разослать скачавшим демо", callback_data=pack("upload_broadcast_", "demo"))
     builder.button(text="💾 Только сохранить", callback_data="upload_save_only")
     builder.button(text="❌ Отменить", callback_data="upload_cancel")
     builder.adjust(1)
-    return builder.as_markup()
+    return _frozen(builder)
 
+@cache
 def notification_products_menu():
     builder = InlineKeyboardBuilder()
     builder.button(text="ScoutScope", callback_data="notify_scout_scope")
@@ -135,19 +201,54 @@ def notification_products_menu():
     builder.button(text="📢 Всем пользователям", callback_data="notify_all")
     builder.button(text="🔙 Назад", callback_data="admin_back")
     builder.adjust(1)
-    return builder.as_markup()
+    return _frozen(builder)
 
+@cache
 def confirm_broadcast_menu():
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ Да, отправить", callback_data="confirm_yes")
     builder.button(text="❌ Отменить", callback_data="confirm_no")
     builder.adjust(2)
-    return builder.as_markup()
+    return _frozen(builder)
+
+# id рассылок не ограничены, поэтому кэш небольшой: нужны лишь меню идущих сейчас рассылок
+@lru_cache(maxsize=64)
+def broadcast_progress_menu(broadcast_id: int, paused: bool = False):
+    builder = InlineKeyboardBuilder()
+    if paused:
+        builder.button(text="▶️ Продолжить", callback_data=pack("broadcast_", "resume", broadcast_id))
+    else:
+        builder.button(text="⏸ Пауза", callback_data=pack("broadcast_", "pause", broadcast_id))
+    builder.button(text="⛔ Остановить", callback_data=pack("broadcast_", "cancel", broadcast_id))
+    builder.adjust(2)
+    return _frozen(builder)
 
+@cache
 def social_networks_menu():
     builder = InlineKeyboardBuilder()
     builder.button(text="Telegram 📱", url="https://t.me/tw1zz_project")
     builder.button(text="Сайт 🌐", url="https://twizz-project.ru/")
     builder.button(text="VK 💬", url="https://vk.com/tw1zz_manager")
     builder.adjust(1)
-    return builder.as_markup()
+    return _frozen(builder)
+
+
+STATIC_MENUS = (
+    main_menu,
+    products_menu,
+    scout_scope_instruction_menu,
+    scout_scope_pro_plans_menu,
+    cis_bot_menu,
+    file_type_menu,
+    platform_menu,
+    admin_menu,
+    admin_delete_products_menu,
+    upload_action_menu,
+    notification_products_menu,
+    confirm_broadcast_menu,
+    social_networks_menu,
+)
+
+# Статичные меню собираем при импорте, чтобы первый пользователь не платил за сборку
+for _menu in STATIC_MENUS:
+    _menu()
@@ -1,33 +1,71 @@
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher
-from config import BOT_TOKEN
+from config import ADMIN_IDS, BOT_TOKEN, METRICS_PORT, RATE_LIMIT_DB
 import database as db
-from handlers import router
-from middlewares import RateLimitMiddleware
+from handlers import callbacks, resume_broadcasts, router, shutdown_broadcasts, warm_product_views
+from metrics import Metrics, start_metrics_server
+from middlewares import CallbackAnswerMiddleware, MetricsMiddleware, RateLimitMiddleware
+from ratelimit import SqliteRateLimitBackend
 
 async def main():
     logging.basicConfig(level=logging.INFO)
     
     # Initialize DB
+    await db.connect()
     await db.create_tables()
+    await db.load_catalog()
+    await warm_product_views()
     
     if not BOT_TOKEN:
         print("Ошибка: Токен бота не найден. Проверьте .env файл.")
+        await db.close()
         return
 
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher()
-    dp.include_router(router)
-    rate_limiter = RateLimitMiddleware()
-    dp.message.middleware(rate_limiter)
-    dp.callback_query.middleware(rate_limiter)
-
-    print("Бот запущен...")
     try:
-        await dp.start_polling(bot)
+        bot = Bot(token=BOT_TOKEN)
+        dp = Dispatcher()
+        dp.include_router(router)
+        # Внутренняя, а не outer middleware: только после фильтров известно имя обработчика.
+        # Первой среди внутренних: в замер задержки попадают и остальные middleware
+        metrics = Metrics()
+        metrics_middleware = MetricsMiddleware(metrics, callbacks)
+        dp.message.middleware(metrics_middleware)
+        dp.callback_query.middleware(metrics_middleware)
+        rate_limit_backend = None
+        if RATE_LIMIT_DB:
+            rate_limit_backend = SqliteRateLimitBackend(RATE_LIMIT_DB)
+            await rate_limit_backend.open()
+        # Администраторы не ограничиваются; дорогие кнопки считаются по политикам своих маршрутов
+        rate_limiter = RateLimitMiddleware(backend=rate_limit_backend, exempt=ADMIN_IDS, callbacks=callbacks)
+        dp.message.middleware(rate_limiter)
+        dp.callback_query.middleware(rate_limiter)
+        # После лимитера: отброшенные им нажатия он отвечает сам
+        dp.callback_query.middleware(CallbackAnswerMiddleware())
+
+        # Рассылки, прерванные прошлым выключением, продолжаются с сохранённого места
+        await resume_broadcasts(bot)
+
+        metrics_runner = None
+        if METRICS_PORT:
+            try:
+                metrics_runner = await start_metrics_server(metrics, METRICS_PORT)
+            except OSError:
+                logging.exception("Не удалось открыть порт %s для метрик", METRICS_PORT)
+
+        print("Бот запущен...")
+        try:
+            await dp.start_polling(bot)
+        finally:
+            if metrics_runner:
+                await metrics_runner.cleanup()
+            await shutdown_broadcasts()
+            await rate_limiter.backend.close()
+            await bot.session.close()
     finally:
-        await bot.session.close()
+        # Отдельно от остальной остановки: буферы /start, сегментов и артефактов сбрасываются,
+        # даже если закрытие чего-то выше упало
+        await db.close()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,125 @@
+import logging
+from bisect import bisect_left
+
+from aiohttp import web
+
+# Границы корзин гистограммы задержек, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_HOST = "127.0.0.1"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+logger = logging.getLogger(__name__)
+
+
+class _Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self, size: int) -> None:
+        # Последняя ячейка — +Inf; накопительные суммы считаются только при выдаче
+        self.counts = [0] * (size + 1)
+        self.total = 0.0
+        self.count = 0
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_float(value: float) -> str:
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+class Metrics:
+    """Счётчики и гистограммы обработчиков в памяти процесса.
+
+    Пишет только цикл событий, поэтому обычные dict и int без блокировок: запись — пара
+    операций со словарём, вся работа по форматированию — в render() при запросе /metrics.
+    """
+
+    _HANDLER_LABELS = ("event", "handler")
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self._updates: dict[tuple[str, str], int] = {}
+        self._errors: dict[tuple[str, str, str], int] = {}
+        self._throttled: dict[tuple[str, str, str], int] = {}
+        self._latency: dict[tuple[str, str], _Histogram] = {}
+
+    def observe(self, event: str, handler: str, seconds: float) -> None:
+        key = (event, handler)
+        self._updates[key] = self._updates.get(key, 0) + 1
+        histogram = self._latency.get(key)
+        if histogram is None:
+            histogram = self._latency[key] = _Histogram(len(self.buckets))
+        histogram.counts[bisect_left(self.buckets, seconds)] += 1
+        histogram.total += seconds
+        histogram.count += 1
+
+    def error(self, event: str, handler: str, exception: BaseException) -> None:
+        key = (event, handler, type(exception).__name__)
+        self._errors[key] = self._errors.get(key, 0) + 1
+
+    def throttle(self, event: str, handler: str, bucket: str) -> None:
+        key = (event, handler, bucket)
+        self._throttled[key] = self._throttled.get(key, 0) + 1
+
+    def _render_counter(self, lines: list[str], name: str, help_text: str, labels: tuple[str, ...], values: dict):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for key, value in sorted(values.items()):
+            lines.append(f"{name}{_labels(labels, key)} {value}")
+
+    def render(self) -> str:
+        """Текущее состояние в текстовом формате Prometheus."""
+        lines: list[str] = []
+        self._render_counter(
+            lines, "bot_updates_total", "Updates that reached a handler.", self._HANDLER_LABELS, self._updates
+        )
+        self._render_counter(
+            lines, "bot_handler_errors_total", "Exceptions raised by handlers.",
+            self._HANDLER_LABELS + ("exception",), self._errors,
+        )
+        self._render_counter(
+            lines, "bot_throttled_total", "Updates dropped by the rate limiter.",
+            self._HANDLER_LABELS + ("bucket",), self._throttled,
+        )
+
+        name = "bot_handler_latency_seconds"
+        lines.append(f"# HELP {name} Time spent handling an update, including middlewares.")
+        lines.append(f"# TYPE {name} histogram")
+        bounds = self.buckets + (float("inf"),)
+        for key, histogram in sorted(self._latency.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                le = f'le="{_format_float(bound)}"'
+                lines.append(f"{name}_bucket{_labels(self._HANDLER_LABELS, key, le)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(self._HANDLER_LABELS, key)} {_format_float(histogram.total)}")
+            lines.append(f"{name}_count{_labels(self._HANDLER_LABELS, key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+async def start_metrics_server(metrics: Metrics, port: int, host: str = METRICS_HOST) -> web.AppRunner:
+    """Поднимает GET /metrics; вызывающий останавливает его через runner.cleanup()."""
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(body=metrics.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except BaseException:
+        await runner.cleanup()
+        raise
+    logger.info("Метрики доступны на http://%s:%s/metrics", host, port)
+    return runner
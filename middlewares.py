@@ -1,83 +1,94 @@
-from collections import deque
-from time import monotonic
+import asyncio
+import logging
+from time import perf_counter
+from typing import Iterable
 
+from pydantic import PrivateAttr
 from aiogram.dispatcher.middlewares.base import BaseMiddleware
 from aiogram.types import CallbackQuery, Message
 
+from callbacks import CallbackTable
+from metrics import Metrics
+from ratelimit import (
+    HIT_ALLOWED,
+    HIT_WARN,
+    RATE_LIMIT_ATTR,
+    RATE_LIMIT_EVICT_BATCH,
+    RATE_LIMIT_GCRA,
+    RATE_LIMIT_WINDOW,
+    MemoryRateLimitBackend,
+    RateLimitBackend,
+    RateLimitPolicy,
+)
+
+# Сколько обработчик может думать, прежде чем кнопку "отпустят" пустым ответом
+CALLBACK_ANSWER_DELAY = 0.05
+# Метка в метриках для нажатий, у которых в CallbackTable нет маршрута
+UNHANDLED_LABEL = "unhandled"
+
+logger = logging.getLogger(__name__)
+
 
 class RateLimitMiddleware(BaseMiddleware):
+    """Лимит запросов на пользователя.
+
+    Параметры конструктора задают общую политику. Обработчик, помеченный rate_limit(...),
+    считается по своей: со своей ценой и, если указан bucket, отдельным счётчиком. Для
+    callback'ов политика берётся у маршрута CallbackTable, найденный маршрут передаётся
+    в dispatch, чтобы не искать его второй раз. Пользователи из exempt не ограничиваются.
+    """
+
     def __init__(
         self,
         min_interval: float = 0.6,
         window: float = 10.0,
         max_requests: int = 8,
         warn_interval: float = 5.0,
-        cleanup_interval: float = 60.0,
         idle_ttl: float | None = None,
+        evict_batch: int = RATE_LIMIT_EVICT_BATCH,
+        algorithm: str = RATE_LIMIT_WINDOW,
+        backend: RateLimitBackend | None = None,
+        exempt: Iterable[int] = (),
+        callbacks: CallbackTable | None = None,
     ) -> None:
-        self.min_interval = min_interval
-        self.window = window
-        self.max_requests = max_requests
-        self.warn_interval = warn_interval
-        self.cleanup_interval = cleanup_interval
-        self.idle_ttl = idle_ttl or max(window, warn_interval, min_interval) * 12
-        self._last_ts: dict[int, float] = {}
-        self._recent: dict[int, deque] = {}
-        self._last_warn: dict[int, float] = {}
-        self._last_cleanup = 0.0
+        self.policy = RateLimitPolicy(min_interval, window, max_requests, warn_interval, idle_ttl)
+        # algorithm и evict_batch настраивают хранилище по умолчанию; у переданного они свои
+        self.backend = backend or MemoryRateLimitBackend(algorithm, evict_batch)
+        self.exempt = frozenset(exempt)
+        self.callbacks = callbacks
+
+    def _policy_for(self, event, data) -> RateLimitPolicy | None:
+        handler = getattr(data.get("handler"), "callback", None)
+        if self.callbacks is not None and isinstance(event, CallbackQuery):
+            match = self.callbacks.match_for(event, data)
+            if match is not None:
+                handler = match[0].handler
+        return getattr(handler, RATE_LIMIT_ATTR, self.policy)
 
     async def __call__(self, handler, event, data):
         user = getattr(event, "from_user", None)
-        if not user:
+        if not user or user.id in self.exempt:
             return await handler(event, data)
 
-        now = monotonic()
-        self._cleanup_inactive_users(now)
-        user_id = user.id
-
-        last = self._last_ts.get(user_id)
-        if last is not None and now - last < self.min_interval:
-            return await self._throttle(event, user_id, now)
-
-        self._last_ts[user_id] = now
-
-        dq = self._recent.setdefault(user_id, deque())
-        while dq and now - dq[0] > self.window:
-            dq.popleft()
-        dq.append(now)
-
-        if len(dq) > self.max_requests:
-            return await self._throttle(event, user_id, now)
-
-        return await handler(event, data)
-
-    def _cleanup_inactive_users(self, now: float) -> None:
-        if now - self._last_cleanup < self.cleanup_interval:
-            return
-
-        self._last_cleanup = now
-        stale_before = now - self.idle_ttl
-        all_user_ids = set(self._last_ts) | set(self._recent) | set(self._last_warn)
-
-        for user_id in all_user_ids:
-            dq = self._recent.get(user_id)
-            last_recent = dq[-1] if dq else 0.0
-            last_seen = max(
-                self._last_ts.get(user_id, 0.0),
-                self._last_warn.get(user_id, 0.0),
-                last_recent,
-            )
-            if last_seen < stale_before:
-                self._last_ts.pop(user_id, None)
-                self._recent.pop(user_id, None)
-                self._last_warn.pop(user_id, None)
-
-    async def _throttle(self, event, user_id: int, now: float):
-        last_warn = self._last_warn.get(user_id, 0)
-        if now - last_warn < self.warn_interval:
-            return
-
-        self._last_warn[user_id] = now
+        policy = self._policy_for(event, data)
+        if policy is None:
+            return await handler(event, data)
+
+        try:
+            verdict = await self.backend.hit(user.id, policy)
+        except Exception:
+            # Недоступное общее хранилище не должно останавливать бота: пропускаем без лимита
+            logger.warning("Лимитер не смог проверить запрос %s", user.id, exc_info=True)
+            verdict = HIT_ALLOWED
+
+        if verdict == HIT_ALLOWED:
+            return await handler(event, data)
+        # Для MetricsMiddleware: апдейт отброшен, и по какому счётчику
+        data["rate_limited"] = policy.bucket
+        if verdict == HIT_WARN:
+            await self._warn(event)
+
+    async def _warn(self, event):
         message = "Слишком много запросов. Попробуйте чуть позже."
 
         if isinstance(event, CallbackQuery):
@@ -90,3 +101,121 @@ class RateLimitMiddleware(BaseMiddleware):
                 await event.answer(message)
             except Exception:
                 pass
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Задержка, число апдейтов, отбросы лимитера и исключения по каждому обработчику.
+
+    Регистрируется раньше остальных middleware, чтобы их время тоже попадало в замер.
+    Это внутренняя middleware: апдейты, которые не прошли фильтры ни одного обработчика,
+    и время проверки фильтров не учитываются, зато известно, какой обработчик сработал.
+    Нажатия кнопок подписываются маршрутом CallbackTable, а не общим dispatch; нажатие
+    без маршрута считается под handler="unhandled".
+    """
+
+    def __init__(self, metrics: Metrics, callbacks: CallbackTable | None = None) -> None:
+        self.metrics = metrics
+        self.callbacks = callbacks
+
+    def _handler_name(self, event, data) -> str:
+        if self.callbacks is not None and isinstance(event, CallbackQuery):
+            match = self.callbacks.match_for(event, data)
+            return match[0].handler.__name__ if match is not None else UNHANDLED_LABEL
+        handler = getattr(data.get("handler"), "callback", None)
+        return getattr(handler, "__name__", "unknown")
+
+    async def __call__(self, handler, event, data):
+        event_type = type(event).__name__
+        name = self._handler_name(event, data)
+        started = perf_counter()
+        try:
+            result = await handler(event, data)
+        except Exception as exc:
+            self.metrics.error(event_type, name, exc)
+            self.metrics.observe(event_type, name, perf_counter() - started)
+            raise
+
+        bucket = data.get("rate_limited")
+        if bucket is not None:
+            self.metrics.throttle(event_type, name, bucket)
+        else:
+            self.metrics.observe(event_type, name, perf_counter() - started)
+        return result
+
+
+class DeferredCallbackAnswer:
+    """Единственный ответ на callback: от обработчика, если он успел, иначе пустой по таймеру."""
+
+    def __init__(self, event: CallbackQuery) -> None:
+        self._event = event
+        self._answered = False
+        self._timer: asyncio.TimerHandle | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def answered(self) -> bool:
+        return self._answered
+
+    def schedule(self, delay: float) -> None:
+        loop = asyncio.get_running_loop()
+        self._timer = loop.call_later(delay, self._answer_in_background)
+
+    def _answer_in_background(self) -> None:
+        self._task = asyncio.create_task(self.answer())
+
+    async def answer(self, text: str | None = None, show_alert: bool | None = None, **kwargs):
+        if self._answered:
+            if text or show_alert:
+                # Обработчик ответил позже delay: пользователь этого текста уже не увидит
+                logger.warning("Ответ на callback %s опоздал и не отправлен: %s", self._event.data, text)
+            return True
+        self._answered = True
+        if self._timer:
+            self._timer.cancel()
+        try:
+            return await CallbackQuery.answer(self._event, text=text, show_alert=show_alert, **kwargs)
+        except Exception:
+            logger.debug("Не удалось ответить на callback %s", self._event.id, exc_info=True)
+            return False
+
+    async def finish(self) -> None:
+        await self.answer()
+        if self._task:
+            await self._task
+
+
+class _AnsweringCallbackQuery(CallbackQuery):
+    """CallbackQuery, у которого answer() идёт через DeferredCallbackAnswer."""
+
+    _deferred: DeferredCallbackAnswer | None = PrivateAttr(default=None)
+
+    async def answer(self, text: str | None = None, show_alert: bool | None = None, **kwargs):
+        return await self._deferred.answer(text, show_alert, **kwargs)
+
+
+class CallbackAnswerMiddleware(BaseMiddleware):
+    """Останавливает "часики" на кнопке, не дожидаясь тяжёлой работы обработчика.
+
+    Обработчик по-прежнему вызывает callback.answer(...): если он сделал это за delay секунд
+    (в том числе с show_alert=True), уходит его ответ, иначе сразу уходит пустой, а поздний
+    ответ обработчика молча пропускается. Telegram принимает на callback только один ответ.
+    """
+
+    def __init__(self, delay: float = CALLBACK_ANSWER_DELAY) -> None:
+        self.delay = delay
+
+    async def __call__(self, handler, event, data):
+        if not isinstance(event, CallbackQuery):
+            return await handler(event, data)
+
+        deferred = DeferredCallbackAnswer(event)
+        # Копия без повторной валидации: меняется только поведение answer()
+        answering = _AnsweringCallbackQuery.model_construct(**dict(event)).as_(event.bot)
+        answering._deferred = deferred
+        data["callback_answer"] = deferred
+
+        deferred.schedule(self.delay)
+        try:
+            return await handler(answering, data)
+        finally:
+            await deferred.finish()
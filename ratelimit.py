@@ -0,0 +1,301 @@
+import asyncio
+import heapq
+from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import dataclass
+from itertools import repeat
+from time import monotonic, time
+
+import aiosqlite
+
+# Скользящее окно точно считает запросы за window; GCRA держит на пользователя одно число
+RATE_LIMIT_WINDOW = "window"
+RATE_LIMIT_GCRA = "gcra"
+# Сколько неактивных пользователей лимитер забывает за один апдейт
+RATE_LIMIT_EVICT_BATCH = 64
+# Общее хранилище чистится реже, но крупными пачками: отдельный DELETE на апдейт дорог
+SHARED_EVICT_BATCH = 1000
+SHARED_EVICT_INTERVAL = 1.0
+
+# Решение лимитера: пропустить, молча отбросить или отбросить с предупреждением
+HIT_ALLOWED = "allowed"
+HIT_DROPPED = "dropped"
+HIT_WARN = "warn"
+
+# Атрибут обработчика со своей политикой, см. rate_limit()
+RATE_LIMIT_ATTR = "rate_limit_policy"
+DEFAULT_BUCKET = "default"
+
+
+@dataclass(frozen=True, slots=True)
+class RateLimitPolicy:
+    min_interval: float = 0.6
+    window: float = 10.0
+    max_requests: int = 8
+    warn_interval: float = 5.0
+    idle_ttl: float | None = None
+    # Политики с одним bucket делят счётчик пользователя, с разными — считаются независимо
+    bucket: str = DEFAULT_BUCKET
+    # Сколько запросов из max_requests списывает одно срабатывание
+    cost: int = 1
+
+    def __post_init__(self) -> None:
+        if self.idle_ttl is None:
+            object.__setattr__(self, "idle_ttl", max(self.window, self.warn_interval, self.min_interval) * 12)
+
+    # GCRA: в среднем max_requests за window, подряд — не больше max_requests
+    @property
+    def emission_interval(self) -> float:
+        return self.window / self.max_requests
+
+    @property
+    def tolerance(self) -> float:
+        return self.window - self.emission_interval
+
+
+def rate_limit(policy: RateLimitPolicy | None):
+    """Свой лимит для обработчика вместо общего; None — обработчик не ограничивается."""
+
+    def decorate(handler):
+        setattr(handler, RATE_LIMIT_ATTR, policy)
+        return handler
+
+    return decorate
+
+
+class _UserState:
+    """Всё, что лимитер помнит о пользователе, в одной записи."""
+
+    __slots__ = ("last_ts", "last_warn", "expires_at")
+
+    def __init__(self) -> None:
+        self.last_ts: float | None = None
+        self.last_warn = 0.0
+        self.expires_at = 0.0
+
+
+class _WindowState(_UserState):
+    __slots__ = ("recent",)
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.recent: deque = deque()
+
+
+class _GcraState(_UserState):
+    # Theoretical arrival time: когда пользователь "расплатится" за все принятые запросы
+    __slots__ = ("tat",)
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.tat = 0.0
+
+
+def _allow_window(state: _WindowState, policy: RateLimitPolicy, now: float) -> bool:
+    dq = state.recent
+    while dq and now - dq[0] > policy.window:
+        dq.popleft()
+    if policy.cost == 1:
+        dq.append(now)
+    else:
+        dq.extend(repeat(now, policy.cost))
+    return len(dq) <= policy.max_requests
+
+
+def _allow_gcra(state: _GcraState, policy: RateLimitPolicy, now: float) -> bool:
+    # Одно число вместо очереди: запрос проходит, если "долг" не превышает допуска на всплеск
+    tat = max(state.tat, now) + policy.emission_interval * policy.cost
+    if tat - now > policy.tolerance + policy.emission_interval:
+        return False
+    state.tat = tat
+    return True
+
+
+_ENGINES = {
+    RATE_LIMIT_WINDOW: (_WindowState, _allow_window),
+    RATE_LIMIT_GCRA: (_GcraState, _allow_gcra),
+}
+
+
+def _decide(state: _UserState, policy: RateLimitPolicy, now: float, allow) -> str:
+    """Проверяет запрос и сразу учитывает его в state; общая логика всех хранилищ."""
+    state.expires_at = now + policy.idle_ttl
+    last = state.last_ts
+    if last is None or now - last >= policy.min_interval:
+        state.last_ts = now
+        if allow(state, policy, now):
+            return HIT_ALLOWED
+
+    if now - state.last_warn < policy.warn_interval:
+        return HIT_DROPPED
+    state.last_warn = now
+    return HIT_WARN
+
+
+async def _execute(conn: aiosqlite.Connection, sql: str, params: tuple = ()) -> None:
+    # Курсор закрываем сразу, чтобы он не держал блокировку файла
+    async with conn.execute(sql, params):
+        pass
+
+
+class RateLimitBackend(ABC):
+    """Где лимитер хранит состояние пользователей.
+
+    hit() проверяет запрос и учитывает его атомарно: между проверкой и записью чужой
+    запрос того же пользователя не вклинится. Счётчик заводится на пару (bucket политики,
+    пользователь). Неактивные записи удаляются пачками.
+    """
+
+    @abstractmethod
+    async def hit(self, user_id: int, policy: RateLimitPolicy) -> str:
+        """Возвращает HIT_ALLOWED, HIT_DROPPED или HIT_WARN."""
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    """Состояние в словаре процесса: быстро, но у каждого процесса бота свой лимит."""
+
+    def __init__(self, algorithm: str = RATE_LIMIT_WINDOW, evict_batch: int = RATE_LIMIT_EVICT_BATCH) -> None:
+        if algorithm not in _ENGINES:
+            raise ValueError(f"Неизвестный алгоритм лимитера: {algorithm}")
+        self.algorithm = algorithm
+        self.evict_batch = evict_batch
+        self._new_state, self._allow = _ENGINES[algorithm]
+        self._buckets: dict[str, dict[int, _UserState]] = {}
+        # Ленивая куча сроков (expires_at, user_id, bucket): по одной записи на счётчик,
+        # срок уточняется при извлечении
+        self._expiry: list[tuple[float, int, str]] = []
+
+    def __len__(self) -> int:
+        return sum(len(states) for states in self._buckets.values())
+
+    async def hit(self, user_id: int, policy: RateLimitPolicy) -> str:
+        now = monotonic()
+        self._evict_expired(now)
+
+        states = self._buckets.get(policy.bucket)
+        if states is None:
+            states = self._buckets[policy.bucket] = {}
+        state = states.get(user_id)
+        if state is None:
+            state = states[user_id] = self._new_state()
+            heapq.heappush(self._expiry, (now + policy.idle_ttl, user_id, policy.bucket))
+        return _decide(state, policy, now, self._allow)
+
+    def _evict_expired(self, now: float) -> None:
+        # Не больше evict_batch записей за апдейт: нагрузка размазана, без пауз на полном обходе
+        expiry = self._expiry
+        for _ in range(self.evict_batch):
+            if not expiry or expiry[0][0] > now:
+                return
+            _, user_id, bucket = heapq.heappop(expiry)
+            states = self._buckets[bucket]
+            state = states.get(user_id)
+            if state is None:
+                continue
+            if state.expires_at > now:
+                # Пользователь был активен после постановки в кучу — переносим срок
+                heapq.heappush(expiry, (state.expires_at, user_id, bucket))
+            else:
+                del states[user_id]
+
+
+class SqliteRateLimitBackend(RateLimitBackend):
+    """Общее состояние для нескольких процессов бота на одной машине — отдельный файл SQLite.
+
+    Только GCRA: на пользователя одна строка фиксированного размера, а не очередь отметок.
+    Время — настенные часы, monotonic() у каждого процесса свой.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        evict_batch: int = SHARED_EVICT_BATCH,
+        evict_interval: float = SHARED_EVICT_INTERVAL,
+    ) -> None:
+        self.path = path
+        self.evict_batch = evict_batch
+        self.evict_interval = evict_interval
+        self._conn: aiosqlite.Connection | None = None
+        # Одно соединение на процесс: его транзакции не должны перекрываться
+        self._lock = asyncio.Lock()
+        self._evict_at = 0.0
+
+    async def open(self) -> None:
+        if self._conn is not None:
+            return
+        # Транзакциями управляем сами: BEGIN IMMEDIATE сразу берёт блокировку на запись
+        conn = await aiosqlite.connect(self.path, isolation_level=None)
+        try:
+            for pragma in (
+                "PRAGMA journal_mode = WAL",
+                # Потерять счётчики при сбое питания не страшно, fsync на каждый апдейт — дорого
+                "PRAGMA synchronous = OFF",
+                "PRAGMA busy_timeout = 1000",
+            ):
+                await _execute(conn, pragma)
+            await _execute(conn, """
+                CREATE TABLE IF NOT EXISTS rate_limits (
+                    key TEXT PRIMARY KEY,
+                    tat REAL NOT NULL,
+                    last_ts REAL,
+                    last_warn REAL NOT NULL,
+                    expires_at REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+            await _execute(
+                conn,
+                "CREATE INDEX IF NOT EXISTS idx_rate_limits_expires ON rate_limits(expires_at)"
+            )
+        except BaseException:
+            await conn.close()
+            raise
+        self._conn = conn
+
+    async def close(self) -> None:
+        async with self._lock:
+            conn, self._conn = self._conn, None
+            if conn is not None:
+                await conn.close()
+
+    async def hit(self, user_id: int, policy: RateLimitPolicy) -> str:
+        key = f"{policy.bucket}:{user_id}"
+        async with self._lock:
+            if self._conn is None:
+                await self.open()
+            conn = self._conn
+            now = time()
+            await _execute(conn, "BEGIN IMMEDIATE")
+            try:
+                async with conn.execute(
+                    "SELECT tat, last_ts, last_warn FROM rate_limits WHERE key = ?", (key,)
+                ) as cursor:
+                    row = await cursor.fetchone()
+                state = _GcraState()
+                if row is not None:
+                    state.tat, state.last_ts, state.last_warn = row
+                verdict = _decide(state, policy, now, _allow_gcra)
+                await _execute(
+                    conn,
+                    "INSERT OR REPLACE INTO rate_limits (key, tat, last_ts, last_warn, expires_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, state.tat, state.last_ts, state.last_warn, state.expires_at),
+                )
+                if now >= self._evict_at:
+                    self._evict_at = now + self.evict_interval
+                    await self._evict_expired(conn, now)
+            except BaseException:
+                await _execute(conn, "ROLLBACK")
+                raise
+            await _execute(conn, "COMMIT")
+        return verdict
+
+    async def _evict_expired(self, conn: aiosqlite.Connection, now: float) -> None:
+        await _execute(
+            conn,
+            "DELETE FROM rate_limits WHERE key IN "
+            "(SELECT key FROM rate_limits WHERE expires_at <= ? LIMIT ?)",
+            (now, self.evict_batch),
+        )
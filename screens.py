@@ -0,0 +1,167 @@
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Awaitable, Callable
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, InputMediaPhoto, Message
+
+from assets import AssetRegistry
+
+# Сколько последних сообщений помним, чтобы не отправлять в Telegram повторно тот же экран
+SCREEN_CACHE_SIZE = 10_000
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class Screen:
+    text: str
+    markup: InlineKeyboardMarkup | None = None
+    # Путь к локальной картинке; без неё экран — обычный текст
+    photo: str | None = None
+    parse_mode: str | None = "Markdown"
+    # Текст в подпись к уже показанной картинке, если она есть (инструкция, тарифы)
+    keep_photo: bool = False
+
+
+@dataclass(frozen=True, slots=True)
+class _Rendered:
+    text: tuple[str, str | None]
+    # Клавиатуры общие и замороженные, поэтому сравниваем по объекту, а не по содержимому:
+    # равная, но собранная заново разметка даст лишний запрос, на который Telegram ответит "not modified"
+    markup: InlineKeyboardMarkup | None
+    photo: str | None
+
+    def same_as(self, other: "_Rendered | None") -> bool:
+        return (
+            other is not None
+            and self.markup is other.markup
+            and self.text == other.text
+            and self.photo == other.photo
+        )
+
+
+def _is_not_modified(error: TelegramBadRequest) -> bool:
+    return "message is not modified" in error.message.lower()
+
+
+def _is_markup_error(error: TelegramBadRequest) -> bool:
+    return "can't parse entities" in error.message.lower()
+
+
+class ScreenRenderer:
+    """Переключает экраны самым дешёвым запросом к Telegram.
+
+    Текст в текст и картинка в картинку правятся на месте (edit_text, edit_caption, edit_media,
+    а если поменялись только кнопки — edit_reply_markup). Удалять и отправлять заново приходится
+    лишь при смене вида сообщения: Telegram не превращает текст в фото и обратно.
+    Последний показанный экран каждого сообщения запоминается, повторный показ не шлёт ничего.
+    """
+
+    def __init__(self, assets: AssetRegistry, cache_size: int = SCREEN_CACHE_SIZE) -> None:
+        self._assets = assets
+        self._cache_size = cache_size
+        self._rendered: OrderedDict[tuple[int, int], _Rendered] = OrderedDict()
+
+    def _remember(self, message: Message, rendered: _Rendered) -> None:
+        key = (message.chat.id, message.message_id)
+        self._rendered[key] = rendered
+        self._rendered.move_to_end(key)
+        if len(self._rendered) > self._cache_size:
+            self._rendered.popitem(last=False)
+
+    async def _send(self, request: Callable[[str | None], Awaitable[object]], parse_mode: str | None):
+        try:
+            return await request(parse_mode)
+        except TelegramBadRequest as exc:
+            if _is_not_modified(exc):
+                return None
+            # Разметку с ошибкой показываем простым текстом, а не теряем экран
+            if parse_mode and _is_markup_error(exc):
+                return await request(None)
+            raise
+
+    async def show(self, message: Message, screen: Screen) -> Message:
+        """Показывает screen на месте message; возвращает сообщение, в котором он теперь виден."""
+        key = (message.chat.id, message.message_id)
+        previous = self._rendered.get(key)
+        has_photo = bool(message.photo)
+
+        photo = None
+        if screen.photo:
+            try:
+                photo = self._assets.content_hash(screen.photo)
+            except FileNotFoundError:
+                # Картинки нет на диске: текст ставим подписью к уже показанной картинке или обычным текстом
+                logger.warning("Картинка экрана не найдена: %s", screen.photo)
+                screen = replace(screen, photo=None, keep_photo=True)
+        if not screen.photo and screen.keep_photo and has_photo:
+            photo = previous.photo if previous else None
+        wants_photo = bool(screen.photo) or (screen.keep_photo and has_photo)
+        rendered = _Rendered((screen.text, screen.parse_mode), screen.markup, photo)
+
+        if rendered.same_as(previous) and wants_photo == has_photo:
+            return message
+
+        if wants_photo != has_photo:
+            return await self._replace(message, screen, rendered)
+
+        same_text = previous is not None and previous.text == rendered.text
+        if wants_photo and screen.photo and (previous is None or previous.photo != photo):
+            result = await self._assets.send(
+                screen.photo,
+                lambda media: self._send(
+                    lambda parse_mode: message.edit_media(
+                        InputMediaPhoto(media=media, caption=screen.text, parse_mode=parse_mode),
+                        reply_markup=screen.markup,
+                    ),
+                    screen.parse_mode,
+                ),
+            )
+        elif same_text:
+            result = await self._send(lambda _: message.edit_reply_markup(reply_markup=screen.markup), None)
+        elif wants_photo:
+            result = await self._send(
+                lambda parse_mode: message.edit_caption(
+                    caption=screen.text, reply_markup=screen.markup, parse_mode=parse_mode
+                ),
+                screen.parse_mode,
+            )
+        else:
+            result = await self._send(
+                lambda parse_mode: message.edit_text(screen.text, reply_markup=screen.markup, parse_mode=parse_mode),
+                screen.parse_mode,
+            )
+
+        self._remember(message, rendered)
+        return result if isinstance(result, Message) else message
+
+    async def _replace(self, message: Message, screen: Screen, rendered: _Rendered) -> Message:
+        try:
+            await message.delete()
+        except Exception:
+            pass
+        self._rendered.pop((message.chat.id, message.message_id), None)
+
+        sent = None
+        if screen.photo:
+            try:
+                sent = await self._assets.send(
+                    screen.photo,
+                    lambda media: self._send(
+                        lambda parse_mode: message.answer_photo(
+                            photo=media, caption=screen.text, reply_markup=screen.markup, parse_mode=parse_mode
+                        ),
+                        screen.parse_mode,
+                    ),
+                )
+            except FileNotFoundError:
+                rendered = _Rendered(rendered.text, rendered.markup, None)
+        if sent is None:
+            sent = await self._send(
+                lambda parse_mode: message.answer(screen.text, reply_markup=screen.markup, parse_mode=parse_mode),
+                screen.parse_mode,
+            )
+        self._remember(sent, rendered)
+        return sent
@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile
+
+import assets
+import database
+
+
+def _photo_message(file_id):
+    return SimpleNamespace(photo=[SimpleNamespace(file_id=f"{file_id}-small"), SimpleNamespace(file_id=file_id)])
+
+
+class AssetRegistryTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        await database.connect(os.path.join(self._tmp.name, "test.db"))
+        await database.create_tables()
+        self.path = os.path.join(self._tmp.name, "logo.png")
+        with open(self.path, "wb") as file:
+            file.write(b"image-v1")
+        self.registry = assets.AssetRegistry()
+
+    async def asyncTearDown(self):
+        await database.close()
+        self._tmp.cleanup()
+
+    async def test_file_is_uploaded_once_and_then_sent_by_id(self):
+        send = AsyncMock(return_value=_photo_message("file-1"))
+        await self.registry.send(self.path, send)
+        await self.registry.send(self.path, send)
+        # Новый экземпляр (как после перезапуска) берёт file_id из базы
+        await assets.AssetRegistry().send(self.path, send)
+
+        self.assertIsInstance(send.await_args_list[0].args[0], FSInputFile)
+        self.assertEqual([call.args[0] for call in send.await_args_list[1:]], ["file-1", "file-1"])
+
+    async def test_changed_file_is_uploaded_again(self):
+        self.registry = assets.AssetRegistry(stat_interval=0)
+        send = AsyncMock(return_value=_photo_message("file-1"))
+        await self.registry.send(self.path, send)
+        with open(self.path, "wb") as file:
+            file.write(b"image-v2-longer")
+        await self.registry.send(self.path, send)
+
+        self.assertIsInstance(send.await_args.args[0], FSInputFile)
+
+    def test_hash_is_not_rechecked_on_every_call(self):
+        digest = self.registry.content_hash(self.path)
+        with patch.object(assets.os, "stat", side_effect=AssertionError("stat")):
+            self.assertEqual(self.registry.content_hash(self.path), digest)
+
+    async def test_stale_file_id_triggers_reupload(self):
+        await database.save_asset_file_id(self.registry.content_hash(self.path), "stale")
+        send = AsyncMock(side_effect=[
+            TelegramBadRequest(None, "Bad Request: wrong file identifier/HTTP URL specified"),
+            _photo_message("file-2"),
+        ])
+
+        await self.registry.send(self.path, send)
+
+        self.assertIsInstance(send.await_args.args[0], FSInputFile)
+        self.assertEqual(await database.get_asset_file_id(self.registry.content_hash(self.path)), "file-2")
+
+    async def test_other_bad_requests_are_not_swallowed(self):
+        await database.save_asset_file_id(self.registry.content_hash(self.path), "file-1")
+        send = AsyncMock(side_effect=TelegramBadRequest(None, "Bad Request: can't parse entities"))
+
+        with self.assertRaises(TelegramBadRequest):
+            await self.registry.send(self.path, send)
+        self.assertEqual(send.await_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,466 @@
+import asyncio
+import unittest
+from time import monotonic
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+)
+
+import broadcaster
+import handlers
+
+
+async def _batches(*batches):
+    for batch in batches:
+        yield list(batch)
+
+
+class TokenBucketTests(unittest.IsolatedAsyncioTestCase):
+    async def test_acquire_waits_for_refill_after_burst(self):
+        bucket = broadcaster.TokenBucket(rate=50, capacity=5)
+        started = monotonic()
+        for _ in range(10):
+            await bucket.acquire()
+
+        # 5 токенов из запаса, ещё 5 пополняются со скоростью 50/с
+        self.assertGreaterEqual(monotonic() - started, 0.09)
+
+
+class ChatPacerTests(unittest.IsolatedAsyncioTestCase):
+    async def test_same_chat_is_spaced_and_other_chats_are_not(self):
+        pacer = broadcaster.ChatPacer(interval=0.1)
+        started = monotonic()
+        await pacer.wait(1)
+        await pacer.wait(2)
+        self.assertLess(monotonic() - started, 0.05)
+
+        await pacer.wait(1)
+        self.assertGreaterEqual(monotonic() - started, 0.09)
+
+    async def test_expired_chats_are_dropped(self):
+        pacer = broadcaster.ChatPacer(interval=0.01)
+        for chat_id in range(100):
+            await pacer.wait(chat_id)
+        await asyncio.sleep(0.02)
+        await pacer.wait(1000)
+
+        self.assertEqual(len(pacer), 1)
+
+
+class BroadcastEngineTests(unittest.IsolatedAsyncioTestCase):
+    async def test_sends_run_concurrently(self):
+        engine = broadcaster.BroadcastEngine(rate=1000, workers=8)
+        in_flight = 0
+        peak = 0
+
+        async def send(chat_id):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.05)
+            in_flight -= 1
+
+        started = monotonic()
+        stats = await engine.run(_batches(range(1, 9), range(9, 17)), send)
+
+        self.assertEqual(stats.sent, 16)
+        self.assertEqual(peak, 8)
+        self.assertLess(monotonic() - started, 0.3)
+
+    async def test_failures_are_reported(self):
+        engine = broadcaster.BroadcastEngine(rate=1000, workers=2)
+        results = {}
+
+        async def send(chat_id):
+            if chat_id % 2:
+                raise RuntimeError("boom")
+
+        stats = await engine.run(_batches([1, 2, 3, 4]), send, lambda chat_id, error: results.update({chat_id: error}))
+
+        self.assertEqual((stats.sent, stats.failed), (2, 2))
+        self.assertIsNone(results[2])
+        self.assertIsInstance(results[3], RuntimeError)
+
+
+    async def test_skipped_recipients_are_counted_separately(self):
+        engine = broadcaster.BroadcastEngine(rate=1000, workers=2)
+
+        async def send(chat_id):
+            if chat_id > 2:
+                raise broadcaster.SkipDelivery()
+
+        stats = await engine.run(_batches([1, 2, 3]), send)
+
+        self.assertEqual((stats.sent, stats.failed, stats.skipped, stats.retried), (2, 0, 1, 0))
+        self.assertEqual(stats.processed, 3)
+
+
+    async def test_send_can_skip_without_spending_rate(self):
+        engine = broadcaster.BroadcastEngine(rate=2, workers=4, throttle_sends=False)
+
+        async def send(chat_id):
+            if chat_id > 1:
+                raise broadcaster.SkipDelivery()
+            await engine.throttle(chat_id)
+
+        started = monotonic()
+        stats = await engine.run(_batches(range(1, 101)), send)
+
+        self.assertEqual((stats.sent, stats.skipped), (1, 99))
+        self.assertLess(monotonic() - started, 0.5)
+
+
+class RetryPolicyTests(unittest.TestCase):
+    def setUp(self):
+        self.policy = broadcaster.RetryPolicy(max_attempts=3, base_delay=1.0, max_delay=2.0)
+
+    def test_retry_after_uses_server_delay(self):
+        error = TelegramRetryAfter(None, "Too Many Requests", retry_after=7)
+        self.assertEqual(self.policy.delay_for(error, 1), 7.0)
+
+    def test_network_errors_back_off_with_jitter_and_give_up(self):
+        error = TelegramNetworkError(None, "timeout")
+        for attempt in (1, 2):
+            delay = self.policy.delay_for(error, attempt)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(2.0, 2 ** (attempt - 1)))
+        self.assertIsNone(self.policy.delay_for(error, 3))
+
+    def test_permanent_errors_are_not_retried(self):
+        self.assertIsNone(self.policy.delay_for(TelegramForbiddenError(None, "bot was blocked by the user"), 1))
+        self.assertIsNone(self.policy.delay_for(TelegramBadRequest(None, "Bad Request: chat not found"), 1))
+
+    def test_unreachable_classification(self):
+        self.assertTrue(broadcaster.is_unreachable(TelegramBadRequest(None, "Bad Request: chat not found")))
+        self.assertFalse(broadcaster.is_unreachable(TelegramBadRequest(None, "Bad Request: message is too long")))
+
+
+class BroadcastRetryTests(unittest.IsolatedAsyncioTestCase):
+    async def test_transient_failure_is_retried_without_blocking_fresh_sends(self):
+        policy = broadcaster.RetryPolicy(base_delay=0.05)
+        engine = broadcaster.BroadcastEngine(rate=1000, workers=1, retry_policy=policy)
+        order = []
+
+        async def send(chat_id):
+            order.append(chat_id)
+            if chat_id == 1 and order.count(1) == 1:
+                raise TelegramNetworkError(None, "connection reset")
+
+        stats = await engine.run(_batches([1, 2, 3]), send)
+
+        self.assertEqual((stats.sent, stats.failed, stats.retried), (3, 0, 1))
+        self.assertEqual(order[:3], [1, 2, 3])
+        self.assertEqual(order[3], 1)
+
+    async def test_retry_after_pauses_global_bucket(self):
+        engine = broadcaster.BroadcastEngine(rate=1000, workers=1, per_chat_interval=0)
+        calls = []
+
+        async def send(chat_id):
+            calls.append((chat_id, monotonic()))
+            if chat_id == 1 and len(calls) == 1:
+                raise TelegramRetryAfter(None, "Too Many Requests", retry_after=0.1)
+
+        started = monotonic()
+        stats = await engine.run(_batches([1, 2]), send)
+
+        self.assertEqual(stats.sent, 2)
+        # Пауза касается всех получателей, а не только того, на ком сработал flood wait
+        second_chat_sent_at = next(sent_at for chat_id, sent_at in calls if chat_id == 2)
+        self.assertGreaterEqual(second_chat_sent_at - started, 0.09)
+
+    async def test_forbidden_is_not_retried(self):
+        engine = broadcaster.BroadcastEngine(rate=1000, workers=1)
+        attempts = 0
+
+        async def send(chat_id):
+            nonlocal attempts
+            attempts += 1
+            raise TelegramForbiddenError(None, "Forbidden: bot was blocked by the user")
+
+        stats = await engine.run(_batches([1]), send)
+
+        self.assertEqual(attempts, 1)
+        self.assertEqual((stats.sent, stats.failed, stats.retried), (0, 1, 0))
+
+
+class BroadcastControlTests(unittest.IsolatedAsyncioTestCase):
+    async def test_pause_holds_new_sends_until_resume(self):
+        engine = broadcaster.BroadcastEngine(rate=1000, workers=1)
+        sent = []
+
+        async def send(chat_id):
+            sent.append(chat_id)
+
+        engine.pause()
+        run = asyncio.create_task(engine.run(_batches([1, 2]), send))
+        await asyncio.sleep(0.05)
+        self.assertEqual(sent, [])
+
+        engine.resume()
+        stats = await run
+        self.assertEqual(stats.sent, 2)
+
+    async def test_cancel_stops_after_in_flight_sends(self):
+        engine = broadcaster.BroadcastEngine(rate=1000, workers=2)
+        job = broadcaster.BroadcastJob(1, engine, total=100)
+
+        async def send(chat_id):
+            await asyncio.sleep(0.02)
+
+        run = asyncio.create_task(engine.run(_batches(range(1, 101)), send))
+        await asyncio.sleep(0.05)
+        job.cancel()
+        stats = await asyncio.wait_for(run, 1)
+
+        self.assertTrue(engine.cancelled)
+        self.assertGreater(stats.sent, 0)
+        self.assertLess(stats.sent, 100)
+
+    async def test_job_reports_rate_and_eta(self):
+        engine = broadcaster.BroadcastEngine()
+        job = broadcaster.BroadcastJob(1, engine, total=30)
+        engine.stats.sent = 10
+        job._started_at -= 2
+
+        self.assertAlmostEqual(job.rate(), 5.0, places=1)
+        self.assertAlmostEqual(job.eta(), 4.0, places=1)
+
+
+class BroadcastHandlerTests(unittest.IsolatedAsyncioTestCase):
+    async def test_preview_counts_only_reachable_users(self):
+        message = SimpleNamespace(edit_text=AsyncMock())
+        callback = SimpleNamespace(from_user=SimpleNamespace(id=7), message=message, answer=AsyncMock())
+        state = SimpleNamespace(get_data=AsyncMock(return_value={"notification_text": "hi"}), update_data=AsyncMock())
+
+        with patch.object(handlers, "ADMIN_IDS", [7]), \
+                patch.object(handlers.db, "count_audience", new=AsyncMock(return_value=3)) as count_mock, \
+                patch.object(handlers.db, "get_user_count", new=AsyncMock(return_value=5)):
+            await handlers.admin_notification_target_selected(callback, state, "all")
+
+        count_mock.assert_awaited_once_with()
+        self.assertIn("Все пользователи (3 чел.)", message.edit_text.await_args.args[0])
+
+    async def test_confirm_broadcast_returns_before_fan_out_finishes(self):
+        bot = SimpleNamespace(send_message=AsyncMock(), edit_message_text=AsyncMock())
+        message = SimpleNamespace(chat=SimpleNamespace(id=7), message_id=70)
+        message.edit_text = AsyncMock(return_value=message)
+        callback = SimpleNamespace(
+            from_user=SimpleNamespace(id=7),
+            message=message,
+            bot=bot,
+            answer=AsyncMock(),
+        )
+        state = SimpleNamespace(
+            get_data=AsyncMock(return_value={"notification_text": "hi", "target": "all"}),
+            clear=AsyncMock(),
+        )
+        release = asyncio.Event()
+
+        async def audience(**filters):
+            await release.wait()
+            yield [101, 102]
+
+        with patch.object(handlers, "ADMIN_IDS", [7]), \
+                patch.object(handlers.db, "create_broadcast", new=AsyncMock(return_value=5)), \
+                patch.object(handlers.db, "count_audience", new=AsyncMock(return_value=2)), \
+                patch.object(handlers.db, "iter_user_batches", new=audience), \
+                patch.object(handlers.db, "add_pending_deliveries", new=AsyncMock()), \
+                patch.object(handlers.db, "record_deliveries", new=AsyncMock()), \
+                patch.object(handlers.db, "finish_broadcast", new=AsyncMock()) as finish_mock:
+            await handlers.admin_confirm_broadcast(callback, state)
+
+            callback.answer.assert_awaited_once()
+            state.clear.assert_awaited_once()
+            job = handlers._broadcast_jobs[5]
+
+            release.set()
+            await asyncio.wait_for(job.task, 1)
+
+        finish_mock.assert_awaited_once_with(5, handlers.db.BROADCAST_DONE)
+        self.assertNotIn(5, handlers._broadcast_jobs)
+        recipients = [call.args[0] for call in bot.send_message.await_args_list]
+        self.assertEqual(recipients, [101, 102, 7])
+
+    async def test_interrupted_broadcast_resumes_from_checkpoint(self):
+        bot = SimpleNamespace(send_message=AsyncMock(), edit_message_text=AsyncMock())
+        broadcast = {
+            "id": 9, "kind": "notification", "payload": '{"text": "hi", "target": "all"}',
+            "created_by": 7, "audience_cursor": 3,
+        }
+        audience_filters = {}
+
+        async def pending(broadcast_id, chunk_size=1000):
+            yield [2]
+
+        async def audience(**filters):
+            audience_filters.update(filters)
+            yield [4, 5]
+
+        with patch.object(handlers.db, "get_unfinished_broadcasts", new=AsyncMock(return_value=[broadcast])), \
+                patch.object(handlers.db, "count_audience", new=AsyncMock(return_value=5)), \
+                patch.object(handlers.db, "get_broadcast_stats", new=AsyncMock(return_value={"sent": 2, "pending": 1})), \
+                patch.object(handlers.db, "iter_pending_deliveries", new=pending), \
+                patch.object(handlers.db, "iter_user_batches", new=audience), \
+                patch.object(handlers.db, "add_pending_deliveries", new=AsyncMock()), \
+                patch.object(handlers.db, "record_deliveries", new=AsyncMock()), \
+                patch.object(handlers.db, "finish_broadcast", new=AsyncMock()) as finish_mock:
+            self.assertEqual(await handlers.resume_broadcasts(bot), 1)
+            job = handlers._broadcast_jobs[9]
+            self.assertEqual(job.total, 3)
+            await asyncio.wait_for(job.task, 1)
+
+        self.assertEqual(audience_filters, {"after_user_id": 3})
+        recipients = [call.args[0] for call in bot.send_message.await_args_list]
+        self.assertEqual(recipients, [7, 2, 4, 5, 7])
+        finish_mock.assert_awaited_once_with(9, handlers.db.BROADCAST_DONE)
+
+    async def test_shutdown_leaves_broadcast_unfinished(self):
+        bot = SimpleNamespace(send_message=AsyncMock(), edit_message_text=AsyncMock())
+
+        async def audience(**filters):
+            yield list(range(1, 1001))
+
+        async def slow_send(chat_id, text):
+            await asyncio.sleep(0.01)
+
+        bot.send_message.side_effect = slow_send
+        with patch.object(handlers.db, "count_audience", new=AsyncMock(return_value=1000)), \
+                patch.object(handlers.db, "iter_user_batches", new=audience), \
+                patch.object(handlers.db, "add_pending_deliveries", new=AsyncMock()), \
+                patch.object(handlers.db, "record_deliveries", new=AsyncMock()), \
+                patch.object(handlers.db, "finish_broadcast", new=AsyncMock()) as finish_mock:
+            job = await handlers._launch_broadcast(bot, 11, "notification", {"text": "hi"}, 7, None)
+            await asyncio.sleep(0.05)
+            await handlers.shutdown_broadcasts(timeout=1)
+
+        self.assertTrue(job.task.done())
+        self.assertTrue(job.suspended)
+        self.assertLess(job.stats.sent, 1000)
+        finish_mock.assert_not_awaited()
+        self.assertNotIn(11, handlers._broadcast_jobs)
+
+
+class FileDeliveryTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.bot = SimpleNamespace(send_document=AsyncMock(), send_media_group=AsyncMock())
+        self.product = {
+            "name": "CRM", "file_id": "app-win", "version": "1.0", "file_id_mac": None, "version_mac": None,
+            "db_file_id": "db-1", "db_version": "5",
+        }
+
+    async def test_app_and_database_are_sent_as_one_album(self):
+        data = {"product_key": "crm", "file_type": "app", "platform": "win", "file_id": "app-win", "version": "1.0"}
+        with patch.object(handlers.db, "record_artifact_delivery", new=AsyncMock()):
+            await handlers._send_file_update(self.bot, 1, data, self.product)
+
+        self.bot.send_document.assert_not_awaited()
+        chat_id, media = self.bot.send_media_group.await_args.args
+        self.assertEqual(chat_id, 1)
+        self.assertEqual([item.media for item in media], ["app-win", "db-1"])
+
+    async def test_recipient_with_every_file_is_skipped(self):
+        data = {"product_key": "crm", "file_type": "app", "platform": "win", "file_id": "app-win", "version": "1.0"}
+        delivered = {"app_win": "1.0", "db": "5"}
+        throttle = AsyncMock()
+        with self.assertRaises(broadcaster.SkipDelivery):
+            await handlers._send_file_update(self.bot, 1, data, self.product, delivered, throttle)
+        throttle.assert_not_awaited()
+        self.bot.send_document.assert_not_awaited()
+        self.bot.send_media_group.assert_not_awaited()
+        self.assertEqual(handlers._delivery_failure(broadcaster.SkipDelivery()), (handlers.db.DELIVERY_SKIPPED, None))
+
+    def test_file_update_audience_follows_admin_choice(self):
+        data = {"product_key": "crm", "file_type": "app", "platform": "mac"}
+        self.assertEqual(
+            handlers._file_update_audience({**data, "audience": handlers.FILE_AUDIENCE_DEMO}),
+            {"product_key": "crm", "action": handlers.db.SEGMENT_DEMO, "platform": "mac"},
+        )
+        self.assertEqual(handlers._file_update_audience({**data, "audience": handlers.FILE_AUDIENCE_ALL}), {})
+
+    async def test_upload_menu_stores_chosen_audience_in_payload(self):
+        state_name = handlers.AdminStates.waiting_for_broadcast_action.state
+        buttons = [row[0].callback_data for row in handlers.kb.upload_action_menu().inline_keyboard[:2]]
+        data = {"product_key": "crm", "file_type": "db", "file_id": "db-2", "version": "6"}
+        state = SimpleNamespace(get_data=AsyncMock(return_value=data), clear=AsyncMock())
+        message = SimpleNamespace(chat=SimpleNamespace(id=7), edit_text=AsyncMock())
+        callback = SimpleNamespace(from_user=SimpleNamespace(id=7), message=message, bot=self.bot, answer=AsyncMock())
+
+        payloads = []
+        for button in buttons:
+            route, fields = handlers.callbacks.resolve(button, state_name)
+            self.assertIs(route.handler, handlers.admin_broadcast_file)
+            with patch.object(handlers, "ADMIN_IDS", [7]), \
+                    patch.object(handlers.db, "update_product_db", new=AsyncMock()), \
+                    patch.object(handlers.db, "create_broadcast", new=AsyncMock(return_value=1)) as create_mock, \
+                    patch.object(handlers, "_launch_broadcast", new=AsyncMock()):
+                await handlers.admin_broadcast_file(callback, state, **fields)
+            payloads.append(create_mock.await_args.args[1]["audience"])
+
+        self.assertEqual(payloads, [handlers.FILE_AUDIENCE_ALL, handlers.FILE_AUDIENCE_DEMO])
+
+    async def test_single_artifact_falls_back_to_send_document(self):
+        self.product["db_file_id"] = None
+        data = {"product_key": "crm", "file_type": "app", "platform": "win", "file_id": "app-win", "version": "1.0"}
+        throttle = AsyncMock()
+        with patch.object(handlers.db, "record_artifact_delivery", new=AsyncMock()):
+            await handlers._send_file_update(self.bot, 1, data, self.product, throttle=throttle)
+
+        throttle.assert_awaited_once_with(1)
+
+        self.bot.send_media_group.assert_not_awaited()
+        self.assertEqual(self.bot.send_document.await_args.args, (1, "app-win"))
+
+    async def test_demo_download_is_one_request(self):
+        callback = SimpleNamespace(
+            bot=self.bot,
+            from_user=SimpleNamespace(id=5),
+            message=SimpleNamespace(chat=SimpleNamespace(id=5)),
+            answer=AsyncMock(),
+        )
+        with patch.object(handlers.db, "get_product", new=AsyncMock(return_value=self.product)), \
+                patch.object(handlers.db, "get_delivered_versions", new=AsyncMock(return_value={})), \
+                patch.object(handlers.db, "record_artifact_delivery", new=AsyncMock()) as record_mock, \
+                patch.object(handlers, "_track_segment", new=AsyncMock()):
+            await handlers.send_demo(callback, "crm", "win")
+
+        self.bot.send_media_group.assert_awaited_once()
+        self.bot.send_document.assert_not_awaited()
+        self.assertEqual(
+            [call.args for call in record_mock.await_args_list],
+            [(5, "crm", "app_win", "1.0"), (5, "crm", "db", "5")],
+        )
+
+    async def test_demo_skips_database_user_already_has(self):
+        callback = SimpleNamespace(
+            bot=self.bot,
+            from_user=SimpleNamespace(id=5),
+            message=SimpleNamespace(chat=SimpleNamespace(id=5)),
+            answer=AsyncMock(),
+        )
+        with patch.object(handlers.db, "get_product", new=AsyncMock(return_value=self.product)), \
+                patch.object(handlers.db, "get_delivered_versions", new=AsyncMock(return_value={5: {"db": "5"}})), \
+                patch.object(handlers.db, "record_artifact_delivery", new=AsyncMock()), \
+                patch.object(handlers, "_track_segment", new=AsyncMock()):
+            await handlers.send_demo(callback, "crm", "win")
+
+        self.bot.send_media_group.assert_not_awaited()
+        self.assertEqual(self.bot.send_document.await_args.args, (5, "app-win"))
+
+    async def test_update_skips_companion_user_already_has(self):
+        data = {"product_key": "crm", "file_type": "app", "platform": "win", "file_id": "app-win", "version": "1.1"}
+        with patch.object(handlers.db, "record_artifact_delivery", new=AsyncMock()) as record_mock:
+            await handlers._send_file_update(self.bot, 1, data, self.product, {"db": "5", "app_win": "1.0"})
+
+        self.bot.send_media_group.assert_not_awaited()
+        self.assertEqual(self.bot.send_document.await_args.args, (1, "app-win"))
+        record_mock.assert_awaited_once_with(1, "crm", "app_win", "1.1")
+
+
+if __name__ == "__main__":
+    unittest.main()
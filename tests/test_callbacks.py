@@ -0,0 +1,61 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+from aiogram.dispatcher.event.bases import UNHANDLED
+
+import callbacks
+import handlers
+
+
+class CallbackTableTests(unittest.IsolatedAsyncioTestCase):
+    def test_exact_route_wins_over_prefix(self):
+        route, fields = handlers.callbacks.resolve("buy_scout_scope")
+        self.assertIs(route.handler, handlers.show_scout_scope_plans)
+        self.assertEqual(fields, {})
+
+        route, fields = handlers.callbacks.resolve("buy_crm")
+        self.assertIs(route.handler, handlers.buy_request)
+        self.assertEqual(fields, {"product_key": "crm"})
+
+    def test_longest_prefix_and_fields_are_resolved(self):
+        route, fields = handlers.callbacks.resolve("demo_download_scout_scope_win")
+        self.assertIs(route.handler, handlers.send_demo)
+        self.assertEqual(fields, {"product_key": "scout_scope", "platform": "win"})
+
+        route, fields = handlers.callbacks.resolve("broadcast_pause_12")
+        self.assertIs(route.handler, handlers.admin_broadcast_control)
+        self.assertEqual(fields, {"action": "pause", "broadcast_id": "12"})
+
+    def test_state_bound_route_takes_precedence(self):
+        state = handlers.AdminStates.waiting_for_product_selection.state
+        route, _ = handlers.callbacks.resolve("prod_crm", state)
+        self.assertIs(route.handler, handlers.admin_select_product)
+
+        route, _ = handlers.callbacks.resolve("prod_crm")
+        self.assertIs(route.handler, handlers.show_product)
+        self.assertIsNone(handlers.callbacks.resolve("confirm_yes"))
+
+    def test_pack_roundtrip(self):
+        data = callbacks.pack("demo_download_", "scout_scope", "mac")
+        self.assertEqual(data, "demo_download_scout_scope_mac")
+        _, fields = handlers.callbacks.resolve(data)
+        self.assertEqual(fields, {"product_key": "scout_scope", "platform": "mac"})
+
+    async def test_dispatch_passes_only_declared_arguments(self):
+        table = callbacks.CallbackTable()
+        handler = AsyncMock()
+
+        @table.route("item_", fields=("item_id",))
+        async def show_item(callback, item_id):
+            await handler(callback, item_id)
+
+        callback = SimpleNamespace(data="item_42")
+        await table.dispatch(callback, None, bot=object(), state=object())
+
+        handler.assert_awaited_once_with(callback, "42")
+        self.assertIs(await table.dispatch(SimpleNamespace(data="unknown"), None), UNHANDLED)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,320 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import database
+
+
+class DatabaseTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self._tmp.name, "test.db")
+        await database.connect(self.db_path)
+        await database.create_tables()
+
+    async def asyncTearDown(self):
+        await database.close()
+        self._tmp.cleanup()
+
+
+class ConnectionPoolTests(DatabaseTestCase):
+    async def test_database_runs_in_wal_mode(self):
+        row = await database._fetchone("PRAGMA journal_mode")
+        self.assertEqual(row[0].lower(), "wal")
+
+    async def test_readers_are_query_only(self):
+        with self.assertRaises(Exception):
+            async with database._pool.reader() as conn:
+                await conn.execute("DELETE FROM users")
+
+    async def test_failed_transaction_is_rolled_back(self):
+        with self.assertRaises(RuntimeError):
+            async with database._pool.transaction() as conn:
+                await conn.execute("INSERT INTO users (user_id) VALUES (1)")
+                raise RuntimeError("boom")
+
+        self.assertEqual(await database.get_user_count(), 0)
+
+    async def test_module_api_roundtrip(self):
+        await database.add_user(1, "alice", "Alice")
+        await database.update_product_file("crm", "file-1", "1.0")
+
+        product = await database.get_product("crm")
+        self.assertEqual(product["file_id"], "file-1")
+        self.assertEqual(product["version"], "1.0")
+        self.assertEqual([user_id async for user_id in database.iter_user_ids()], [1])
+        self.assertEqual(len(await database.get_all_products()), 3)
+
+
+class MigrationTests(DatabaseTestCase):
+    async def test_schema_version_is_recorded(self):
+        row = await database._fetchone("PRAGMA user_version")
+        self.assertEqual(row[0], database.SCHEMA_VERSION)
+
+    async def test_up_to_date_boot_does_not_write(self):
+        with patch.object(database._pool, "transaction") as transaction_mock:
+            await database.create_tables()
+
+        transaction_mock.assert_not_called()
+
+    async def test_legacy_database_is_upgraded(self):
+        await database.close()
+        legacy_path = os.path.join(self._tmp.name, "legacy.db")
+        conn = sqlite3.connect(legacy_path)
+        conn.execute("CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, full_name TEXT)")
+        conn.execute(
+            "CREATE TABLE products (key TEXT PRIMARY KEY, name TEXT, file_id TEXT, description TEXT, "
+            "version TEXT, db_file_id TEXT, db_version TEXT)"
+        )
+        conn.execute("INSERT INTO products (key, name, file_id) VALUES ('crm', 'CRM', 'legacy-file')")
+        conn.commit()
+        conn.close()
+
+        await database.connect(legacy_path)
+        await database.create_tables()
+
+        product = await database.get_product("crm")
+        self.assertEqual(product["file_id"], "legacy-file")
+        self.assertIsNone(product["file_id_mac"])
+        row = await database._fetchone("PRAGMA user_version")
+        self.assertEqual(row[0], database.SCHEMA_VERSION)
+
+
+class ProductCatalogTests(DatabaseTestCase):
+    async def test_product_reads_are_served_from_snapshot(self):
+        await database.load_catalog()
+
+        with patch.object(database._pool, "transaction") as transaction_mock:
+            with patch.object(database._pool, "reader") as reader_mock:
+                product = await database.get_product("scout_scope")
+
+        transaction_mock.assert_not_called()
+        reader_mock.assert_not_called()
+        self.assertEqual(product["name"], "ScoutScope")
+
+    async def test_updates_refresh_snapshot(self):
+        await database.load_catalog()
+
+        await database.update_product_file_mac("crm", "mac-1", "2.0")
+        product = await database.get_product("crm")
+        self.assertEqual(product["file_id_mac"], "mac-1")
+
+        await database.clear_product_file_mac("crm")
+        product = await database.get_product("crm")
+        self.assertIsNone(product["file_id_mac"])
+
+    async def test_external_writes_are_detected_via_data_version(self):
+        await database.load_catalog()
+
+        other = sqlite3.connect(self.db_path)
+        other.execute("UPDATE products SET version = '9.9' WHERE key = 'crm'")
+        other.commit()
+        other.close()
+
+        with patch.object(database._catalog, "check_interval", 0):
+            product = await database.get_product("crm")
+        self.assertEqual(product["version"], "9.9")
+
+
+class AudienceIteratorTests(DatabaseTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        for user_id in range(1, 8):
+            await database.add_user(user_id, None, f"User {user_id}")
+
+    async def test_batches_are_keyset_paginated(self):
+        batches = [batch async for batch in database.iter_user_batches(chunk_size=3)]
+        self.assertEqual(batches, [[1, 2, 3], [4, 5, 6], [7]])
+
+    async def test_filters_are_applied(self):
+        user_ids = [
+            user_id
+            async for user_id in database.iter_user_ids(chunk_size=2, after_user_id=2, exclude_user_ids=[4, 6])
+        ]
+        self.assertEqual(user_ids, [3, 5, 7])
+
+
+class UserSegmentTests(DatabaseTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        await database.add_user_segment(1, "crm", database.SEGMENT_VIEW)
+        await database.add_user_segment(2, "crm", database.SEGMENT_DEMO, "mac")
+        await database.add_user_segment(2, "crm", database.SEGMENT_VIEW)
+        await database.add_user_segment(3, "crm", database.SEGMENT_DEMO, "win")
+        await database.add_user_segment(4, "scout_scope", database.SEGMENT_BUY)
+
+    async def _audience(self, **filters):
+        return [user_id async for user_id in database.iter_user_ids(**filters)]
+
+    async def test_product_audience_is_deduplicated(self):
+        self.assertEqual(await self._audience(product_key="crm"), [1, 2, 3])
+        self.assertEqual(await database.count_audience(product_key="crm"), 3)
+
+    async def test_platform_audience(self):
+        audience = await self._audience(product_key="crm", action=database.SEGMENT_DEMO, platform="mac")
+        self.assertEqual(audience, [2])
+
+    async def test_platform_audience_uses_index(self):
+        rows = await database._fetchall(
+            "EXPLAIN QUERY PLAN SELECT DISTINCT user_id FROM user_segments "
+            "WHERE user_id > 0 AND product_key = 'crm' AND action = 'demo' AND platform = 'mac' "
+            "ORDER BY user_id LIMIT 10"
+        )
+        plan = " ".join(row[3] for row in rows)
+        self.assertIn("idx_user_segments_action", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    async def test_unreachable_users_are_skipped(self):
+        for user_id in (1, 2, 3):
+            await database.add_user(user_id, None, f"User {user_id}")
+        broadcast_id = await database.create_broadcast("notification", {"text": "hi"})
+        await database.record_deliveries(broadcast_id, [(2, database.DELIVERY_BLOCKED, "TelegramForbiddenError")])
+        await database.mark_user_unreachable(3)
+
+        self.assertEqual(await self._audience(), [1])
+        self.assertEqual(await self._audience(product_key="crm"), [1])
+        self.assertEqual(await database.count_audience(product_key="crm"), 1)
+        self.assertEqual(await self._audience(include_unreachable=True), [1, 2, 3])
+
+        await database.mark_user_reachable(2)
+        await database.add_user(3, "back", "User 3")
+        self.assertEqual(await self._audience(), [1, 2, 3])
+
+    async def test_unreachable_filter_uses_index(self):
+        rows = await database._fetchall(
+            "EXPLAIN QUERY PLAN SELECT user_id FROM users WHERE blocked_at IS NOT NULL"
+        )
+        plan = " ".join(row[3] for row in rows)
+        self.assertIn("idx_users_blocked", plan)
+
+    async def test_delivered_versions_are_tracked_per_artifact(self):
+        await database.record_artifact_delivery(1, "crm", "app_win", "1.0")
+        await database.record_artifact_delivery(1, "crm", "app_win", "1.1")
+        await database.record_artifact_delivery(1, "crm", "db", "5")
+        await database.record_artifact_delivery(2, "scout_scope", "db", "7")
+
+        delivered = await database.get_delivered_versions("crm", [1, 2, 3])
+        self.assertEqual(delivered, {1: {"app_win": "1.1", "db": "5"}})
+
+    async def test_delivered_versions_accept_more_ids_than_sqlite_variables(self):
+        await database.record_artifact_delivery(1500, "crm", "db", "5")
+
+        delivered = await database.get_delivered_versions("crm", range(1, 2001))
+        self.assertEqual(delivered, {1500: {"db": "5"}})
+
+
+class BroadcastLedgerTests(DatabaseTestCase):
+    async def test_ledger_tracks_recipient_states(self):
+        broadcast_id = await database.create_broadcast("notification", {"text": "hi"}, 42)
+        await database.add_pending_deliveries(broadcast_id, [1, 2, 3, 4])
+
+        ledger = database.DeliveryLedger(broadcast_id, batch_size=2)
+        ledger.record(1, database.DELIVERY_SENT)
+        ledger.record(2, database.DELIVERY_BLOCKED, "TelegramForbiddenError")
+        ledger.record(3, database.DELIVERY_FAILED, "TelegramNetworkError")
+        await ledger.close()
+        await database.finish_broadcast(broadcast_id)
+
+        stats = await database.get_broadcast_stats(broadcast_id)
+        self.assertEqual(
+            stats,
+            {
+                database.DELIVERY_SENT: 1,
+                database.DELIVERY_BLOCKED: 1,
+                database.DELIVERY_FAILED: 1,
+                database.DELIVERY_PENDING: 1,
+            },
+        )
+        self.assertEqual(await database.get_pending_deliveries(broadcast_id), [4])
+        broadcast = await database.get_broadcast(broadcast_id)
+        self.assertEqual(broadcast["status"], database.BROADCAST_DONE)
+
+    async def test_failed_background_flush_is_logged_and_retried(self):
+        broadcast_id = await database.create_broadcast("notification", {"text": "hi"})
+        ledger = database.DeliveryLedger(broadcast_id, batch_size=1)
+        with patch.object(database, "record_deliveries", side_effect=OSError("disk I/O error")):
+            with self.assertLogs(database.logger, "ERROR"):
+                ledger.record(1, database.DELIVERY_SENT)
+                await ledger._flush_task
+        await ledger.close()
+
+        stats = await database.get_broadcast_stats(broadcast_id)
+        self.assertEqual(stats[database.DELIVERY_SENT], 1)
+
+    async def test_pending_insert_does_not_overwrite_recorded_status(self):
+        broadcast_id = await database.create_broadcast("notification", {"text": "hi"})
+        await database.record_deliveries(broadcast_id, [(1, database.DELIVERY_SENT, None)])
+        await database.add_pending_deliveries(broadcast_id, [1, 2])
+
+        self.assertEqual(await database.get_pending_deliveries(broadcast_id), [2])
+
+    async def test_pending_batch_query_uses_index(self):
+        rows = await database._fetchall(
+            "EXPLAIN QUERY PLAN SELECT user_id FROM broadcast_deliveries "
+            "WHERE broadcast_id = 1 AND status = 'pending' AND user_id > 0 ORDER BY user_id LIMIT 10"
+        )
+        plan = " ".join(row[3] for row in rows)
+        self.assertIn("idx_broadcast_deliveries_status", plan)
+
+    async def test_checkpoint_survives_for_resume(self):
+        broadcast_id = await database.create_broadcast("notification", {"text": "hi"}, 42)
+        await database.add_pending_deliveries(broadcast_id, [3, 1, 2])
+        await database.record_deliveries(broadcast_id, [(1, database.DELIVERY_SENT, None)])
+        await database.add_pending_deliveries(broadcast_id, [5, 4])
+
+        broadcast = await database.get_broadcast(broadcast_id)
+        self.assertEqual(broadcast["audience_cursor"], 5)
+        pending = [batch async for batch in database.iter_pending_deliveries(broadcast_id, chunk_size=2)]
+        self.assertEqual(pending, [[2, 3], [4, 5]])
+        unfinished = await database.get_unfinished_broadcasts()
+        self.assertEqual([row["id"] for row in unfinished], [broadcast_id])
+
+        await database.finish_broadcast(broadcast_id)
+        self.assertEqual(await database.get_unfinished_broadcasts(), [])
+
+
+class WriteBehindBufferTests(DatabaseTestCase):
+    async def test_add_user_is_buffered_and_deduplicated(self):
+        await database.add_user(1, "old", "Old Name")
+        await database.add_user(1, "new", "New Name")
+        await database.add_user(2, None, "Bob")
+
+        self.assertEqual(len(database._users), 2)
+        await database.flush_users()
+
+        self.assertEqual(len(database._users), 0)
+        row = await database._fetchone("SELECT username, full_name FROM users WHERE user_id = 1")
+        self.assertEqual(tuple(row), ("new", "New Name"))
+
+    async def test_upsert_refreshes_changed_profile(self):
+        await database.add_user(1, "alice", "Alice")
+        await database.flush_users()
+        await database.add_user(1, "alice_2", "Alice B")
+        await database.flush_users()
+
+        row = await database._fetchone("SELECT username, full_name FROM users WHERE user_id = 1")
+        self.assertEqual(tuple(row), ("alice_2", "Alice B"))
+
+    async def test_batch_size_triggers_flush(self):
+        with patch.object(database._users, "batch_size", 2):
+            await database.add_user(1, "a", "A")
+            await database.add_user(2, "b", "B")
+            await database._users._timer
+
+        self.assertEqual(len(database._users), 0)
+        self.assertEqual(await database.get_user_count(), 2)
+
+    async def test_pending_users_are_flushed_on_close(self):
+        await database.add_user(1, "alice", "Alice")
+        await database.close()
+
+        conn = sqlite3.connect(self.db_path)
+        count = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        conn.close()
+        self.assertEqual(count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+import keyboards
+
+
+class KeyboardCacheTests(unittest.TestCase):
+    def test_static_menus_are_shared_and_frozen(self):
+        for menu in keyboards.STATIC_MENUS:
+            self.assertIs(menu(), menu())
+
+        with self.assertRaises(Exception):
+            keyboards.admin_menu().inline_keyboard = []
+
+    def test_shared_menus_cannot_be_mutated_in_place(self):
+        menu = keyboards.products_menu()
+        with self.assertRaises(AttributeError):
+            menu.inline_keyboard.append(())
+        with self.assertRaises(AttributeError):
+            menu.inline_keyboard[0].append(menu.inline_keyboard[0][0])
+        with self.assertRaises(Exception):
+            menu.inline_keyboard[0][0].text = "x"
+        with self.assertRaises(Exception):
+            keyboards.main_menu().keyboard[0][0].text = "x"
+
+        self.assertEqual(keyboards.products_menu().inline_keyboard[0][0].text, "ScoutScope")
+
+    def test_parametrized_menus_are_cached_per_arguments(self):
+        self.assertIs(keyboards.scout_scope_menu(True), keyboards.scout_scope_menu(True))
+        self.assertIsNot(keyboards.scout_scope_menu(True), keyboards.scout_scope_menu(False))
+        self.assertIs(keyboards.demo_platform_menu("crm"), keyboards.demo_platform_menu("crm"))
+
+    def test_delete_targets_menu_is_cached_by_uploaded_files(self):
+        product = {
+            "file_id": "a", "version": "1", "file_id_mac": None, "version_mac": None,
+            "db_file_id": None, "db_version": None,
+        }
+        menu = keyboards.admin_delete_targets_menu("crm", product)
+
+        self.assertIs(keyboards.admin_delete_targets_menu("crm", {**product, "version": "2"}), menu)
+        callbacks = [row[0].callback_data for row in menu.inline_keyboard]
+        self.assertEqual(
+            callbacks,
+            ["admin_del_target_app_win", "admin_delete_back_products", "admin_delete_cancel"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+from aiogram import Bot
+from aiogram.types import CallbackQuery, User
+from aiohttp import ClientSession
+
+import middlewares
+from callbacks import CallbackTable
+from metrics import Metrics, start_metrics_server
+from ratelimit import RateLimitPolicy, rate_limit
+
+
+def _callback(data):
+    return CallbackQuery(
+        id="1", from_user=User(id=1, is_bot=False, first_name="u"), chat_instance="1", data=data
+    ).as_(Bot("1:test"))
+
+
+class MetricsTests(unittest.TestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        for seconds in (0.05, 0.1, 0.5, 3.0):
+            metrics.observe("Message", "cmd_start", seconds)
+
+        text = metrics.render()
+        self.assertIn('bot_updates_total{event="Message",handler="cmd_start"} 4', text)
+        self.assertIn('bot_handler_latency_seconds_bucket{event="Message",handler="cmd_start",le="0.1"} 2', text)
+        self.assertIn('bot_handler_latency_seconds_bucket{event="Message",handler="cmd_start",le="1.0"} 3', text)
+        self.assertIn('bot_handler_latency_seconds_bucket{event="Message",handler="cmd_start",le="+Inf"} 4', text)
+        self.assertIn('bot_handler_latency_seconds_count{event="Message",handler="cmd_start"} 4', text)
+        self.assertIn("# TYPE bot_handler_latency_seconds histogram", text)
+
+    def test_label_values_are_escaped(self):
+        metrics = Metrics()
+        metrics.error("Message", 'say "hi"\n', ValueError())
+        self.assertIn('handler="say \\"hi\\"\\n",exception="ValueError"} 1', metrics.render())
+
+
+class MetricsMiddlewareTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.metrics = Metrics()
+        self.table = CallbackTable()
+
+        @self.table.route("demo_download_", fields=("product_key", "platform"))
+        @rate_limit(RateLimitPolicy(min_interval=0, max_requests=1, bucket="downloads"))
+        async def send_demo(callback, product_key, platform):
+            pass
+
+        @self.table.route("buy_", fields=("product_key",))
+        async def buy_request(callback, product_key):
+            raise RuntimeError("boom")
+
+        self.outer = middlewares.MetricsMiddleware(self.metrics, self.table)
+        self.limiter = middlewares.RateLimitMiddleware(min_interval=0, callbacks=self.table)
+
+    async def _press(self, data):
+        async def dispatch(event, data):
+            return await self.table.dispatch(event, **data)
+
+        async def limited(event, data):
+            return await self.limiter(dispatch, event, data)
+
+        return await self.outer(limited, _callback(data), {"raw_state": None})
+
+    async def test_callbacks_are_labelled_by_route(self):
+        with patch.object(CallbackQuery, "answer", new=AsyncMock()):
+            await self._press("demo_download_crm_win")
+            await self._press("demo_download_crm_win")
+            with self.assertRaises(RuntimeError):
+                await self._press("buy_crm")
+
+        self.assertEqual(self.metrics._updates[("CallbackQuery", "send_demo")], 1)
+        self.assertEqual(self.metrics._throttled[("CallbackQuery", "send_demo", "downloads")], 1)
+        self.assertEqual(self.metrics._errors[("CallbackQuery", "buy_request", "RuntimeError")], 1)
+
+    async def test_unknown_callback_is_labelled_unhandled(self):
+        with patch.object(CallbackQuery, "answer", new=AsyncMock()):
+            await self._press("no_such_button")
+
+        self.assertEqual(self.metrics._updates, {("CallbackQuery", middlewares.UNHANDLED_LABEL): 1})
+
+    async def test_message_handlers_are_labelled_by_function(self):
+        async def cmd_start(message):
+            pass
+
+        handler = AsyncMock(return_value="ok")
+        event = SimpleNamespace(from_user=SimpleNamespace(id=1))
+        result = await self.outer(handler, event, {"handler": SimpleNamespace(callback=cmd_start)})
+
+        self.assertEqual(result, "ok")
+        self.assertEqual(self.metrics._updates[("SimpleNamespace", "cmd_start")], 1)
+
+
+class MetricsServerTests(unittest.IsolatedAsyncioTestCase):
+    async def test_endpoint_serves_prometheus_text(self):
+        metrics = Metrics()
+        metrics.observe("Message", "cmd_start", 0.01)
+        runner = await start_metrics_server(metrics, 0)
+        self.addAsyncCleanup(runner.cleanup)
+        host, port = runner.addresses[0][:2]
+
+        async with ClientSession() as session:
+            async with session.get(f"http://{host}:{port}/metrics") as response:
+                body = await response.text()
+                self.assertEqual(response.status, 200)
+                self.assertTrue(response.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+
+        self.assertIn('bot_updates_total{event="Message",handler="cmd_start"} 1', body)
+
+
+if __name__ == "__main__":
+    unittest.main()
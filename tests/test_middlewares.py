@@ -0,0 +1,220 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+from aiogram import Bot
+from aiogram.types import CallbackQuery, User
+
+import handlers
+import middlewares
+import ratelimit
+from callbacks import CallbackTable
+from ratelimit import RateLimitPolicy, rate_limit
+
+
+def _callback(data="prod_crm"):
+    return CallbackQuery(
+        id="1", from_user=User(id=1, is_bot=False, first_name="u"), chat_instance="1", data=data
+    ).as_(Bot("1:test"))
+
+
+class CallbackAnswerMiddlewareTests(unittest.IsolatedAsyncioTestCase):
+    async def test_slow_handler_is_acknowledged_before_it_finishes(self):
+        middleware = middlewares.CallbackAnswerMiddleware(delay=0.01)
+        acknowledged_during_handler = False
+
+        async def handler(callback, data):
+            nonlocal acknowledged_during_handler
+            await asyncio.sleep(0.05)
+            acknowledged_during_handler = answer_mock.await_count == 1
+            await callback.answer()
+
+        with patch.object(CallbackQuery, "answer", new=AsyncMock()) as answer_mock:
+            await middleware(handler, _callback(), {})
+
+        self.assertTrue(acknowledged_during_handler)
+        answer_mock.assert_awaited_once()
+        self.assertIsNone(answer_mock.await_args.kwargs["text"])
+
+    async def test_early_alert_is_delivered(self):
+        middleware = middlewares.CallbackAnswerMiddleware(delay=0.05)
+
+        async def handler(callback, data):
+            await callback.answer("Продукт не найден", show_alert=True)
+            await callback.answer()
+
+        with patch.object(CallbackQuery, "answer", new=AsyncMock()) as answer_mock:
+            await middleware(handler, _callback(), {})
+
+        answer_mock.assert_awaited_once()
+        self.assertEqual(answer_mock.await_args.kwargs["text"], "Продукт не найден")
+        self.assertTrue(answer_mock.await_args.kwargs["show_alert"])
+
+    async def test_late_alert_is_logged(self):
+        middleware = middlewares.CallbackAnswerMiddleware(delay=0.01)
+
+        async def handler(callback, data):
+            await asyncio.sleep(0.05)
+            await callback.answer("Заявка отправлена", show_alert=True)
+
+        with patch.object(CallbackQuery, "answer", new=AsyncMock()) as answer_mock:
+            with self.assertLogs(middlewares.logger, "WARNING"):
+                await middleware(handler, _callback(), {})
+
+        answer_mock.assert_awaited_once()
+        self.assertIsNone(answer_mock.await_args.kwargs["text"])
+
+    async def test_purchase_request_alert_survives_slow_admin_notifications(self):
+        middleware = middlewares.CallbackAnswerMiddleware(delay=0.01)
+
+        async def slow_send(*args, **kwargs):
+            await asyncio.sleep(0.05)
+
+        bot = SimpleNamespace(send_message=slow_send)
+
+        async def handler(callback, data):
+            await handlers.buy_request(callback, bot, "crm")
+
+        with patch.object(CallbackQuery, "answer", new=AsyncMock()) as answer_mock, \
+                patch.object(handlers, "ADMIN_IDS", [7, 8]), \
+                patch.object(handlers, "_track_segment", new=AsyncMock()):
+            await middleware(handler, _callback("buy_crm"), {})
+
+        answer_mock.assert_awaited_once()
+        self.assertTrue(answer_mock.await_args.kwargs["show_alert"])
+        self.assertIn("Заявка отправлена", answer_mock.await_args.kwargs["text"])
+
+    async def test_failed_handler_still_stops_spinner(self):
+        middleware = middlewares.CallbackAnswerMiddleware(delay=1)
+
+        async def handler(callback, data):
+            raise RuntimeError("boom")
+
+        with patch.object(CallbackQuery, "answer", new=AsyncMock()) as answer_mock:
+            with self.assertRaises(RuntimeError):
+                await middleware(handler, _callback(), {})
+
+        answer_mock.assert_awaited_once()
+
+
+class RateLimitMiddlewareTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = patch.object(ratelimit, "monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.handler = AsyncMock(return_value="ok")
+
+    async def _event(self, limiter, user_id, data=None):
+        event = SimpleNamespace(from_user=SimpleNamespace(id=user_id))
+        return await limiter(self.handler, event, data if data is not None else {})
+
+    async def test_requests_faster_than_min_interval_are_dropped(self):
+        limiter = middlewares.RateLimitMiddleware(min_interval=0.5)
+        self.assertEqual(await self._event(limiter, 1), "ok")
+        self.now += 0.1
+        self.assertIsNone(await self._event(limiter, 1))
+        self.now += 0.5
+        self.assertEqual(await self._event(limiter, 1), "ok")
+
+    async def test_idle_users_are_evicted_in_bounded_batches(self):
+        limiter = middlewares.RateLimitMiddleware(idle_ttl=10, evict_batch=4)
+        for user_id in range(10):
+            await self._event(limiter, user_id)
+        self.assertEqual(len(limiter.backend), 10)
+
+        self.now += 5
+        await self._event(limiter, 3)
+        self.now += 6
+        await self._event(limiter, 100)
+        self.assertEqual(len(limiter.backend), 8)
+        await self._event(limiter, 100)
+        await self._event(limiter, 100)
+
+        # Пользователь 3 был активен позже остальных и остаётся
+        self.assertEqual(sorted(limiter.backend._buckets["default"]), [3, 100])
+
+    async def test_gcra_allows_burst_then_average_rate(self):
+        limiter = middlewares.RateLimitMiddleware(
+            min_interval=0, window=10, max_requests=4, algorithm=middlewares.RATE_LIMIT_GCRA
+        )
+        results = []
+        for _ in range(5):
+            results.append(await self._event(limiter, 1))
+            self.now += 0.01
+        self.assertEqual(results, ["ok"] * 4 + [None])
+
+        # Место для следующего запроса освобождается через window / max_requests
+        self.now += 2.5
+        self.assertEqual(await self._event(limiter, 1), "ok")
+        self.assertIsNone(await self._event(limiter, 1))
+
+    async def test_gcra_keeps_min_interval(self):
+        limiter = middlewares.RateLimitMiddleware(min_interval=0.5, algorithm=middlewares.RATE_LIMIT_GCRA)
+        self.assertEqual(await self._event(limiter, 1), "ok")
+        self.now += 0.1
+        self.assertIsNone(await self._event(limiter, 1))
+        self.assertFalse(hasattr(limiter.backend._buckets["default"][1], "recent"))
+
+    async def test_handler_policy_uses_its_own_bucket_and_cost(self):
+        @rate_limit(RateLimitPolicy(min_interval=0, max_requests=4, cost=2, bucket="downloads"))
+        async def download(message):
+            pass
+
+        limiter = middlewares.RateLimitMiddleware(min_interval=0)
+        data = {"handler": SimpleNamespace(callback=download)}
+        results = [await self._event(limiter, 1, dict(data)) for _ in range(3)]
+        self.assertEqual(results, ["ok", "ok", None])
+        # Общий счётчик дорогие запросы не тратят
+        self.assertEqual(await self._event(limiter, 1), "ok")
+
+    async def test_exempt_users_and_unlimited_handlers_pass(self):
+        @rate_limit(None)
+        async def unlimited(message):
+            pass
+
+        limiter = middlewares.RateLimitMiddleware(min_interval=10, exempt=[42])
+        for _ in range(3):
+            self.assertEqual(await self._event(limiter, 42), "ok")
+            self.assertEqual(await self._event(limiter, 1, {"handler": SimpleNamespace(callback=unlimited)}), "ok")
+        self.assertEqual(len(limiter.backend), 0)
+
+    async def test_callback_policy_comes_from_route(self):
+        table = CallbackTable()
+        calls = []
+
+        @table.route("demo_download_", fields=("product_key", "platform"))
+        @rate_limit(RateLimitPolicy(min_interval=0, max_requests=1, bucket="downloads"))
+        async def send_demo(callback, product_key, platform):
+            calls.append((product_key, platform))
+
+        limiter = middlewares.RateLimitMiddleware(min_interval=0, callbacks=table)
+        callback = _callback("demo_download_scout_scope_win")
+
+        async def handler(event, data):
+            return await table.dispatch(event, **data)
+
+        with patch.object(CallbackQuery, "answer", new=AsyncMock()) as answer_mock:
+            with patch.object(table, "resolve", wraps=table.resolve) as resolve:
+                await limiter(handler, callback, {"raw_state": None})
+                await limiter(handler, callback, {"raw_state": None})
+
+        self.assertEqual(calls, [("scout_scope", "win")])
+        # Маршрут ищется один раз на апдейт: dispatch берёт найденный лимитером
+        self.assertEqual(resolve.call_count, 2)
+        answer_mock.assert_awaited_once()
+
+    async def test_backend_failure_lets_requests_through(self):
+        backend = ratelimit.MemoryRateLimitBackend()
+        limiter = middlewares.RateLimitMiddleware(backend=backend)
+        with patch.object(backend, "hit", side_effect=OSError("disk I/O error")):
+            self.assertEqual(await self._event(limiter, 1), "ok")
+
+    def test_unknown_algorithm_is_rejected(self):
+        with self.assertRaises(ValueError):
+            middlewares.RateLimitMiddleware(algorithm="token")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import ratelimit
+from ratelimit import HIT_ALLOWED, HIT_DROPPED, HIT_WARN, RATE_LIMIT_GCRA, RateLimitPolicy
+
+
+class MemoryRateLimitBackendTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = patch.object(ratelimit, "monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_cost_is_charged_against_max_requests(self):
+        for algorithm in (ratelimit.RATE_LIMIT_WINDOW, RATE_LIMIT_GCRA):
+            backend = ratelimit.MemoryRateLimitBackend(algorithm)
+            policy = RateLimitPolicy(min_interval=0, window=10, max_requests=6, cost=3)
+            self.assertEqual(await backend.hit(1, policy), HIT_ALLOWED, algorithm)
+            self.assertEqual(await backend.hit(1, policy), HIT_ALLOWED, algorithm)
+            self.assertEqual(await backend.hit(1, policy), HIT_WARN, algorithm)
+
+    async def test_buckets_are_counted_separately(self):
+        backend = ratelimit.MemoryRateLimitBackend()
+        navigation = RateLimitPolicy(min_interval=0, max_requests=1)
+        downloads = RateLimitPolicy(min_interval=0, max_requests=1, bucket="downloads")
+        self.assertEqual(await backend.hit(1, navigation), HIT_ALLOWED)
+        self.assertEqual(await backend.hit(1, downloads), HIT_ALLOWED)
+        self.assertEqual(await backend.hit(1, navigation), HIT_WARN)
+        self.assertEqual(await backend.hit(1, downloads), HIT_WARN)
+        self.assertEqual(len(backend), 2)
+
+    def test_unknown_algorithm_is_rejected(self):
+        with self.assertRaises(ValueError):
+            ratelimit.MemoryRateLimitBackend("token")
+
+    def test_backend_must_implement_hit(self):
+        class Incomplete(ratelimit.RateLimitBackend):
+            pass
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+
+class SqliteRateLimitBackendTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._tmp.name, "rate_limit.db")
+        self.now = 1_700_000_000.0
+        patcher = patch.object(ratelimit, "time", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.policy = RateLimitPolicy(min_interval=0, window=10, max_requests=2)
+        # Два хранилища на один файл — как два процесса бота
+        self.first = ratelimit.SqliteRateLimitBackend(self.path)
+        self.second = ratelimit.SqliteRateLimitBackend(self.path)
+
+    async def asyncTearDown(self):
+        await self.first.close()
+        await self.second.close()
+        self._tmp.cleanup()
+
+    def _keys(self):
+        with sqlite3.connect(self.path) as conn:
+            return sorted(row[0] for row in conn.execute("SELECT key FROM rate_limits"))
+
+    async def test_processes_share_one_limit(self):
+        self.assertEqual(await self.first.hit(1, self.policy), HIT_ALLOWED)
+        self.assertEqual(await self.second.hit(1, self.policy), HIT_ALLOWED)
+        self.assertEqual(await self.first.hit(1, self.policy), HIT_WARN)
+        self.assertEqual(await self.second.hit(1, self.policy), HIT_DROPPED)
+        # Другой пользователь считается отдельно
+        self.assertEqual(await self.second.hit(2, self.policy), HIT_ALLOWED)
+
+        self.now += 5
+        self.assertEqual(await self.second.hit(1, self.policy), HIT_ALLOWED)
+
+    async def test_matches_memory_backend(self):
+        policy = RateLimitPolicy(min_interval=0.5, window=10, max_requests=4)
+        memory = ratelimit.MemoryRateLimitBackend(RATE_LIMIT_GCRA)
+        with patch.object(ratelimit, "monotonic", side_effect=lambda: self.now):
+            for step in (0, 0.1, 0.6, 0.6, 0.6, 0.6, 3, 0.2, 6):
+                self.now += step
+                self.assertEqual(await self.first.hit(7, policy), await memory.hit(7, policy))
+
+    async def test_expired_rows_are_deleted_in_batches(self):
+        backend = ratelimit.SqliteRateLimitBackend(self.path, evict_batch=3, evict_interval=0)
+        self.addAsyncCleanup(backend.close)
+        policy = RateLimitPolicy(min_interval=0, idle_ttl=10)
+        for user_id in range(5):
+            await backend.hit(user_id, policy)
+
+        self.now += 11
+        await backend.hit(100, policy)
+        self.assertEqual(len(self._keys()), 3)
+        await backend.hit(100, policy)
+        self.assertEqual(self._keys(), ["default:100"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -105,6 +105,26 @@ class ScoutScopeNavigationTests(unittest.IsolatedAsyncioTestCase):
         self.assertIn("2.0\\*mac", text)
         self.assertIn("db\\`3", text)
 
+    def test_product_view_is_cached_until_row_changes(self):
+        product = {
+            "name": "CRM", "description": "desc", "version": "1.0", "version_mac": None,
+            "db_version": None, "file_id": "file-win", "file_id_mac": None,
+        }
+
+        with patch.object(handlers, "_product_views", {}), \
+                patch.object(handlers, "_build_product_text", wraps=handlers._build_product_text) as build_mock:
+            first = handlers._product_view("crm", product)
+            self.assertIs(handlers._product_view("crm", product), first)
+            # Перезагрузка каталога даёт новую строку с теми же данными — карточку не пересобираем
+            self.assertIs(handlers._product_view("crm", dict(product)), first)
+            self.assertEqual(build_mock.call_count, 1)
+
+            changed = handlers._product_view("crm", {**product, "version": "1.1"})
+
+        self.assertEqual(build_mock.call_count, 2)
+        self.assertIn("1.1", changed[0])
+        self.assertEqual(changed[2], "Performance.jpg")
+
 
 if __name__ == "__main__":
     unittest.main()
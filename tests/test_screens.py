@@ -0,0 +1,114 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InputMediaPhoto
+
+import keyboards
+from screens import Screen, ScreenRenderer
+
+
+def _message(photo=False, message_id=1):
+    message = SimpleNamespace(
+        chat=SimpleNamespace(id=10),
+        message_id=message_id,
+        photo=[SimpleNamespace(file_id="old")] if photo else None,
+        edit_text=AsyncMock(),
+        edit_caption=AsyncMock(),
+        edit_media=AsyncMock(),
+        edit_reply_markup=AsyncMock(),
+        delete=AsyncMock(),
+        answer=AsyncMock(),
+        answer_photo=AsyncMock(),
+    )
+    message.answer.return_value = SimpleNamespace(chat=message.chat, message_id=message_id + 1)
+    return message
+
+
+class ScreenRendererTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        async def send(path, request):
+            return await request(f"id:{path}")
+
+        assets = SimpleNamespace(content_hash=lambda path: f"hash:{path}", send=send)
+        self.renderer = ScreenRenderer(assets)
+
+    async def test_text_is_edited_once_and_identical_render_is_skipped(self):
+        message = _message()
+        screen = Screen("Выберите продукт:", keyboards.products_menu())
+
+        await self.renderer.show(message, screen)
+        await self.renderer.show(message, screen)
+
+        message.edit_text.assert_awaited_once()
+        message.delete.assert_not_awaited()
+
+    async def test_markup_only_change_edits_reply_markup(self):
+        message = _message()
+        await self.renderer.show(message, Screen("text", keyboards.crm_menu(True)))
+        await self.renderer.show(message, Screen("text", keyboards.crm_menu(False)))
+
+        message.edit_text.assert_awaited_once()
+        message.edit_reply_markup.assert_awaited_once_with(reply_markup=keyboards.crm_menu(False))
+
+    async def test_markup_is_compared_by_identity(self):
+        message = _message()
+        markup = keyboards.products_menu()
+        await self.renderer.show(message, Screen("text", markup))
+        await self.renderer.show(message, Screen("text", markup.model_copy()))
+
+        message.edit_reply_markup.assert_awaited_once()
+
+    async def test_photo_screens_use_edit_media_then_edit_caption(self):
+        message = _message(photo=True)
+        await self.renderer.show(message, Screen("CRM", keyboards.crm_menu(True), "Performance.jpg"))
+        await self.renderer.show(message, Screen("Тарифы", keyboards.scout_scope_pro_plans_menu(), keep_photo=True))
+
+        media = message.edit_media.await_args.args[0]
+        self.assertIsInstance(media, InputMediaPhoto)
+        self.assertEqual(media.media, "id:Performance.jpg")
+        message.edit_caption.assert_awaited_once()
+        message.delete.assert_not_awaited()
+
+    async def test_missing_photo_falls_back_to_caption_or_text(self):
+        def content_hash(path):
+            raise FileNotFoundError(path)
+
+        self.renderer._assets.content_hash = content_hash
+        photo_message = _message(photo=True)
+        text_message = _message(message_id=5)
+        screen = Screen("CRM", keyboards.crm_menu(True), photo="missing.png")
+
+        with self.assertLogs("screens", "WARNING"):
+            await self.renderer.show(photo_message, screen)
+            await self.renderer.show(text_message, screen)
+
+        photo_message.edit_caption.assert_awaited_once()
+        photo_message.edit_media.assert_not_awaited()
+        text_message.edit_text.assert_awaited_once()
+        text_message.delete.assert_not_awaited()
+
+    async def test_photo_to_text_is_replaced(self):
+        message = _message(photo=True)
+        sent = await self.renderer.show(message, Screen("Выберите продукт:", keyboards.products_menu()))
+
+        message.delete.assert_awaited_once()
+        message.answer.assert_awaited_once()
+        self.assertEqual(sent.message_id, 2)
+
+    async def test_not_modified_is_ignored_and_bad_markdown_falls_back(self):
+        message = _message()
+        message.edit_text.side_effect = TelegramBadRequest(None, "Bad Request: message is not modified")
+        await self.renderer.show(message, Screen("same"))
+
+        message.edit_text.side_effect = [TelegramBadRequest(None, "Bad Request: can't parse entities"), None]
+        message.edit_text.reset_mock()
+        await self.renderer.show(message, Screen("broken *markdown"))
+
+        parse_modes = [call.kwargs["parse_mode"] for call in message.edit_text.await_args_list]
+        self.assertEqual(parse_modes, ["Markdown", None])
+
+
+if __name__ == "__main__":
+    unittest.main()